@@ -13,6 +13,23 @@ float_vec_t to_float_vec(vec_t v)
   return { (float)v.x, (float)v.y, (float)v.z };
 }
 
+#ifdef COMPACT_WIRE
+vec_t to_vec(vec_t v)
+{
+  return v;
+}
+
+wire_vec_t to_wire_vec(vec_t v)
+{
+  return v;
+}
+#else
+wire_vec_t to_wire_vec(vec_t v)
+{
+  return to_float_vec(v);
+}
+#endif
+
 void intersect_ray_shape(
   ray_t *ray,
   shape_t *shape,
@@ -165,7 +182,7 @@ Loop_Over_Scene:
 
       for (int j = 0; j < BATCH_SIZE; j++) {
         rayhit_data tmp_rayhit;
-        tmp_rayhit.data = { to_float_vec(intersects[j].pt), intersects[j].scene_index };
+        tmp_rayhit.data = { to_wire_vec(intersects[j].pt), (wire_index_t)intersects[j].scene_index };
         tmp_rayhit.dest = tmp_ray.dest;
         tmp_rayhit.id = tmp_ray.id;
         tmp_rayhit.keep = tmp_ray.keep;
@@ -40,18 +40,31 @@ typedef struct __attribute__((packed)) {
   fp_t _pad[2];
 } ray_t;
 
+// With COMPACT_WIRE defined, rays and rayhits cross the DMA as fp_t values rather
+// than floats: 16 bytes per ray instead of 32, and 8 bytes per rayhit instead of 16.
+// Rays keep two pad values either way so the stream width stays a power of two.
+#ifdef COMPACT_WIRE
+typedef vec_t wire_vec_t;
+typedef fp_t wire_pad_t;
+typedef uint16_t wire_index_t;
+#else
+typedef float_vec_t wire_vec_t;
+typedef float wire_pad_t;
+typedef int wire_index_t;
+#endif
+
 typedef struct __attribute__((packed)) {
-  float_vec_t origin;
-  float_vec_t direction;
-  float _pad[2];
+  wire_vec_t origin;
+  wire_vec_t direction;
+  wire_pad_t _pad[2];
 } wire_ray_t;
 
 typedef hls::axis<wire_ray_t, 1, 1, 1> ray_data;
 typedef hls::stream<ray_data> ray_stream;
 
-typedef struct {
-  float_vec_t loc;
-  int scene_index;
+typedef struct __attribute__((packed)) {
+  wire_vec_t loc;
+  wire_index_t scene_index;
 } rayhit_t;
 
 typedef hls::axis<rayhit_t, 1, 1, 1> rayhit_data;
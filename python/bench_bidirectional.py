@@ -0,0 +1,173 @@
+"""
+Compare how fast the bidirectional and unidirectional integrators converge on each scene.
+
+Renders a converged reference of each scene once (cached in .bench_cache/), then renders
+the scene with render_scene_wavefront and with render_scene_bidirectional at doubling rays
+per pixel until the time budget runs out, measuring the error against the reference after
+each render. For the last render of each integrator that fit the budget, prints the rays
+per pixel, seconds, RMSE, and the efficiency: the inverse of MSE times seconds, which stays
+about constant as rays per pixel grow, so the ratio of two integrators' efficiencies is how
+much longer one needs to reach the same error.
+
+The reference is rendered with the bidirectional integrator, which converges to the same
+image, as unidirectional references of scenes with small lights stay too noisy to measure
+against. Its remaining noise would still put a floor under every render's error, so it is
+rendered as two halves with their own seeds, and the noise their difference shows is taken
+out of the MSE the efficiencies use.
+
+    python3 bench_bidirectional.py scenes/cornell_box_small_light.json
+    python3 bench_bidirectional.py scenes/*.json --depth 5 --budget 30 --out bidirectional.json
+
+Light subpaths only start from emissive spheres, triangles and quads, so scenes lit by
+planes alone are rendered the same way by both integrators.
+"""
+
+import argparse
+import contextlib
+import hashlib
+import io
+import itertools
+import json
+import os
+import time
+
+import numpy as np
+
+from bench_quality import CACHE_DIR, REFERENCE_SEED, errors
+from pathtracer import CounterRNG, Pathtracer
+
+INTEGRATORS = {
+    "unidirectional": "render_scene_wavefront",
+    "bidirectional": "render_scene_bidirectional",
+}
+
+
+def render(scene_json, rows, cols, spp, depth, integrator, seed=0) -> Pathtracer:
+    """
+    Render a scene quietly.
+
+    Parameters:
+        scene_json: The scene.
+        rows: The render height.
+        cols: The render width.
+        spp: The rays per pixel.
+        depth: The bounce depth.
+        integrator: One of INTEGRATORS.
+        seed: The seed of the pathtracer's random numbers.
+
+    Returns:
+        Pathtracer: The pathtracer holding the render.
+    """
+    p = Pathtracer(rows, cols)
+    p.rays_per_pixel = spp
+    p.depth = depth
+    p.rng = CounterRNG(seed)
+    p.load_from_json(scene_json)
+    with contextlib.redirect_stdout(io.StringIO()):
+        getattr(p, INTEGRATORS[integrator])()
+    return p
+
+
+def reference(scene_json, rows, cols, spp, depth) -> tuple:
+    """
+    Get the converged reference of a scene at the bounce depth of the renders, rendering and
+    caching it the first time.
+
+    Parameters:
+        scene_json: The scene.
+        rows: The render height.
+        cols: The render width.
+        spp: The reference's rays per pixel.
+        depth: The bounce depth.
+
+    Returns:
+        Tuple[np.ndarray, float]: The reference image, and the MSE of its own noise on the 0-1 scale.
+    """
+    settings = json.dumps([scene_json, rows, cols, spp, depth, REFERENCE_SEED, "bidirectional"])
+    fname = os.path.join(CACHE_DIR, f"reference_{hashlib.sha1(settings.encode()).hexdigest()[:16]}.npz")
+    if os.path.exists(fname):
+        cached = np.load(fname)
+        return cached["image"], float(cached["noise_mse"])
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    t0 = time.time()
+    halves = [
+        render(scene_json, rows, cols, spp // 2, depth, "bidirectional", seed=REFERENCE_SEED + i).final_pixels
+        for i in range(2)
+    ]
+    image = (halves[0] + halves[1]) / 2
+    # The halves' difference has twice the variance of a half, four times the variance of their mean.
+    noise_mse = errors(halves[0], halves[1])["rmse"] ** 2 / 4
+    print(f"  rendered the {spp} rays per pixel reference in {time.time() - t0:.1f} s, rmse {np.sqrt(noise_mse):.4f}")
+    np.savez(fname, image=image, noise_mse=noise_mse)
+    return image, noise_mse
+
+
+def curve(scene_json, ref, noise_mse, rows, cols, depth, integrator, budget) -> list:
+    """
+    Render with an integrator at 1, 2, 4, ... rays per pixel until a render would run past the budget.
+
+    Parameters:
+        scene_json: The scene.
+        ref: The scene's reference image.
+        noise_mse: The MSE of the reference's own noise.
+        rows: The render height.
+        cols: The render width.
+        depth: The bounce depth.
+        integrator: One of INTEGRATORS.
+        budget: The time budget, in seconds.
+
+    Returns:
+        list: A point per render, with its rays per pixel, seconds taken, errors and efficiency.
+    """
+    points = []
+    for spp in (2 ** i for i in itertools.count()):
+        t0 = time.time()
+        p = render(scene_json, rows, cols, spp, depth, integrator)
+        seconds = time.time() - t0
+        error = errors(p.final_pixels, ref)
+        mse = max(error["rmse"] ** 2 - noise_mse, 1e-12)
+        points.append({"spp": spp, "seconds": seconds, **error, "efficiency": 1 / (mse * seconds)})
+        # Render times roughly double with the rays per pixel.
+        if seconds * 2 > budget:
+            break
+    return points
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenes", nargs="+")
+    parser.add_argument("--rows", type=int, default=30)
+    parser.add_argument("--cols", type=int, default=40)
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--budget", type=float, default=16, help="time budget per integrator, in seconds")
+    parser.add_argument("--reference-spp", type=int, default=4096)
+    parser.add_argument("--out", default="bidirectional.json")
+    args = parser.parse_args()
+
+    results = {}
+    for scene in args.scenes:
+        print(scene)
+        with open(scene, "r") as scene_file:
+            scene_json = scene_file.read()
+        ref, noise_mse = reference(scene_json, args.rows, args.cols, args.reference_spp, args.depth)
+
+        curves = {}
+        for integrator in INTEGRATORS:
+            curves[integrator] = curve(scene_json, ref, noise_mse, args.rows, args.cols, args.depth, integrator, args.budget)
+            last = curves[integrator][-1]
+            print(
+                f"  {integrator:<15} {last['spp']:>5} spp in {last['seconds']:>6.2f} s: rmse {last['rmse']:.4f}, "
+                f"efficiency {last['efficiency']:>10.4g} / (mse s)"
+            )
+        ratio = curves["bidirectional"][-1]["efficiency"] / curves["unidirectional"][-1]["efficiency"]
+        print(f"  bidirectional converges {ratio:.2f}x as fast")
+        results[os.path.basename(scene)] = {"curves": curves, "efficiency_ratio": ratio}
+
+    settings = {key: getattr(args, key) for key in ("rows", "cols", "depth", "budget", "reference_spp")}
+    with open(args.out, "w") as out_file:
+        json.dump({"settings": settings, "scenes": results}, out_file, indent=2)
+    print(f"Wrote the curves to {args.out}.")
+
+
+if __name__ == "__main__":
+    main()
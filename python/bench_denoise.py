@@ -0,0 +1,65 @@
+"""
+Compare low sample count renders, with and without denoising, against a high sample count reference.
+
+    python3 bench_denoise.py scenes/cornell_box.json --rows 60 --cols 80 --spp 4 --reference-spp 256
+"""
+
+import argparse
+import contextlib
+import io
+import time
+
+import numpy as np
+
+from denoise import denoise_render
+from pathtracer import Pathtracer
+
+
+def rmse(image, reference) -> float:
+    """
+    Get the root mean squared error of an image against a reference, on the displayed 0-255 scale.
+    """
+    return float(np.sqrt(np.mean((image.clip(0, 255) - reference.clip(0, 255)) ** 2)))
+
+
+def render(scene, rows, cols, spp, depth, aovs) -> Pathtracer:
+    p = Pathtracer(rows, cols)
+    p.rays_per_pixel = spp
+    p.depth = depth
+    p.aovs_enabled = aovs
+    p.load_from_file(scene)
+    with contextlib.redirect_stdout(io.StringIO()):
+        p.render_scene()
+    return p
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenes", nargs="+")
+    parser.add_argument("--rows", type=int, default=60)
+    parser.add_argument("--cols", type=int, default=80)
+    parser.add_argument("--spp", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--reference-spp", type=int, default=256)
+    parser.add_argument("--depth", type=int, default=5)
+    args = parser.parse_args()
+
+    for scene in args.scenes:
+        t0 = time.time()
+        reference = render(scene, args.rows, args.cols, args.reference_spp, args.depth, False).final_pixels
+        print(f"{scene}: {args.reference_spp} spp reference took {time.time() - t0:.1f} s")
+        print(f"  {'spp':>4} {'render s':>9} {'denoise s':>10} {'rmse':>8} {'denoised rmse':>14}")
+        for spp in args.spp:
+            t0 = time.time()
+            p = render(scene, args.rows, args.cols, spp, args.depth, True)
+            render_time = time.time() - t0
+            t0 = time.time()
+            denoised = denoise_render(p)
+            denoise_time = time.time() - t0
+            print(
+                f"  {spp:>4} {render_time:>9.2f} {denoise_time:>10.3f} "
+                f"{rmse(p.final_pixels, reference):>8.2f} {rmse(denoised, reference):>14.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
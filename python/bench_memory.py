@@ -0,0 +1,213 @@
+"""
+Measure the memory used by renders of the bundled scenes at several resolutions, sample
+counts and backends, and check it against the stored budget.
+
+    python3 bench_memory.py                  # measure and check against memory_budget.json
+    python3 bench_memory.py --update         # measure and store the results as the new budget
+    python3 bench_memory.py --scenes scenes/cornell_box.json --backends grouped --sizes 48x64
+
+Every configuration renders in a fresh process. Python allocations are traced with
+tracemalloc, and the process RSS is sampled from /proc while the render runs. Figures
+are reported per million pixels, relative to the process just before the pathtracer is
+created (after a tiny warm-up render, so one-off allocations are left out):
+
+    peak      the most traced memory held at once during the render
+    retained  the traced memory still held by the pathtracer once the render is done
+    peak rss / steady rss   the largest and the median sampled RSS during the render
+
+The check fails (exit status 1) when the peak or retained memory of a configuration
+exceeds its budget by more than the tolerance. RSS figures are only reported, as they
+depend on the allocator and the machine.
+"""
+
+import argparse
+import concurrent.futures
+import contextlib
+import glob
+import io
+import json
+import multiprocessing
+import os
+import statistics
+import threading
+import time
+import tracemalloc
+
+BACKENDS = ["software", "grouped", "wavefront", "progressive", "hardware", "bidirectional"]
+DEFAULT_BUDGET = os.path.join(os.path.dirname(os.path.abspath(__file__)), "memory_budget.json")
+RSS_SAMPLE_INTERVAL = 0.005
+
+
+def current_rss() -> int:
+    """
+    Get the resident set size of this process, in bytes, or 0 where /proc is not available.
+    """
+    try:
+        with open("/proc/self/statm", "r") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return 0
+
+
+class RssSampler():
+    """Represents a background thread sampling the RSS of this process."""
+
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL) -> None:
+        self.interval = interval
+        self.samples = []
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self) -> None:
+        while not self.stop.is_set():
+            self.samples.append(current_rss())
+            time.sleep(self.interval)
+
+    def __enter__(self) -> "RssSampler":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stop.set()
+        self.thread.join()
+        self.samples.append(current_rss())
+
+
+def measure(scene, backend, rows, cols, spp, depth) -> dict:
+    """
+    Render one configuration and measure its memory. Meant to run in a fresh process.
+
+    Parameters:
+        scene: The scene file.
+        backend: One of BACKENDS.
+        rows: The render height.
+        cols: The render width.
+        spp: The rays per pixel.
+        depth: The bounce depth.
+
+    Returns:
+        dict: The measurements, in bytes per million pixels, and the render time.
+    """
+    from pathtracer import Pathtracer
+
+    with open(scene, "r") as scene_file:
+        scene_json = scene_file.read()
+
+    def render(rows, cols, spp, sampler=None) -> Pathtracer:
+        p = Pathtracer(rows, cols)
+        p.rays_per_pixel = spp
+        p.depth = depth
+        p.load_from_json(scene_json)
+        with sampler or contextlib.nullcontext(), contextlib.redirect_stdout(io.StringIO()):
+            if backend == "software":
+                p.render_scene()
+            elif backend == "grouped":
+                p.render_scene_in_software()
+            elif backend == "wavefront":
+                p.render_scene_wavefront()
+            elif backend == "progressive":
+                p.render_progressive()
+            elif backend == "hardware":
+                p.init_hardware(emulate=True)
+                p.render_scene_in_hardware()
+            elif backend == "bidirectional":
+                p.render_scene_bidirectional()
+            else:
+                raise Exception(f"Unknown backend {backend}.")
+        return p
+
+    # Warm up on a tiny render first, so lazy imports and one-off allocations are not counted.
+    render(2, 2, 1)
+
+    rss_base = current_rss()
+    tracemalloc.start()
+    base, _ = tracemalloc.get_traced_memory()
+    t0 = time.time()
+    sampler = RssSampler()
+    p = render(rows, cols, spp, sampler)
+    seconds = time.time() - t0
+
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    megapixels = rows * cols / 1e6
+    rss = [max(sample - rss_base, 0) for sample in sampler.samples]
+    return {
+        "peak": (peak - base) / megapixels,
+        "retained": (retained - base) / megapixels,
+        "peak_rss": max(rss) / megapixels,
+        "steady_rss": statistics.median(rss) / megapixels,
+        "seconds": seconds,
+    }
+
+
+def config_key(scene, backend, rows, cols, spp) -> str:
+    return f"{os.path.basename(scene)}:{backend}:{rows}x{cols}:{spp}spp"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenes", nargs="+", default=sorted(glob.glob(os.path.join("scenes", "*.json"))))
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=BACKENDS)
+    parser.add_argument("--sizes", nargs="+", default=["12x16", "24x32", "48x64"], help="resolutions, as ROWSxCOLS")
+    parser.add_argument("--spp", type=int, nargs="+", default=[1, 2])
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--budget", default=DEFAULT_BUDGET)
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed growth over the budget, as a fraction")
+    parser.add_argument("--update", action="store_true", help="store the measurements as the new budget")
+    args = parser.parse_args()
+
+    budget = {}
+    if os.path.exists(args.budget):
+        with open(args.budget, "r") as budget_file:
+            budget = json.load(budget_file)
+
+    configs = [
+        (scene, backend, *map(int, size.split("x")), spp)
+        for scene in args.scenes
+        for backend in args.backends
+        for size in args.sizes
+        for spp in args.spp
+    ]
+    results = {}
+    failures = []
+    print(f"{'configuration':<48} {'peak':>9} {'retained':>9} {'peak rss':>9} {'steady rss':>10} {'seconds':>8}   (MB / Mpixel)")
+    for scene, backend, rows, cols, spp in configs:
+        # A fresh process per configuration, so allocations and RSS don't carry over.
+        with concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+            result = pool.submit(measure, scene, backend, rows, cols, spp, args.depth).result()
+        key = config_key(scene, backend, rows, cols, spp)
+        results[key] = result
+        status = ""
+        if key in budget and not args.update:
+            over = [
+                metric for metric in ("peak", "retained")
+                if result[metric] > budget[key][metric] * (1 + args.tolerance)
+            ]
+            if over:
+                failures.append(key)
+                status = "  OVER BUDGET: " + ", ".join(
+                    f"{metric} {result[metric] / 1e6:.1f} > {budget[key][metric] / 1e6:.1f}" for metric in over
+                )
+        print(
+            f"{key:<48} {result['peak'] / 1e6:>9.1f} {result['retained'] / 1e6:>9.1f} "
+            f"{result['peak_rss'] / 1e6:>9.1f} {result['steady_rss'] / 1e6:>10.1f} {result['seconds']:>8.2f}{status}"
+        )
+
+    if args.update:
+        budget.update({key: {"peak": round(r["peak"]), "retained": round(r["retained"])} for key, r in results.items()})
+        with open(args.budget, "w") as budget_file:
+            json.dump(budget, budget_file, indent=2, sort_keys=True)
+            budget_file.write("\n")
+        print(f"Stored the budget for {len(results)} configurations in {args.budget}.")
+        return
+
+    missing = [key for key in results if key not in budget]
+    if missing:
+        print(f"{len(missing)} configurations have no budget yet; run with --update to add them.")
+    if failures:
+        print(f"{len(failures)} configurations are over budget.")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Compare the occlusion query backends with answering the same queries through cast_ray.
+
+Casts camera rays through a grid of pixels to find points on each scene's surfaces, pairs
+the points up at random, and asks whether each pair sees each other: with cast_ray, by
+finding the closest hit and comparing its distance, and with Pathtracer.occluded on each
+backend, which stops at the first blocker. Prints the time taken, the queries per second,
+the speedup over cast_ray, and how many answers differ from cast_ray's.
+
+    python3 bench_occlusion.py scenes/cornell_box.json scenes/instanced_boxes.json
+    python3 bench_occlusion.py scenes/*.json --rows 40 --cols 60 --backends wavefront hardware
+
+The hardware backend runs on the emulated hardware. Its fixed point arithmetic, and the CPU
+sphere test it shares with the hybrid renderer, make a few answers differ at grazing angles.
+"""
+
+import argparse
+import contextlib
+import io
+import time
+
+import numpy as np
+
+from pathtracer import MIN_HIT_DIST, OCCLUSION_BACKENDS, Pathtracer, Ray
+
+
+def point_pairs(p, seed) -> tuple:
+    """
+    Get pairs of points on the scene's surfaces, from the first hits of one camera ray per pixel.
+
+    Parameters:
+        p: The pathtracer holding the scene.
+        seed: The seed for pairing up the points.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The points and the points paired with them, (n, 3) each.
+    """
+    rows, cols = np.mgrid[0:p.rows, 0:p.cols]
+    dirs = np.array([p.camera.get_ray_dir(c + 0.5, r + 0.5) for r, c in zip(rows.ravel(), cols.ravel())], dtype=float)
+    origins = np.tile(np.asarray(p.camera.pos, dtype=float), (len(dirs), 1))
+    p.wave_shapes = p.wavefront_shapes()
+    hit, points, *_ = p.wavefront_extend(origins, dirs)
+    points = points[hit]
+    return points, points[np.random.default_rng(seed).permutation(len(points))]
+
+
+def cast_ray_occluded(p, origins, dirs, max_dists) -> np.ndarray:
+    """
+    Answer occlusion queries through cast_ray, the way they were answered before Pathtracer.occluded.
+
+    Parameters:
+        p: The pathtracer holding the scene.
+        origins: The ray origins, (n, 3).
+        dirs: The ray directions, (n, 3).
+        max_dists: The distance along each ray hits must be nearer than, (n,).
+
+    Returns:
+        np.ndarray: Per ray, whether it is blocked.
+    """
+    occluded = np.zeros(len(origins), dtype=bool)
+    for i in range(len(origins)):
+        if max_dists[i] > MIN_HIT_DIST:
+            isect = p.cast_ray(Ray(origins[i], dirs[i]))
+            occluded[i] = isect is not None and isect.dist < max_dists[i]
+    return occluded
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenes", nargs="+")
+    parser.add_argument("--rows", type=int, default=30)
+    parser.add_argument("--cols", type=int, default=40)
+    parser.add_argument("--backends", nargs="+", choices=OCCLUSION_BACKENDS, default=list(OCCLUSION_BACKENDS))
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for scene in args.scenes:
+        p = Pathtracer(args.rows, args.cols)
+        p.load_from_file(scene)
+        points, targets = point_pairs(p, args.seed)
+        if not len(points):
+            print(f"{scene}: no camera ray hits anything, skipped")
+            continue
+        dirs = targets - points
+        max_dists = np.linalg.norm(dirs, axis=1) - MIN_HIT_DIST
+
+        t0 = time.time()
+        reference = cast_ray_occluded(p, points, dirs, max_dists)
+        base_seconds = time.time() - t0
+        print(f"{scene}: {len(points)} point pairs, {reference.mean() * 100:.1f}% occluded")
+        print(f"  {'cast_ray':<10} {base_seconds:>8.3f} s {len(points) / base_seconds:>10.0f} queries/s")
+
+        for backend in args.backends:
+            if backend == "hardware":
+                with contextlib.redirect_stdout(io.StringIO()):
+                    p.init_hardware(emulate=True)
+                    p.send_scene_to_hardware()
+                    p.allocate_buffers(len(points))
+            t0 = time.time()
+            occluded = p.occluded(points, dirs, max_dists, backend)
+            seconds = time.time() - t0
+            print(
+                f"  {backend:<10} {seconds:>8.3f} s {len(points) / seconds:>10.0f} queries/s "
+                f"{base_seconds / seconds:>7.1f}x, {int(np.sum(occluded != reference))} answers differ"
+            )
+
+
+if __name__ == "__main__":
+    main()
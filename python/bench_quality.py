@@ -0,0 +1,205 @@
+"""
+Compare render configurations on error for equal render time.
+
+Renders a converged reference of each scene once (cached in .bench_cache/), then renders
+each configuration at doubling rays per pixel until its time budget runs out, measuring
+the error against the reference after each render. The error-vs-time curves are written
+as JSON, along with the configuration with the lowest error within each time budget.
+
+    python3 bench_quality.py scenes/cornell_box.json --budgets 2 5 10 --out quality.json
+    python3 bench_quality.py scenes/*.json --depths 3 5 --backends software hardware --denoise off on
+
+A configuration is a bounce depth, a backend (`software` renders with render_scene,
+`grouped` with render_scene_in_software, `wavefront` with render_scene_wavefront,
+`bidirectional` with render_scene_bidirectional and `hardware` on the emulated hardware), and
+whether the result is denoised. Errors are on the 0-1 scale: RMSE, and relative MSE
+(squared error over the squared reference plus 0.01, so dark pixels don't dominate).
+"""
+
+import argparse
+import contextlib
+import hashlib
+import io
+import itertools
+import json
+import os
+import time
+
+import numpy as np
+
+from denoise import denoise_render
+from pathtracer import CounterRNG, Pathtracer
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".bench_cache")
+REL_MSE_EPSILON = 0.01
+BACKENDS = ["software", "grouped", "wavefront", "bidirectional", "hardware"]
+# References use their own random numbers, so their noise is independent of the renders'.
+REFERENCE_SEED = 0x5EED
+
+
+def errors(image, reference) -> dict:
+    """
+    Get the error of an image against a reference, on the 0-1 scale.
+
+    Parameters:
+        image: The image, in 0-255 range.
+        reference: The reference, in 0-255 range.
+
+    Returns:
+        dict: The RMSE and the relative MSE.
+    """
+    image = image.clip(0, 255) / 255
+    reference = reference.clip(0, 255) / 255
+    squared = (image - reference) ** 2
+    return {
+        "rmse": float(np.sqrt(np.mean(squared))),
+        "rel_mse": float(np.mean(squared / (reference ** 2 + REL_MSE_EPSILON))),
+    }
+
+
+def render(scene_json, rows, cols, spp, depth, backend, aovs=False, seed=0) -> Pathtracer:
+    """
+    Render a scene quietly.
+
+    Parameters:
+        scene_json: The scene.
+        rows: The render height.
+        cols: The render width.
+        spp: The rays per pixel.
+        depth: The bounce depth.
+        backend: One of BACKENDS.
+        aovs: Whether to record the auxiliary buffers, for denoising.
+        seed: The seed of the pathtracer's random numbers.
+
+    Returns:
+        Pathtracer: The pathtracer holding the render.
+    """
+    p = Pathtracer(rows, cols)
+    p.rays_per_pixel = spp
+    p.depth = depth
+    p.aovs_enabled = aovs
+    p.rng = CounterRNG(seed)
+    p.load_from_json(scene_json)
+    with contextlib.redirect_stdout(io.StringIO()):
+        if backend == "software":
+            p.render_scene()
+        elif backend == "grouped":
+            p.render_scene_in_software()
+        elif backend == "wavefront":
+            p.render_scene_wavefront()
+        elif backend == "bidirectional":
+            p.render_scene_bidirectional()
+        elif backend == "hardware":
+            p.init_hardware(emulate=True)
+            p.render_scene_in_hardware()
+        else:
+            raise Exception(f"Unknown backend {backend}.")
+    return p
+
+
+def reference(scene_json, rows, cols, spp, depth) -> np.ndarray:
+    """
+    Get the converged reference of a scene, rendering and caching it the first time.
+
+    Parameters:
+        scene_json: The scene.
+        rows: The render height.
+        cols: The render width.
+        spp: The reference's rays per pixel.
+        depth: The reference's bounce depth.
+
+    Returns:
+        np.ndarray: The reference image.
+    """
+    settings = json.dumps([scene_json, rows, cols, spp, depth, REFERENCE_SEED])
+    fname = os.path.join(CACHE_DIR, f"reference_{hashlib.sha1(settings.encode()).hexdigest()[:16]}.npy")
+    if os.path.exists(fname):
+        return np.load(fname)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    t0 = time.time()
+    image = render(scene_json, rows, cols, spp, depth, "software", seed=REFERENCE_SEED).final_pixels
+    print(f"  rendered the {spp} rays per pixel reference in {time.time() - t0:.1f} s")
+    np.save(fname, image)
+    return image
+
+
+def curve(scene_json, ref, rows, cols, depth, backend, denoise, budget) -> list:
+    """
+    Render a configuration at 1, 2, 4, ... rays per pixel until a render would run past the budget.
+
+    Parameters:
+        scene_json: The scene.
+        ref: The scene's reference image.
+        rows: The render height.
+        cols: The render width.
+        depth: The bounce depth.
+        backend: One of BACKENDS.
+        denoise: Whether to denoise the renders.
+        budget: The time budget, in seconds.
+
+    Returns:
+        list: A point per render, with its rays per pixel, seconds taken and errors.
+    """
+    points = []
+    for spp in (2 ** i for i in itertools.count()):
+        t0 = time.time()
+        p = render(scene_json, rows, cols, spp, depth, backend, aovs=denoise)
+        image = denoise_render(p) if denoise else p.final_pixels
+        seconds = time.time() - t0
+        points.append({"spp": spp, "seconds": seconds, **errors(image, ref)})
+        # Render times roughly double with the rays per pixel.
+        if seconds * 2 > budget:
+            break
+    return points
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenes", nargs="+")
+    parser.add_argument("--rows", type=int, default=30)
+    parser.add_argument("--cols", type=int, default=40)
+    parser.add_argument("--budgets", type=float, nargs="+", default=[1, 4, 16], help="time budgets, in seconds")
+    parser.add_argument("--depths", type=int, nargs="+", default=[3, 5])
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=["software"])
+    parser.add_argument("--denoise", nargs="+", choices=["off", "on"], default=["off", "on"])
+    parser.add_argument("--reference-spp", type=int, default=256)
+    parser.add_argument("--reference-depth", type=int, default=8)
+    parser.add_argument("--out", default="quality.json")
+    args = parser.parse_args()
+
+    results = {}
+    for scene in args.scenes:
+        print(scene)
+        with open(scene, "r") as scene_file:
+            scene_json = scene_file.read()
+        ref = reference(scene_json, args.rows, args.cols, args.reference_spp, args.reference_depth)
+
+        curves = {}
+        for depth, backend, denoise in itertools.product(args.depths, args.backends, args.denoise):
+            name = f"depth={depth} backend={backend} denoise={denoise}"
+            curves[name] = curve(scene_json, ref, args.rows, args.cols, depth, backend, denoise == "on", max(args.budgets))
+            last = curves[name][-1]
+            print(f"  {name:<44} {last['spp']:>4} spp in {last['seconds']:>6.2f} s: rmse {last['rmse']:.4f}, rel mse {last['rel_mse']:.4f}")
+
+        # The best configuration within each budget, by the error of its last render that fit.
+        best = {}
+        for budget in args.budgets:
+            fits = {
+                name: [point for point in points if point["seconds"] <= budget]
+                for name, points in curves.items()
+            }
+            fits = {name: points[-1] for name, points in fits.items() if points}
+            if fits:
+                name = min(fits, key=lambda name: fits[name]["rmse"])
+                best[str(budget)] = {"config": name, **fits[name]}
+                print(f"  best within {budget:g} s: {name} at {fits[name]['spp']} spp, rmse {fits[name]['rmse']:.4f}")
+        results[os.path.basename(scene)] = {"curves": curves, "best": best}
+
+    settings = {key: getattr(args, key) for key in ("rows", "cols", "budgets", "reference_spp", "reference_depth")}
+    with open(args.out, "w") as out_file:
+        json.dump({"settings": settings, "scenes": results}, out_file, indent=2)
+    print(f"Wrote the curves to {args.out}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Measure how threaded wavefront renders scale against the serial wavefront engine.
+
+Renders each scene with render_scene_wavefront on the calling thread, then on thread pools
+of each size, and reports the render time, rays per second and speedup over the serial
+render, whether the image matches the serial one, and the extra memory the threads use at
+peak (traced with tracemalloc in a separate render, as tracing slows NumPy down).
+
+    python3 bench_threads.py scenes/cornell_box.json
+    python3 bench_threads.py scenes/*.json --rows 120 --cols 160 --threads 1 2 4
+
+Threads share the scene, the pathtracer and the frame. Each sums the light of the wave it
+is tracing in a buffer of just that wave's pixels, so the memory per thread is one wave in
+flight. A process pool pays for a whole interpreter, NumPy and the scene per worker instead. Speedups depend on the
+cores available (os.cpu_count() is printed) and on how much of a render runs in NumPy's
+array kernels, which release the GIL: instanced geometry is traversed one ray at a time
+in Python, and scales poorly.
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import time
+import tracemalloc
+
+import numpy as np
+
+from pathtracer import Pathtracer
+
+
+def render(scene_json, rows, cols, spp, depth, threads, trace_memory=False) -> tuple:
+    """
+    Render a scene quietly with the wavefront engine.
+
+    Parameters:
+        scene_json: The scene.
+        rows: The render height.
+        cols: The render width.
+        spp: The rays per pixel.
+        depth: The bounce depth.
+        threads: The thread pool size, or None to render on the calling thread.
+        trace_memory: Whether to trace the peak memory of the render.
+
+    Returns:
+        Tuple[Pathtracer, float, int]: The pathtracer holding the render, the seconds taken,
+        and the peak traced memory above the memory in use when the render started (0 when
+        not traced).
+    """
+    p = Pathtracer(rows, cols)
+    p.rays_per_pixel = spp
+    p.depth = depth
+    p.load_from_json(scene_json)
+    if trace_memory:
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+    t0 = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        p.render_scene_wavefront(threads=threads)
+    seconds = time.time() - t0
+    peak = 0
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1] - base
+        tracemalloc.stop()
+    return p, seconds, peak
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenes", nargs="+")
+    parser.add_argument("--rows", type=int, default=60)
+    parser.add_argument("--cols", type=int, default=80)
+    parser.add_argument("--spp", type=int, default=8)
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 3, 4])
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} CPUs")
+    for scene in args.scenes:
+        with open(scene, "r") as scene_file:
+            scene_json = scene_file.read()
+        settings = (scene_json, args.rows, args.cols, args.spp, args.depth)
+        serial, serial_seconds, _ = render(*settings, None)
+        _, _, serial_peak = render(*settings, None, trace_memory=True)
+        print(f"{scene}: {args.rows}x{args.cols}, {args.spp} spp, depth {args.depth}")
+        print(
+            f"  {'serial':<10} {serial_seconds:>8.2f} s {serial.iters / serial_seconds:>10.0f} rays/s "
+            f"{'':>8} peak {serial_peak / 2 ** 20:>7.1f} MiB"
+        )
+        for threads in args.threads:
+            p, seconds, _ = render(*settings, threads)
+            _, _, peak = render(*settings, threads, trace_memory=True)
+            same = np.array_equal(p.final_pixels, serial.final_pixels)
+            print(
+                f"  {f'{threads} threads':<10} {seconds:>8.2f} s {p.iters / seconds:>10.0f} rays/s "
+                f"{serial_seconds / seconds:>7.2f}x peak {peak / 2 ** 20:>7.1f} MiB "
+                f"({(peak - serial_peak) / 2 ** 20:+.1f}), {'same image' if same else 'IMAGE DIFFERS'}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Edge-aware denoising of low sample count renders.
+
+Implements the edge-avoiding a-trous wavelet filter (Dammertz et al. 2010),
+guided by the auxiliary buffers the pathtracer records from each pixel's first
+hit. Every pass blurs with a 5x5 B3 spline kernel whose taps are spread 2^i
+pixels apart, and weights each tap down where the color, normal, depth or
+shape id differs from the center pixel, so edges survive while flat regions
+are smoothed. Lighting is filtered separately from albedo, so that the filter
+never has to blur across color changes of the surfaces themselves.
+"""
+
+from typing import Optional
+
+import numpy as np
+
+# 1D B3 spline kernel; the 2D kernel is its outer product.
+B3_KERNEL = np.array([1 / 16, 1 / 4, 3 / 8, 1 / 4, 1 / 16])
+ALBEDO_EPSILON = 1e-3
+
+
+def _shifted(image: np.ndarray, dr, dc) -> np.ndarray:
+    """
+    Get the image shifted so that each pixel holds its neighbour at (dr, dc), clamping at the borders.
+
+    Parameters:
+        image: The image to shift, with rows and columns as its first two axes.
+        dr: The row offset.
+        dc: The column offset.
+
+    Returns:
+        np.ndarray: The shifted image.
+    """
+    rows, cols = image.shape[0], image.shape[1]
+    row_idx = np.clip(np.arange(rows) + dr, 0, rows - 1)
+    col_idx = np.clip(np.arange(cols) + dc, 0, cols - 1)
+    return image[row_idx][:, col_idx]
+
+
+def atrous_denoise(
+    color: np.ndarray,
+    albedo: np.ndarray,
+    normal: np.ndarray,
+    depth: np.ndarray,
+    shape_id: Optional[np.ndarray] = None,
+    iterations=4,
+    sigma_color=1.0,
+    sigma_normal=0.5,
+    sigma_depth=2.0,
+) -> np.ndarray:
+    """
+    Denoise a rendered image with the edge-avoiding a-trous wavelet filter.
+
+    Parameters:
+        color: The noisy image, (rows, cols, 3) in 0-255 range.
+        albedo: The first hit albedo, (rows, cols, 3) in 0-1 range.
+        normal: The first hit unit normals, (rows, cols, 3).
+        depth: The first hit distances from the camera, (rows, cols).
+        shape_id: Optional first hit shape indices, (rows, cols). Pixels on different shapes are never mixed.
+        iterations: The number of filter passes. The filter footprint is 4 * 2^iterations pixels wide.
+        sigma_color: How strongly differences in (lighting) color stop the filter, relative to 255.
+            Halved every pass, as the noise left to remove shrinks. Should shrink with the
+            square root of the sample count, as the noise does.
+        sigma_normal: How strongly differences in normals stop the filter.
+        sigma_depth: How strongly differences in depth stop the filter, per pixel of tap distance.
+
+    Returns:
+        np.ndarray: The denoised image, (rows, cols, 3).
+    """
+    # Filter the lighting rather than the final color, so textures and color edges stay sharp.
+    has_albedo = albedo > ALBEDO_EPSILON
+    lighting = np.where(has_albedo, color / np.where(has_albedo, albedo, 1), color) / 255
+
+    for i in range(iterations):
+        step = 2 ** i
+        color_scale = sigma_color * (2 ** -i)
+        total = np.zeros_like(lighting)
+        weights = np.zeros(lighting.shape[:2])
+        for ki, dr in enumerate(range(-2, 3)):
+            for kj, dc in enumerate(range(-2, 3)):
+                tap_lighting = _shifted(lighting, dr * step, dc * step)
+                color_dist = np.sum((tap_lighting - lighting) ** 2, axis=2)
+                normal_dist = np.sum((_shifted(normal, dr * step, dc * step) - normal) ** 2, axis=2)
+                depth_dist = np.abs(_shifted(depth, dr * step, dc * step) - depth)
+                tap_distance = step * max(abs(dr), abs(dc)) + 1e-6
+                w = B3_KERNEL[ki] * B3_KERNEL[kj] * np.exp(
+                    -color_dist / (color_scale ** 2)
+                    - normal_dist / (sigma_normal ** 2)
+                    - depth_dist / (sigma_depth * tap_distance)
+                )
+                if shape_id is not None:
+                    w = w * (_shifted(shape_id, dr * step, dc * step) == shape_id)
+                total += w[:, :, np.newaxis] * tap_lighting
+                weights += w
+        # The center tap always has full weight, so weights never drop to zero.
+        lighting = total / weights[:, :, np.newaxis]
+
+    return np.where(has_albedo, lighting * np.where(has_albedo, albedo, 1), lighting) * 255
+
+
+def denoise_render(pathtracer, **kwargs) -> np.ndarray:
+    """
+    Denoise a finished render using its auxiliary buffers.
+    The pathtracer must have rendered with aovs_enabled set.
+
+    Parameters:
+        pathtracer: The pathtracer holding the render.
+        kwargs: Filter settings, passed on to atrous_denoise. sigma_color defaults to
+            a value suited to the render's rays per pixel.
+
+    Returns:
+        np.ndarray: The denoised image, in the same format as final_pixels.
+    """
+    kwargs.setdefault("sigma_color", 4.0 / np.sqrt(pathtracer.rays_per_pixel))
+    return atrous_denoise(
+        pathtracer.final_pixels,
+        pathtracer.aov_albedo,
+        pathtracer.aov_normal,
+        pathtracer.aov_depth,
+        pathtracer.aov_shape_id,
+        **kwargs,
+    )
@@ -0,0 +1,529 @@
+"""
+Distributed tile rendering across several render nodes.
+
+A coordinator splits one frame into tiles and farms them out to render nodes
+over TCP. Before rendering it runs a cheap low resolution prepass to estimate
+how many ray casts each tile will cost, then hands tiles out based on that cost
+and on each node's measured throughput. Tiles held by nodes that disconnect or
+overrun their expected time are re-issued to other nodes. The returned
+accumulation sums and sample counts are merged into the pathtracer's
+final_pixels.
+
+Start some render nodes:
+    python3 distributed.py node --port 9101 &
+    python3 distributed.py node --port 9102 &
+
+Render a frame across them:
+    python3 distributed.py render scenes/cornell_box.json --nodes 127.0.0.1:9101,127.0.0.1:9102 --spp 8
+"""
+
+import argparse
+import asyncio
+import json
+import struct
+from time import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from pathtracer import Camera, CounterRNG, Pathtracer, load_scene_from_json
+from render_service import scene_key
+
+DEFAULT_TILE_SIZE = 32
+PREPASS_SCALE = 4
+TILES_IN_FLIGHT = 2
+# A tile is re-issued once it has taken this many times longer than expected.
+OVERRUN_FACTOR = 4.0
+MIN_TILE_TIMEOUT = 2.0
+
+
+async def send_message(writer: asyncio.StreamWriter, header, payload=b"") -> None:
+    """
+    Send a message: a length prefixed JSON header followed by a length prefixed binary payload.
+
+    Parameters:
+        writer: The stream to write to.
+        header: The JSON serializable message header.
+        payload: The raw bytes following the header.
+    """
+    header_bytes = json.dumps(header).encode()
+    writer.write(struct.pack('!II', len(header_bytes), len(payload)) + header_bytes + payload)
+    await writer.drain()
+
+
+async def recv_message(reader: asyncio.StreamReader) -> Tuple[dict, bytes]:
+    """
+    Receive a message sent with send_message.
+
+    Parameters:
+        reader: The stream to read from.
+
+    Returns:
+        Tuple[dict, bytes]: The message header and payload.
+    """
+    header_len, payload_len = struct.unpack('!II', await reader.readexactly(8))
+    header = json.loads(await reader.readexactly(header_len))
+    payload = await reader.readexactly(payload_len) if payload_len else b""
+    return header, payload
+
+
+class Tile():
+    """Represents a rectangular tile of the frame."""
+
+    def __init__(self, tile_id, row_start, row_end, col_start, col_end) -> None:
+        """
+        Initialize a new Tile object.
+
+        Parameters:
+            tile_id: The index of the tile.
+            row_start: The first row of the tile.
+            row_end: One past the last row of the tile.
+            col_start: The first column of the tile.
+            col_end: One past the last column of the tile.
+        """
+        self.tile_id = tile_id
+        self.rect = (row_start, row_end, col_start, col_end)
+        # Estimated number of ray casts needed to render the tile.
+        self.cost = 1.0
+        self.done = False
+        # Nodes currently working on this tile. More than one if it was re-issued.
+        self.holders: List["NodeLink"] = []
+
+    def pixel_count(self) -> int:
+        return (self.rect[1] - self.rect[0]) * (self.rect[3] - self.rect[2])
+
+
+class RenderNode():
+    """Represents a render node serving tiles to a coordinator."""
+
+    def __init__(self) -> None:
+        """
+        Initialize a new RenderNode object.
+        """
+        # Scenes loaded on this node, keyed by the hash of their JSON.
+        self.scenes: Dict[str, list] = {}
+
+    def render_tile(self, key, settings, rect, samples) -> Tuple[np.ndarray, int]:
+        """
+        Render one tile.
+
+        Parameters:
+            key: The key of a scene previously sent to this node.
+            settings: The frame's render settings (rows, cols, depth, seed, camera).
+            rect: The tile's (row_start, row_end, col_start, col_end).
+            samples: The number of rays to fire per pixel.
+
+        Returns:
+            Tuple[np.ndarray, int]: The summed tile colors and the number of ray casts performed.
+        """
+        p = Pathtracer(settings["rows"], settings["cols"])
+        p.depth = settings["depth"]
+        p.rng = CounterRNG(settings["seed"])
+        camera = settings["camera"]
+        p.set_camera(camera["pos"], camera["pitch"], camera["yaw"], camera.get("fov"))
+        p.scene = self.scenes[key]
+        accum = p.render_region(rect[0], rect[1], rect[2], rect[3], samples)
+        return accum, p.iters
+
+    async def handle_coordinator(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Serve one coordinator connection, rendering the tiles it sends one at a time.
+
+        Parameters:
+            reader: The connection's stream reader.
+            writer: The connection's stream writer.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                header, payload = await recv_message(reader)
+                if header["op"] == "scene":
+                    self.scenes[header["key"]] = load_scene_from_json(payload.decode())
+                elif header["op"] == "tile":
+                    t0 = time()
+                    accum, rays = await loop.run_in_executor(
+                        None, self.render_tile, header["key"], header["settings"], header["rect"], header["samples"]
+                    )
+                    await send_message(writer, {
+                        "op": "result",
+                        "tile_id": header["tile_id"],
+                        "samples": header["samples"],
+                        "rays": rays,
+                        "seconds": time() - t0,
+                    }, accum.astype(np.float64).tobytes())
+        except (asyncio.IncompleteReadError, ConnectionResetError, BrokenPipeError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port) -> asyncio.AbstractServer:
+        """
+        Start accepting coordinator connections.
+
+        Parameters:
+            host: The host to listen on.
+            port: The port to listen on.
+
+        Returns:
+            asyncio.AbstractServer: The listening server.
+        """
+        return await asyncio.start_server(self.handle_coordinator, host, port)
+
+
+class NodeLink():
+    """Represents the coordinator's connection to one render node."""
+
+    def __init__(self, address, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Initialize a new NodeLink object.
+
+        Parameters:
+            address: The node's "host:port" address.
+            reader: The connection's stream reader.
+            writer: The connection's stream writer.
+        """
+        self.address = address
+        self.reader = reader
+        self.writer = writer
+        # Measured ray casts per second, None until the first tile comes back.
+        self.throughput: Optional[float] = None
+        self.in_flight: Dict[int, float] = {}
+        self.alive = True
+        self.tiles_done = 0
+
+    def record(self, rays, seconds) -> None:
+        """
+        Update the node's throughput estimate with a finished tile.
+
+        Parameters:
+            rays: The number of ray casts the tile took.
+            seconds: How long the node spent on the tile.
+        """
+        measured = rays / max(seconds, 1e-6)
+        if self.throughput is None:
+            self.throughput = measured
+        else:
+            self.throughput = 0.7 * self.throughput + 0.3 * measured
+
+
+class Coordinator():
+    """Represents the coordinator of a distributed render."""
+
+    def __init__(self, pathtracer: Pathtracer, scene_json, tile_size=DEFAULT_TILE_SIZE) -> None:
+        """
+        Initialize a new Coordinator object.
+
+        Parameters:
+            pathtracer: The pathtracer describing the frame (resolution, camera, depth, rays per pixel).
+                Its final_pixels receive the merged result.
+            scene_json: The JSON blob of the scene to render.
+            tile_size: The width and height of the tiles.
+        """
+        self.pathtracer = pathtracer
+        self.scene_json = scene_json
+        self.key = scene_key(scene_json)
+        self.tile_size = tile_size
+        self.nodes: List[NodeLink] = []
+        self.tiles: List[Tile] = []
+        self.accum = np.zeros((pathtracer.rows, pathtracer.cols, 3))
+        self.sample_counts = np.zeros((pathtracer.rows, pathtracer.cols), dtype=np.int32)
+        self.reissued = 0
+        self.work_changed: Optional[asyncio.Event] = None
+
+    def settings(self):
+        camera = self.pathtracer.camera
+        return {
+            "rows": self.pathtracer.rows,
+            "cols": self.pathtracer.cols,
+            "depth": self.pathtracer.depth,
+            "seed": self.pathtracer.rng.seed,
+            "camera": {
+                "pos": [float(x) for x in camera.pos],
+                "pitch": camera.pitch,
+                "yaw": camera.yaw,
+                "fov": self.pathtracer.fov,
+            },
+        }
+
+    def make_tiles(self) -> None:
+        """
+        Split the frame into tiles.
+        """
+        rows, cols, size = self.pathtracer.rows, self.pathtracer.cols, self.tile_size
+        self.tiles = []
+        for r in range(0, rows, size):
+            for c in range(0, cols, size):
+                self.tiles.append(Tile(len(self.tiles), r, min(r + size, rows), c, min(c + size, cols)))
+
+    def estimate_costs(self, scale=PREPASS_SCALE) -> float:
+        """
+        Estimate the cost of every tile from a one ray per pixel prepass at reduced resolution.
+        The cost of a tile is the number of ray casts its prepass pixels took, scaled up to
+        the full resolution and sample count.
+
+        Parameters:
+            scale: The factor the resolution is reduced by for the prepass.
+
+        Returns:
+            float: The time the prepass took, in seconds.
+        """
+        t0 = time()
+        full = self.pathtracer
+        rows, cols = max(1, full.rows // scale), max(1, full.cols // scale)
+        p = Pathtracer(rows, cols)
+        p.depth = full.depth
+        p.rng = full.rng
+        p.fov = full.fov
+        p.camera = Camera(full.camera.pos, full.camera.pitch, full.camera.yaw, rows, cols, full.fov)
+        p.scene = full.scene
+
+        casts = np.zeros((rows, cols))
+        for r in range(rows):
+            for c in range(cols):
+                before = p.iters
+                p.ray_color(p.camera.get_random_ray(r, c))
+                casts[r][c] = p.iters - before
+
+        row_scale, col_scale = full.rows / rows, full.cols / cols
+        for tile in self.tiles:
+            r0, r1, c0, c1 = tile.rect
+            lr0, lr1 = int(r0 / row_scale), max(int(r0 / row_scale) + 1, int(r1 / row_scale))
+            lc0, lc1 = int(c0 / col_scale), max(int(c0 / col_scale) + 1, int(c1 / col_scale))
+            mean_casts = casts[lr0:lr1, lc0:lc1].mean()
+            tile.cost = mean_casts * tile.pixel_count() * full.rays_per_pixel
+        return time() - t0
+
+    async def connect(self, addresses) -> None:
+        """
+        Connect to the render nodes and send them the scene.
+
+        Parameters:
+            addresses: The nodes' "host:port" addresses.
+        """
+        for address in addresses:
+            host, port = address.rsplit(":", 1)
+            try:
+                reader, writer = await asyncio.open_connection(host, int(port))
+            except OSError as e:
+                print(f"Could not connect to render node {address}: {e}")
+                continue
+            node = NodeLink(address, reader, writer)
+            await send_message(writer, {"op": "scene", "key": self.key}, self.scene_json.encode())
+            self.nodes.append(node)
+        if not self.nodes:
+            raise ConnectionError("No render nodes available.")
+
+    def pick_tile(self, node: NodeLink, now) -> Optional[Tile]:
+        """
+        Choose the next tile for a node with a free slot.
+
+        Unstarted tiles are handed out largest first, but a node only takes a tile it is
+        expected to finish before the cluster as a whole finishes the remaining work, so
+        slow nodes end up with the cheap tiles. Once no unstarted tiles remain, idle nodes
+        duplicate tiles whose holders have overrun their expected time.
+
+        Parameters:
+            node: The node to assign a tile to.
+            now: The current time.
+
+        Returns:
+            Optional[Tile]: The tile to assign, if any.
+        """
+        pending = sorted((t for t in self.tiles if not t.done and not t.holders), key=lambda t: -t.cost)
+        if pending:
+            known = [n.throughput for n in self.nodes if n.alive and n.throughput]
+            if node.throughput is None or not known:
+                return pending[0]
+            horizon = sum(t.cost for t in pending) / sum(known)
+            for tile in pending:
+                if tile.cost / node.throughput <= horizon:
+                    return tile
+            return pending[-1]
+
+        for tile in self.tiles:
+            if tile.done or node in tile.holders:
+                continue
+            if all(now > holder.in_flight.get(tile.tile_id, now) for holder in tile.holders):
+                self.reissued += 1
+                return tile
+        return None
+
+    def expected_deadline(self, node: NodeLink, tile: Tile, now) -> float:
+        """
+        Get the time after which a tile assigned now to the given node counts as overrun.
+        """
+        fastest = max((n.throughput for n in self.nodes if n.throughput), default=None)
+        throughput = node.throughput or fastest
+        if throughput is None:
+            return now + MIN_TILE_TIMEOUT * 10
+        return now + max(MIN_TILE_TIMEOUT, OVERRUN_FACTOR * tile.cost / throughput)
+
+    async def feed(self, node: NodeLink) -> None:
+        """
+        Keep a node supplied with tiles until every tile is done or the node dies.
+
+        Parameters:
+            node: The node to feed.
+        """
+        settings = self.settings()
+        while node.alive and not all(t.done for t in self.tiles):
+            if len(node.in_flight) >= TILES_IN_FLIGHT:
+                await self.wait_for_change()
+                continue
+            now = time()
+            tile = self.pick_tile(node, now)
+            if tile is None:
+                await self.wait_for_change()
+                continue
+            tile.holders.append(node)
+            node.in_flight[tile.tile_id] = self.expected_deadline(node, tile, now)
+            try:
+                await send_message(node.writer, {
+                    "op": "tile",
+                    "tile_id": tile.tile_id,
+                    "key": self.key,
+                    "settings": settings,
+                    "rect": tile.rect,
+                    "samples": self.pathtracer.rays_per_pixel,
+                }, b"")
+            except (ConnectionResetError, BrokenPipeError):
+                self.drop(node)
+
+    async def wait_for_change(self) -> None:
+        """
+        Wait for a result, a dead node, or a tile to become overdue.
+        """
+        self.work_changed.clear()
+        try:
+            await asyncio.wait_for(self.work_changed.wait(), timeout=0.25)
+        except asyncio.TimeoutError:
+            pass
+
+    async def receive(self, node: NodeLink) -> None:
+        """
+        Merge results coming back from a node until it disconnects or the frame is done.
+
+        Parameters:
+            node: The node to receive from.
+        """
+        try:
+            while node.alive:
+                header, payload = await recv_message(node.reader)
+                tile = self.tiles[header["tile_id"]]
+                node.in_flight.pop(tile.tile_id, None)
+                if node in tile.holders:
+                    tile.holders.remove(node)
+                node.record(header["rays"], header["seconds"])
+                if not tile.done:
+                    r0, r1, c0, c1 = tile.rect
+                    accum = np.frombuffer(payload, dtype=np.float64).reshape((r1 - r0, c1 - c0, 3))
+                    self.accum[r0:r1, c0:c1] += accum
+                    self.sample_counts[r0:r1, c0:c1] += header["samples"]
+                    tile.done = True
+                    node.tiles_done += 1
+                self.work_changed.set()
+                if all(t.done for t in self.tiles):
+                    return
+        except (asyncio.IncompleteReadError, ConnectionResetError, BrokenPipeError):
+            self.drop(node)
+
+    def drop(self, node: NodeLink) -> None:
+        """
+        Mark a node as dead and release the tiles it held for re-issue.
+
+        Parameters:
+            node: The node that failed.
+        """
+        if not node.alive:
+            return
+        print(f"\nRender node {node.address} failed, re-issuing {len(node.in_flight)} tiles.")
+        node.alive = False
+        for tile_id in node.in_flight:
+            tile = self.tiles[tile_id]
+            if node in tile.holders:
+                tile.holders.remove(node)
+        node.in_flight.clear()
+        self.work_changed.set()
+
+    async def render(self, addresses) -> None:
+        """
+        Render the frame across the given render nodes.
+        Results in the pathtracer's final_pixels being filled with the merged image.
+
+        Parameters:
+            addresses: The nodes' "host:port" addresses.
+        """
+        self.work_changed = asyncio.Event()
+        self.make_tiles()
+        prepass_seconds = self.estimate_costs()
+        print(f"Prepass estimated {sum(t.cost for t in self.tiles):.0f} ray casts over {len(self.tiles)} tiles in {prepass_seconds:.2f} seconds.")
+
+        await self.connect(addresses)
+        t0 = time()
+        tasks = []
+        for node in self.nodes:
+            tasks.append(asyncio.create_task(self.receive(node)))
+            tasks.append(asyncio.create_task(self.feed(node)))
+
+        while not all(t.done for t in self.tiles):
+            if not any(n.alive for n in self.nodes):
+                raise ConnectionError("All render nodes failed.")
+            await self.wait_for_change()
+            done = sum(t.done for t in self.tiles)
+            print(f"\r{done} / {len(self.tiles)} tiles done.", end='')
+
+        for task in tasks:
+            task.cancel()
+        for node in self.nodes:
+            node.writer.close()
+
+        counts = np.maximum(self.sample_counts, 1)[:, :, np.newaxis]
+        self.pathtracer.final_pixels = self.accum / counts
+        print()
+        print(f"Done in {time() - t0:.2f} seconds, {self.reissued} tiles re-issued.")
+        for node in self.nodes:
+            throughput = f"{node.throughput:.0f} rays per second" if node.throughput else "no results"
+            print(f"  {node.address}: {node.tiles_done} tiles, {throughput}{'' if node.alive else ' (failed)'}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    node = commands.add_parser("node", help="Run a render node.")
+    node.add_argument("--host", default="127.0.0.1")
+    node.add_argument("--port", type=int, required=True)
+
+    render = commands.add_parser("render", help="Render a frame across render nodes.")
+    render.add_argument("scene")
+    render.add_argument("--nodes", required=True, help="Comma separated host:port list.")
+    render.add_argument("--rows", type=int, default=360)
+    render.add_argument("--cols", type=int, default=480)
+    render.add_argument("--spp", type=int, default=4)
+    render.add_argument("--depth", type=int, default=4)
+    render.add_argument("--tile-size", type=int, default=DEFAULT_TILE_SIZE)
+    render.add_argument("--out", default="test_render_result.png")
+
+    args = parser.parse_args()
+    if args.command == "node":
+        async def serve():
+            server = await RenderNode().serve(args.host, args.port)
+            print(f"Render node listening on {args.host}:{args.port}.")
+            async with server:
+                await server.serve_forever()
+        asyncio.run(serve())
+        return
+
+    p = Pathtracer(args.rows, args.cols)
+    p.rays_per_pixel = args.spp
+    p.depth = args.depth
+    with open(args.scene, 'r') as scene_file:
+        scene_json = scene_file.read()
+    p.load_from_json(scene_json)
+    coordinator = Coordinator(p, scene_json, args.tile_size)
+    asyncio.run(coordinator.render(args.nodes.split(",")))
+    p.save_rendered_scene(args.out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+"""
+Local stand-in for the pynq raycast overlay.
+
+Provides the parts of the pynq API the pathtracer uses (Overlay, allocate, the
+raycast IP, the AXI DMA channels and the scene BRAM controller) and emulates the
+hls-v4 raycast kernel in NumPy, so the hardware-integrated code paths can be run
+and tested on any machine:
+
+    p.init_hardware(emulate=True)
+
+Like the hls-v4 kernel, the emulator reads up to MAX_SCENE_OBJECTS shapes from
+BRAM, only intersects planes and triangles, and returns hits one indexed with 0
+meaning no hit. Ray and shape coordinates are quantized to ap_fixed<16, 8>
+(truncating and saturating) on the way in, but the arithmetic itself is done in
+floating point, so results can differ slightly from the real IP.
+
+Overlays whose bitfile name contains "compact" emulate the kernel built with
+COMPACT_WIRE, which streams rays and rayhits as raw ap_fixed<16, 8> values
+(RAY_COMPACT_DTYPE and RAYHIT_COMPACT_DTYPE) instead of floats, rays still padded
+to 16 bytes.
+
+Overlays whose bitfile name ends in _x<N> (raycast_x4.bit) emulate N raycast IPs,
+named like Vivado names copies of an IP: raycast_0, axi_dma_0 and axi_bram_ctrl_0
+up to raycast_<N-1>. Instance i keeps reporting its receive channel busy for i
+polls after each transfer, so transfers on several instances finish out of order.
+"""
+
+import os
+import re
+
+import numpy as np
+
+MAX_SCENE_OBJECTS = 16
+SHAPE_STRIDE = 64
+BATCH_SIZE = 16
+SHAPETYPE_PLANE = 0
+SHAPETYPE_TRI = 2
+
+# ap_fixed<16, 8>: 8 fractional bits, representable range [-128, 128).
+FIXED_FRAC_BITS = 8
+FIXED_MIN = -128.0
+FIXED_MAX = 128.0 - 2.0 ** -FIXED_FRAC_BITS
+
+RAY_DTYPE = np.dtype([('origin', '<f4', 3), ('direction', '<f4', 3), ('pad', '<f4', 2)])
+RAYHIT_DTYPE = np.dtype([('loc', '<f4', 3), ('scene_index', '<i4')])
+SHAPE_DTYPE = np.dtype([('coords', '<f4', (3, 3)), ('type', 'u1')])
+RAY_COMPACT_DTYPE = np.dtype([('origin', '<i2', 3), ('direction', '<i2', 3), ('pad', '<i2', 2)])
+RAYHIT_COMPACT_DTYPE = np.dtype([('loc', '<i2', 3), ('scene_index', '<u2')])
+
+
+def to_fixed(values) -> np.ndarray:
+    """
+    Quantize values the way the IP's fp_t (ap_fixed<16, 8, AP_TRN, AP_SAT>) does.
+
+    Parameters:
+        values: The values to quantize.
+
+    Returns:
+        np.ndarray: The quantized values, as float64.
+    """
+    scale = 2.0 ** FIXED_FRAC_BITS
+    return np.clip(np.floor(np.asarray(values, dtype=np.float64) * scale) / scale, FIXED_MIN, FIXED_MAX)
+
+
+class EmulatedBuffer(np.ndarray):
+    """Represents a contiguous buffer returned by allocate."""
+
+    def freebuffer(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+def allocate(shape, dtype=np.uint32, **kwargs) -> EmulatedBuffer:
+    """
+    Allocate a zeroed buffer, like pynq.allocate.
+
+    Parameters:
+        shape: The buffer shape.
+        dtype: The buffer element type.
+
+    Returns:
+        EmulatedBuffer: The buffer.
+    """
+    return np.zeros(shape, dtype=dtype).view(EmulatedBuffer)
+
+
+class EmulatedBram():
+    """Represents the scene BRAM behind an AXI BRAM controller."""
+
+    def __init__(self, size=MAX_SCENE_OBJECTS * SHAPE_STRIDE) -> None:
+        self.memory = bytearray(size)
+        self.bytes_written = 0
+
+    def write(self, offset, data) -> None:
+        """
+        Write bytes (or a 32 bit word) at the given byte offset.
+        """
+        if isinstance(data, int):
+            data = int(data).to_bytes(4, 'little')
+        if offset < 0 or offset + len(data) > len(self.memory):
+            raise IndexError(f"BRAM write of {len(data)} bytes at {offset} is out of range.")
+        self.memory[offset:offset + len(data)] = data
+        self.bytes_written += len(data)
+
+    def read(self, offset, length=4) -> int:
+        return int.from_bytes(self.memory[offset:offset + length], 'little')
+
+    def shapes(self) -> np.ndarray:
+        """
+        Get the shapes held in BRAM, as a SHAPE_DTYPE array.
+        """
+        raw = np.frombuffer(bytes(self.memory), dtype=np.uint8).reshape(MAX_SCENE_OBJECTS, SHAPE_STRIDE)
+        return raw[:, :SHAPE_DTYPE.itemsize].copy().view(SHAPE_DTYPE).reshape(MAX_SCENE_OBJECTS)
+
+
+class EmulatedRaycastIP():
+    """Represents the raycast IP's AXI-Lite control interface."""
+
+    def __init__(self) -> None:
+        self.starts = 0
+
+    def write(self, offset, value) -> None:
+        if offset == 0 and value & 0x1:
+            self.starts += 1
+
+    def read(self, offset) -> int:
+        # Report idle and done.
+        return 0x6
+
+
+class EmulatedDmaChannel():
+    """Represents one direction of the AXI DMA."""
+
+    def __init__(self, dma, is_send) -> None:
+        self.dma = dma
+        self.is_send = is_send
+        self.transfers = 0
+        self.bytes_transferred = 0
+        self.busy_polls = 0
+
+    def transfer(self, buffer, start=0, nbytes=0) -> None:
+        """
+        Start a transfer. The send channel hands rays to the kernel, the receive channel
+        runs the kernel and fills the buffer with rayhits.
+
+        Parameters:
+            buffer: The buffer to transfer from or into.
+            start: The byte offset into the buffer.
+            nbytes: The number of bytes to transfer, or 0 for the rest of the buffer.
+        """
+        data = buffer.view(np.uint8).reshape(-1)[start:]
+        if nbytes:
+            data = data[:nbytes]
+        self.transfers += 1
+        self.bytes_transferred += data.nbytes
+        if self.is_send and self.dma.compact_wire:
+            packed = np.frombuffer(data.tobytes(), dtype=RAY_COMPACT_DTYPE)
+            rays = np.zeros(len(packed), dtype=RAY_DTYPE)
+            rays['origin'] = packed['origin'] / 2.0 ** FIXED_FRAC_BITS
+            rays['direction'] = packed['direction'] / 2.0 ** FIXED_FRAC_BITS
+            self.dma.pending_rays = rays
+        elif self.is_send:
+            self.dma.pending_rays = np.frombuffer(data.tobytes(), dtype=RAY_DTYPE)
+        else:
+            hits = self.dma.raycast(self.dma.pending_rays)
+            if self.dma.compact_wire:
+                packed = np.zeros(len(hits), dtype=RAYHIT_COMPACT_DTYPE)
+                packed['loc'] = np.floor(hits['loc'].astype(np.float64) * 2.0 ** FIXED_FRAC_BITS)
+                packed['scene_index'] = hits['scene_index']
+                hits = packed
+            hit_bytes = np.frombuffer(hits.tobytes(), dtype=np.uint8)[:data.size]
+            data[:len(hit_bytes)] = hit_bytes
+            self.busy_polls = self.dma.latency
+
+    def wait(self) -> None:
+        self.busy_polls = 0
+
+    @property
+    def idle(self) -> bool:
+        if self.busy_polls > 0:
+            self.busy_polls -= 1
+            return False
+        return True
+
+
+class EmulatedDma():
+    """Represents the AXI DMA feeding the raycast IP, and the kernel behind it."""
+
+    def __init__(self, bram: EmulatedBram, compact_wire=False, latency=0) -> None:
+        self.bram = bram
+        self.compact_wire = compact_wire
+        self.latency = latency
+        self.pending_rays = np.zeros(0, dtype=RAY_DTYPE)
+        self.sendchannel = EmulatedDmaChannel(self, True)
+        self.recvchannel = EmulatedDmaChannel(self, False)
+
+    def raycast(self, rays: np.ndarray) -> np.ndarray:
+        """
+        Emulate the hls-v4 raycast kernel on a stream of rays.
+
+        Parameters:
+            rays: The rays, as a RAY_DTYPE array. Only whole batches of BATCH_SIZE produce output.
+
+        Returns:
+            np.ndarray: The rayhits, as a RAYHIT_DTYPE array.
+        """
+        count = (len(rays) // BATCH_SIZE) * BATCH_SIZE
+        origin = to_fixed(rays['origin'][:count])
+        direction = to_fixed(rays['direction'][:count])
+        best_dist = np.full(count, FIXED_MAX)
+        best_index = np.zeros(count, dtype=np.int32)
+        best_pt = np.zeros((count, 3))
+
+        for j, shape in enumerate(self.bram.shapes()):
+            coords = to_fixed(shape['coords'])
+            if shape['type'] == SHAPETYPE_PLANE:
+                dir_dot_norm = direction @ coords[1]
+                ok = np.abs(dir_dot_norm) >= 0.0001
+                t = np.where(ok, ((coords[0] - origin) @ coords[1]) / np.where(ok, dir_dot_norm, 1), -1)
+                ok &= t >= 0
+            elif shape['type'] == SHAPETYPE_TRI:
+                edge1 = coords[1] - coords[0]
+                edge2 = coords[2] - coords[0]
+                ray_cross_edge2 = np.cross(direction, edge2)
+                det = ray_cross_edge2 @ edge1
+                ok = np.abs(det) >= 0.0001
+                inv_det = 1.0 / np.where(ok, det, 1)
+                s = origin - coords[0]
+                u = inv_det * np.sum(s * ray_cross_edge2, axis=1)
+                s_cross_edge1 = np.cross(s, edge1)
+                v = inv_det * np.sum(direction * s_cross_edge1, axis=1)
+                t = inv_det * (s_cross_edge1 @ edge2)
+                ok &= (u >= 0) & (u <= 1) & (v >= 0) & (u + v <= 1) & (t >= 0.00001)
+            else:
+                continue
+            traversed = direction * t[:, np.newaxis]
+            dist = np.minimum(np.sum(traversed * traversed, axis=1), FIXED_MAX)
+            ok &= (dist <= best_dist) & (dist >= 0.00001)
+            best_dist = np.where(ok, dist, best_dist)
+            best_index = np.where(ok, j + 1, best_index)
+            best_pt = np.where(ok[:, np.newaxis], to_fixed(origin + traversed), best_pt)
+
+        hits = np.zeros(count, dtype=RAYHIT_DTYPE)
+        hits['loc'] = best_pt
+        hits['scene_index'] = best_index
+        return hits
+
+
+class Overlay():
+    """Represents the raycast overlay, like pynq.Overlay."""
+
+    def __init__(self, bitfile=None, **kwargs) -> None:
+        """
+        Initialize a new emulated Overlay object.
+
+        Parameters:
+            bitfile: The bitstream path. Only its name is used, to pick the wire format and
+                the number of raycast IPs.
+        """
+        self.bitfile = bitfile
+        name = os.path.basename(bitfile) if bitfile is not None else ""
+        compact_wire = "compact" in name
+        match = re.search(r'_x(\d+)\.', name)
+        self.instances = int(match.group(1)) if match else 1
+        if self.instances == 1:
+            self.raycast_0 = EmulatedRaycastIP()
+            self.axi_bram_ctrl_0 = EmulatedBram()
+            self.axi_dma = EmulatedDma(self.axi_bram_ctrl_0, compact_wire)
+            return
+        for i in range(self.instances):
+            bram = EmulatedBram()
+            setattr(self, f'raycast_{i}', EmulatedRaycastIP())
+            setattr(self, f'axi_bram_ctrl_{i}', bram)
+            setattr(self, f'axi_dma_{i}', EmulatedDma(bram, compact_wire, latency=i))
@@ -1,18 +1,118 @@
 from enum import IntEnum
+import hashlib
 import json
 import math
 import matplotlib.pyplot as plt
 import numpy as np
+import os
 import random
+import re
 import struct
+import threading
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from time import time
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 NUM_PLL = 16
 RAY_FIELDS = 8
 RAYHIT_FIELDS = 4
 FIELD_WIDTH = 4
+MAX_SCENE_OBJECTS = 16
+SHAPE_STRIDE = 64
+START_CONTROL_REG = 0x0
+SHAPETYPE_NOTHING = 3
+RAYCAST_BITFILE = '/home/xilinx/pynq/overlays/raycast/raycast.bit'
+# Built from hls-v4 with COMPACT_WIRE defined: rays and rayhits cross the DMA as the
+# kernel's ap_fixed<16, 8> values instead of floats.
+RAYCAST_COMPACT_BITFILE = '/home/xilinx/pynq/overlays/raycast_compact/raycast_compact.bit'
+FIXED_FRAC_BITS = 8
+RAY_COMPACT_DTYPE = np.dtype([('origin', '<i2', 3), ('direction', '<i2', 3), ('pad', '<i2', 2)])
+RAYHIT_COMPACT_DTYPE = np.dtype([('loc', '<i2', 3), ('scene_index', '<u2')])
+# Scenes split into several chunks stream this many batches of NUM_PLL rays through
+# each chunk per BRAM upload, to spread the cost of the uploads.
+CHUNK_GROUP_BATCHES = 64
+# Co-scheduled renders split groups of this many batches of NUM_PLL rays between the FPGA and the CPU.
+COSCHEDULE_GROUP_BATCHES = 8
+# Overlays with several raycast IPs split each group into this many transfers per IP, so
+# queue depth dispatch can hand the IPs that finish first more of the group.
+UNIT_QUEUE_DEPTH = 2
+DISPATCH_POLICIES = ('round_robin', 'queue_depth')
+# Width and height, in pixels, of the tiles of camera rays culled together in packet mode.
+PACKET_TILE_SIZE = 8
+# Primary hit cached renders aim each pixel's camera rays through a fixed grid of this
+# many by this many sub-pixel positions, cycling through them sample by sample.
+PRIMARY_STRATA = 2
+# The most primitives in a BVH leaf.
+BVH_LEAF_SIZE = 4
+# Mesh files are read this many bytes (OBJ) or elements (PLY) at a time.
+MESH_CHUNK_BYTES = 1 << 22
+MESH_CHUNK_ELEMENTS = 1 << 16
+PLY_TYPES = {
+    'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+    'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2',
+    'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+    'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8',
+}
+# The most paths the wavefront integrator keeps live at once, and the most ray-shape pairs
+# its whole-array intersection tests at once.
+WAVEFRONT_SIZE = 65536
+WAVEFRONT_EXTEND_ELEMENTS = 1 << 20
+# Threaded wavefront renders split the pixels into this many waves per thread, so threads
+# whose paths die early pick up more waves, but no smaller than this many pixels, so that
+# most of a wave's time is spent in NumPy kernels, outside the GIL. Renders too small to give
+# every thread a wave that size still get a wave per thread.
+THREAD_WAVES_PER_THREAD = 4
+THREAD_MIN_WAVE_SIZE = 8192
+# The bidirectional integrator keeps every vertex of a wave's camera and light subpaths until
+# they are connected, so its waves are smaller.
+BIDIRECTIONAL_WAVE_SIZE = 4096
+# Render sessions keep the camera ray directions of this many samples, which re-renders go
+# through first; with the primary hit cache on, the directions repeat every PRIMARY_STRATA²
+# samples and all of them are kept.
+SESSION_CAMERA_SAMPLES = 4
+# The scene optimizer treats coordinates closer than this as the same, and primitives with
+# less area as degenerate. Shapes are sorted along a Morton curve of this many bits per axis.
+OPTIMIZE_TOLERANCE = 1e-9
+MORTON_BITS = 10
+
+# Hits closer than this to the ray origin are the surface the ray is leaving.
+MIN_HIT_DIST = 0.0001
+# The ways occlusion queries can be answered: a ray at a time, whole arrays of rays at a
+# time, or on the raycast IPs.
+OCCLUSION_BACKENDS = ('software', 'wavefront', 'hardware')
+# Fixed point rays hit the surface a query ends on a little short of it, so hardware hits
+# within this distance of a query's max distance are checked again on the CPU.
+HW_OCCLUSION_SLACK = 32 * 2.0 ** -FIXED_FRAC_BITS
+
+# Indices of the uniforms in each (pixel, sample, bounce) block drawn from a CounterRNG.
+DIM_PIXEL_X = 0
+DIM_PIXEL_Y = 1
+DIM_DIRECTION_U = 2
+DIM_DIRECTION_V = 3
+# Blocks of uniforms the bidirectional integrator's light subpaths draw from, apart from the
+# camera paths' block 0: the directions they leave each vertex in (bounce 0 is the emission),
+# and, at bounce 0, the light they start from and the point on it.
+BLOCK_LIGHT_PATH = 1
+BLOCK_LIGHT_POINT = 2
+DIM_LIGHT_PICK = 0
+DIM_LIGHT_POINT_U = 1
+DIM_LIGHT_POINT_V = 2
+
+PHILOX_ROUNDS = 10
+PHILOX_M0 = 0xD2E7470EE14C6C93
+PHILOX_M1 = 0xCA5A826395121157
+PHILOX_W0 = 0x9E3779B97F4A7C15
+PHILOX_W1 = 0xBB67AE8584CAA73B
+# Batches up to this size are generated by NumPy's own Philox, one counter at a time,
+# which is faster than the vectorized rounds for a handful of counters.
+PHILOX_SCALAR_BATCH = 64
+
+DEFAULT_CHECKPOINT_INTERVAL = 60
+CHECKPOINT_VERSION = 1
+# Bump when a change alters what renders look like, so stale cached renders are not reused.
+RENDER_CACHE_VERSION = 1
+DEFAULT_RENDER_CACHE_BYTES = 1 << 30
 
 
 def rot_vec_z(vec, c, s) -> np.ndarray:
@@ -84,33 +184,166 @@ def random_vector() -> np.ndarray:
     Returns:
         np.ndarray: A random 3D vector on the unit sphere.
     """
-    u = random.random()
-    v = random.random()
+    return random_vector_from(random.random(), random.random())
+
+def random_hemisphere_vector(normal) -> np.ndarray:
+    """
+    Generate a random 3D vector in the hemisphere defined by the given normal.
+
+    Parameters:
+        normal: The normal defining the hemisphere.
+
+    Returns:
+        np.ndarray: A random 3D vector in the hemisphere defined by the given normal.
+    """
+    return hemisphere_vector_from(random.random(), random.random(), normal)
+
+def random_vector_from(u, v) -> np.ndarray:
+    """
+    Map two uniform numbers to a 3D vector on the unit sphere.
+
+    Parameters:
+        u: A uniform number in [0, 1), selecting the azimuth.
+        v: A uniform number in [0, 1), selecting the inclination.
+
+    Returns:
+        np.ndarray: A 3D vector on the unit sphere.
+    """
     theta = u * 2 * math.pi
     phi = math.acos(2 * v - 1)
     sin_phi = math.sin(phi)
     return np.array([sin_phi * math.cos(theta), sin_phi * math.sin(theta), math.cos(phi)])
 
-def random_hemisphere_vector(normal) -> np.ndarray:
+def hemisphere_vector_from(u, v, normal) -> np.ndarray:
     """
-    Generate a random 3D vector in the hemisphere defined by the given normal.
+    Map two uniform numbers to a 3D vector in the hemisphere defined by the given normal.
 
     Parameters:
+        u: A uniform number in [0, 1), selecting the azimuth.
+        v: A uniform number in [0, 1), selecting the inclination.
         normal: The normal defining the hemisphere.
 
     Returns:
-        np.ndarray: A random 3D vector in the hemisphere defined by the given normal.
+        np.ndarray: A 3D vector in the hemisphere defined by the given normal.
+    """
+    vec = random_vector_from(u, v)
+    if np.dot(vec, normal) < 0:
+        # Vector not in the same hemisphere as normal - flip it.
+        return -1 * vec
+    return vec
+
+def _mulhilo64(a, m):
+    """
+    Multiply 64 bit words, returning the high and low words of the 128 bit products.
+
+    Parameters:
+        a: Array of uint64 words.
+        m: The 64 bit multiplier, as an int.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The high and low words of the products.
     """
-    v = random_vector()
-    if np.dot(v, normal) < 0:
-        # Random vector not in the same hemisphere as normal - flip it.
-        return -1 * v
-    return v
+    low_mask = np.uint64(0xFFFFFFFF)
+    shift = np.uint64(32)
+    m_lo = np.uint64(m & 0xFFFFFFFF)
+    m_hi = np.uint64(m >> 32)
+    a_lo = a & low_mask
+    a_hi = a >> shift
+    lo_lo = a_lo * m_lo
+    lo_hi = a_lo * m_hi
+    hi_lo = a_hi * m_lo
+    mid = (lo_lo >> shift) + (lo_hi & low_mask) + (hi_lo & low_mask)
+    hi = a_hi * m_hi + (lo_hi >> shift) + (hi_lo >> shift) + (mid >> shift)
+    return hi, a * np.uint64(m)
+
+class CounterRNG():
+    """
+    Represents a counter-based random number generator.
+
+    Every uniform is a pure function of (seed, pixel, sample, bounce, block), so
+    renders come out the same no matter how the work is split up or in which order
+    it runs. Each counter yields a block of four uniforms, indexed by the DIM_*
+    constants. The generator is NumPy's Philox4x64-10 bit generator: the block for
+    a counter holds the bits of
+    np.random.Philox(key=[seed, 0], counter=[pixel, sample, bounce, block]).random_raw(4).
+    Small batches are drawn from NumPy's Philox directly, large batches run the
+    Philox rounds vectorized over all counters at once.
+    """
+
+    def __init__(self, seed=0) -> None:
+        """
+        Initialize a new CounterRNG object.
+
+        Parameters:
+            seed: The seed, keying the generator.
+        """
+        self.seed = seed
+        self.key = np.array([seed, 0], dtype=np.uint64)
+        self.bit_generator = np.random.Philox(key=self.key)
+        mask = (1 << 64) - 1
+        self.round_keys = [
+            (np.uint64((seed + i * PHILOX_W0) & mask), np.uint64((i * PHILOX_W1) & mask))
+            for i in range(PHILOX_ROUNDS)
+        ]
+
+    def raw(self, pixel, sample, bounce, block=0) -> np.ndarray:
+        """
+        Get the raw 64 bit words for the given counters. Arguments broadcast against each other.
+
+        Parameters:
+            pixel: The pixel index (row * cols + col).
+            sample: The sample index within the pixel.
+            bounce: The bounce number along the path.
+            block: The block of four dimensions within the bounce.
+
+        Returns:
+            np.ndarray: uint64 array of shape (..., 4).
+        """
+        words = np.broadcast_arrays(*(np.asarray(x, dtype=np.uint64) for x in (pixel, sample, bounce, block)))
+        shape = words[0].shape
+        # Work on flat arrays so that scalar counters don't become numpy scalars, which warn on overflow.
+        c0, c1, c2, c3 = (w.reshape(-1) for w in words)
+        if c0.size <= PHILOX_SCALAR_BATCH:
+            counters = np.stack([c0, c1, c2, c3], axis=-1)
+            out = np.empty(counters.shape, dtype=np.uint64)
+            for i, counter in enumerate(counters):
+                self.bit_generator.state = {
+                    'bit_generator': 'Philox',
+                    'state': {'counter': counter, 'key': self.key},
+                    'buffer': out[i],
+                    'buffer_pos': 4,
+                    'has_uint32': 0,
+                    'uinteger': 0,
+                }
+                out[i] = self.bit_generator.random_raw(4)
+            return out.reshape(shape + (4,))
+        # NumPy's Philox increments its counter before producing a block.
+        c0 = c0 + np.uint64(1)
+        for k0, k1 in self.round_keys:
+            hi0, lo0 = _mulhilo64(c0, PHILOX_M0)
+            hi1, lo1 = _mulhilo64(c2, PHILOX_M1)
+            c0, c1, c2, c3 = hi1 ^ c1 ^ k0, lo1, hi0 ^ c3 ^ k1, lo0
+        return np.stack([c0, c1, c2, c3], axis=-1).reshape(shape + (4,))
+
+    def uniforms(self, pixel, sample, bounce, block=0) -> np.ndarray:
+        """
+        Get uniform numbers in [0, 1) for the given counters. Arguments broadcast against each other.
+
+        Parameters:
+            pixel: The pixel index (row * cols + col).
+            sample: The sample index within the pixel.
+            bounce: The bounce number along the path.
+            block: The block of four dimensions within the bounce.
+
+        Returns:
+            np.ndarray: float64 array of shape (..., 4).
+        """
+        return (self.raw(pixel, sample, bounce, block) >> np.uint64(11)) * (1.0 / 9007199254740992.0)
 
 class Ray():
     """Represents a ray in 3D space."""
 
-    def __init__(self, pos, dir, bounces=0, r=0, c=0) -> None:
+    def __init__(self, pos, dir, bounces=0, r=0, c=0, sample=0) -> None:
         """
         Initialize a new Ray object.
 
@@ -120,12 +353,14 @@ class Ray():
             bounces: The number of bounces the ray has made.
             r: The row of the pixel.
             c: The column of the pixel.
+            sample: The index of the pixel sample the ray belongs to.
         """
         self.pos: np.ndarray = pos
         self.dir: np.ndarray = dir
         self.bounces = bounces
         self.r = r
         self.c = c
+        self.sample = sample
 
 class Camera():
     """Represents a camera in 3D space."""
@@ -192,6 +427,25 @@ class Camera():
             dir = dir / norm
         return dir
 
+    def tile_corners(self, row_start, row_end, col_start, col_end) -> np.ndarray:
+        """
+        Get the (unnormalized) directions through the corners of a tile of pixels. Every
+        camera ray sampled within the tile points into the pyramid they span.
+
+        Parameters:
+            row_start: The first row of the tile.
+            row_end: One past the last row of the tile.
+            col_start: The first column of the tile.
+            col_end: One past the last column of the tile.
+
+        Returns:
+            np.ndarray: The four corner directions, (4, 3), in order around the tile.
+        """
+        return np.array([
+            self.top_left + (self.horizontal_delta * x) + (self.vert_delta * y)
+            for x, y in ((col_start, row_start), (col_end, row_start), (col_end, row_end), (col_start, row_end))
+        ])
+
     def get_random_ray(self, r, c) -> Ray:
         """
         Get a ray originating at the camera location and pointed towards a random position within the given pixel.
@@ -205,10 +459,26 @@ class Camera():
         """
         return Ray(self.pos, self.get_ray_dir(c + random.random(), r + random.random()), r=r, c=c)
 
+    def get_sample_ray(self, r, c, sample, uniforms) -> Ray:
+        """
+        Get a ray originating at the camera location and pointed towards a sample position within the given pixel.
+
+        Parameters:
+            r: The row of the pixel.
+            c: The column of the pixel.
+            sample: The index of the pixel sample.
+            uniforms: The uniforms for the sample's first bounce, from a CounterRNG.
+
+        Returns:
+            Ray: A ray originating at the camera location and pointed towards the sample position within the given pixel.
+        """
+        dir = self.get_ray_dir(c + uniforms[DIM_PIXEL_X], r + uniforms[DIM_PIXEL_Y])
+        return Ray(self.pos, dir, r=r, c=c, sample=sample)
+
 class Intersection():
     """Represents an intersection between a ray and a shape."""
 
-    def __init__(self, pt, shape, dist):
+    def __init__(self, pt, shape, dist, normal=None, instance=None):
         """
         Initialize a new Intersection object.
 
@@ -216,16 +486,23 @@ class Intersection():
             pt: The point of intersection.
             shape: The shape that was intersected.
             dist: The distance from the ray's starting position to the point of intersection.
+            normal: The shape's normal at the point, if already known.
+            instance: For hits on instanced geometry, the (geometry, instance index, triangle index) hit.
         """
         self.pt = pt
         self.shape = shape
         self.dist = dist
+        self.normal = normal
+        self.instance = instance
 
 class ShapeType(IntEnum):
     """Represents the type of a shape."""
     PLANE = 0
     SPHERE = 1
     TRIANGLE = 2
+    # Parallelograms, from the scene optimizer's merged triangle pairs. Not a hardware shape
+    # type: they are sent to the hardware as their two triangles.
+    QUAD = 4
 
 def shape_type(shape_str: str) -> ShapeType:
     """
@@ -243,6 +520,8 @@ def shape_type(shape_str: str) -> ShapeType:
         return ShapeType.PLANE
     if shape_str == "triangle":
         return ShapeType.TRIANGLE
+    if shape_str == "quad":
+        return ShapeType.QUAD
     raise Exception("Invalid shape type.")
 
 class Shape:
@@ -263,7 +542,8 @@ class Shape:
         self.color = color
         self.specularity = specularity
         self.emittance = emittance
-        # Note that all three coordinates only used for triangles.
+        # Note that all three coordinates only used for triangles and quads. A quad's fourth
+        # corner is coordinates[1] + coordinates[2] - coordinates[0].
         # Else the first coord defines center and second defines normal.
         self.coordinates = coordinates
 
@@ -271,31 +551,30 @@ class Shape:
         # todo ensure functioning
         return struct.pack('fffffffffc0i', *self.coordinates[0], *self.coordinates[1], *self.coordinates[2], bytes([self.shape_type]))
 
-    def intersection_with(self, ray) -> Optional[Intersection]:
+    def hit_param(self, pos, dir) -> Optional[float]:
         """
-        Get the intersection between the shape and the given ray.
+        Get the ray parameter at which a ray hits the shape.
 
         Parameters:
-            ray: The ray to check for intersection.
+            pos: The ray origin.
+            dir: The ray direction.
 
         Returns:
-            Optional[Intersection]: The intersection between the shape and the given ray, if it exists.
+            Optional[float]: The ray parameter of the hit (the hit point is pos + t * dir), if it exists.
         """
         if self.shape_type == ShapeType.PLANE:
-            dir_dot_norm = np.dot(ray.dir, self.coordinates[1])
+            dir_dot_norm = np.dot(dir, self.coordinates[1])
             if abs(dir_dot_norm) < 0.000001:
                 return None
-            t = np.dot(self.coordinates[0] - ray.pos, self.coordinates[1]) / dir_dot_norm
+            t = np.dot(self.coordinates[0] - pos, self.coordinates[1]) / dir_dot_norm
             if t < 0:
                 return None
-            traversed_ray = t * ray.dir
-            intersect_pt = ray.pos + traversed_ray
-            return Intersection(intersect_pt, self, np.linalg.norm(traversed_ray))
+            return t
 
         elif self.shape_type == ShapeType.SPHERE:
-            a = np.dot(ray.dir, ray.dir)
-            b = 2 * np.dot(ray.dir, ray.pos - self.coordinates[0])
-            c = np.dot(ray.pos - self.coordinates[0], ray.pos - self.coordinates[0]) - self.coordinates[1][0] ** 2 # XXX: coordinates[1][0] as radius
+            a = np.dot(dir, dir)
+            b = 2 * np.dot(dir, pos - self.coordinates[0])
+            c = np.dot(pos - self.coordinates[0], pos - self.coordinates[0]) - self.coordinates[1][0] ** 2 # XXX: coordinates[1][0] as radius
             discrim = (b ** 2) - (4 * a * c)
             if discrim < 0:
                 return None
@@ -303,37 +582,96 @@ class Shape:
             t2 = (-1 * b - math.sqrt(discrim)) / (2 * a)
             if t1 < 0 and t2 < 0:
                 return None
-            t = min(t1, t2)
-            traversed_ray = t * ray.dir
-            intersect_pt = ray.pos + traversed_ray
-            return Intersection(intersect_pt, self, np.linalg.norm(traversed_ray))
+            # Take the nearer root in front of the ray; the other one is behind it when starting inside.
+            # A near root within MIN_HIT_DIST is the surface the ray is leaving, as in intersect_spheres.
+            return t2 if t2 * math.sqrt(a) > MIN_HIT_DIST else t1
 
-        elif self.shape_type == ShapeType.TRIANGLE:
+        elif self.shape_type in (ShapeType.TRIANGLE, ShapeType.QUAD):
             edge1 = self.coordinates[1] - self.coordinates[0]
             edge2 = self.coordinates[2] - self.coordinates[0]
-            ray_cross_edge2 = np.cross(ray.dir, edge2)
+            ray_cross_edge2 = np.cross(dir, edge2)
             det = np.dot(edge1, ray_cross_edge2)
             if abs(det) < 0.000001:
                 return None
             inv_det = 1.0 / det
-            s = ray.pos - self.coordinates[0]
+            s = pos - self.coordinates[0]
             u = inv_det * np.dot(s, ray_cross_edge2)
             if (u < 0) or (u > 1):
                 return None
             s_cross_edge1 = np.cross(s, edge1)
-            v = inv_det * np.dot(ray.dir, s_cross_edge1)
-            if (v < 0) or (u + v > 1):
+            v = inv_det * np.dot(dir, s_cross_edge1)
+            if (v < 0) or (v > 1 if self.shape_type == ShapeType.QUAD else u + v > 1):
                 return None
             t = inv_det * np.dot(edge2, s_cross_edge1)
             if (t < 0.000001):
                 return None
-            traversed_ray =  t * ray.dir
-            intersect_pt = ray.pos + traversed_ray
-            return Intersection(intersect_pt, self, np.linalg.norm(traversed_ray))
-        
+            return t
+
         else:
             return None
 
+    def intersection_with(self, ray) -> Optional[Intersection]:
+        """
+        Get the intersection between the shape and the given ray.
+
+        Parameters:
+            ray: The ray to check for intersection.
+
+        Returns:
+            Optional[Intersection]: The intersection between the shape and the given ray, if it exists.
+        """
+        t = self.hit_param(ray.pos, ray.dir)
+        if t is None:
+            return None
+        traversed_ray = t * ray.dir
+        intersect_pt = ray.pos + traversed_ray
+        return Intersection(intersect_pt, self, np.linalg.norm(traversed_ray))
+
+    def occludes(self, origin, dir, t_min, t_max) -> bool:
+        """
+        Check whether the shape blocks a ray between two ray parameters, without building an Intersection.
+
+        Parameters:
+            origin: The ray origin.
+            dir: The ray direction.
+            t_min: The ray parameter hits must be beyond.
+            t_max: The ray parameter hits must be nearer than.
+
+        Returns:
+            bool: Whether the ray hits the shape between t_min and t_max.
+        """
+        t = self.hit_param(origin, dir)
+        return t is not None and t_min < t < t_max
+
+    def outside_frustum(self, apex, corners) -> bool:
+        """
+        Check whether no ray from the apex pointing into the pyramid spanned by the corner
+        directions can hit the shape. Conservative: may return False for shapes that are missed.
+
+        Parameters:
+            apex: The origin shared by the rays.
+            corners: The four directions spanning the pyramid, (4, 3), in order around it.
+
+        Returns:
+            bool: Whether the shape can be skipped for all the rays.
+        """
+        if self.shape_type == ShapeType.PLANE:
+            # Ray directions are positive mixes of the corners, so the plane is only hit in
+            # front of the apex if some corner points towards it.
+            side = np.dot(self.coordinates[0] - apex, self.coordinates[1])
+            return bool(np.all((corners @ self.coordinates[1]) * side < 0))
+
+        normals = frustum_normals(corners)
+        if self.shape_type == ShapeType.SPHERE:
+            # Outside if the whole sphere is beyond one of the side planes.
+            margin = self.coordinates[1][0] + 1e-9
+            return bool(np.any(normals @ (self.coordinates[0] - apex) < -margin))
+        if self.shape_type in (ShapeType.TRIANGLE, ShapeType.QUAD):
+            # Outside if all the corners are beyond the same side plane.
+            offsets = (self.corners() - apex) @ normals.T
+            return bool(np.any(np.all(offsets < -1e-9, axis=0)))
+        return False
+
     def normal(self, point) -> np.ndarray:
         """
         Get the normal of the shape at the given point.
@@ -348,279 +686,3720 @@ class Shape:
             return self.coordinates[1]
         if self.shape_type == ShapeType.SPHERE:
             return normalize(point - self.coordinates[0])
-        if self.shape_type == ShapeType.TRIANGLE:
+        if self.shape_type in (ShapeType.TRIANGLE, ShapeType.QUAD):
             return np.cross(self.coordinates[1] - self.coordinates[0], self.coordinates[2] - self.coordinates[0])
         raise Exception()
 
-def load_scene_from_json(json_blob):
+    def corners(self) -> np.ndarray:
+        """
+        Get the corners of a triangle or quad.
+
+        Returns:
+            np.ndarray: The corners, (3, 3) for triangles and (4, 3) for quads.
+        """
+        corners = np.array(self.coordinates[:3], dtype=float)
+        if self.shape_type == ShapeType.QUAD:
+            corners = np.vstack([corners, corners[1] + corners[2] - corners[0]])
+        return corners
+
+    def triangles(self) -> List["Shape"]:
+        """
+        Get the shape as shapes the hardware can intersect: a quad as its two triangles,
+        anything else as itself.
+
+        Returns:
+            List[Shape]: The shapes.
+        """
+        if self.shape_type != ShapeType.QUAD:
+            return [self]
+        p0, p1, p2, p3 = self.corners()
+        # Both halves keep the quad's winding, so their normals match it.
+        return [
+            Shape("triangle", self.color, self.specularity, self.emittance, [p0, p1, p2]),
+            Shape("triangle", self.color, self.specularity, self.emittance, [p3, p2, p1]),
+        ]
+
+def intersect_spheres(origins, dirs, centers, radii):
     """
-    Load a scene from a JSON blob.
+    Find the nearest sphere hit for each of a batch of rays at once.
 
     Parameters:
-        json_blob: The JSON blob to load.
+        origins: The ray origins, (n, 3).
+        dirs: The ray directions, (n, 3).
+        centers: The sphere centers, (m, 3).
+        radii: The sphere radii, (m,).
 
     Returns:
-        List[Shape]: List of shapes representing the loaded scene.
+        Tuple[np.ndarray, np.ndarray]: The distance to the nearest hit of each ray (inf for
+        no hit), and the index of the sphere hit (-1 for no hit).
     """
-    shapes = []
-    data = json.loads(json_blob)
-    for obj in data:
-        shape_type = obj['shape_type']
-        color = np.array(obj['color'])
-        specularity = obj['specularity']
-        emittance = obj['emittance']
-        coordinates = [np.array(coord) for coord in obj['coordinates']]
-        shape = Shape(shape_type, color, specularity, emittance, coordinates)
-        shapes.append(shape)
-    return shapes
+    n = len(origins)
+    if len(radii) == 0:
+        return np.full(n, np.inf), np.full(n, -1)
+    to_origin = origins[:, np.newaxis, :] - centers[np.newaxis, :, :]
+    a = np.sum(dirs * dirs, axis=1)[:, np.newaxis]
+    b = 2 * np.einsum('nk,nmk->nm', dirs, to_origin)
+    c = np.sum(to_origin * to_origin, axis=2) - radii[np.newaxis, :] ** 2
+    discrim = b ** 2 - 4 * a * c
+    root = np.sqrt(np.maximum(discrim, 0))
+    dir_len = np.sqrt(a)
+    near = (-b - root) / (2 * a) * dir_len
+    far = (-b + root) / (2 * a) * dir_len
+    dist = np.where(near > MIN_HIT_DIST, near, far)
+    dist = np.where((discrim >= 0) & (dist > MIN_HIT_DIST), dist, np.inf)
+    idx = np.argmin(dist, axis=1)
+    best = dist[np.arange(n), idx]
+    idx[best == np.inf] = -1
+    return best, idx
 
-class Pathtracer():
-    """Represents a path tracer."""
+def intersect_shape_arrays(kind, coords, origins, dirs):
+    """
+    Intersect every ray with every shape of one type at once, with the same tests as
+    Shape.hit_param.
 
-    def __init__(self, rows=360, cols=480, camera = None) -> None:
-        """
-        Initialize a new Pathtracer object.
+    Parameters:
+        kind: The shape type, 'plane', 'sphere', 'triangle' or 'quad'.
+        coords: The shapes' coordinates, (m, 2, 3) for planes and spheres, (m, 3, 3) for
+            triangles and quads.
+        origins: The ray origins, (n, 1, 3).
+        dirs: The ray directions, (n, 1, 3).
 
-        Parameters:
-            camera: The camera to use for rendering.
-        """
-        self.rays_per_pixel = 4
-        self.depth = 4
-        
-        self.rows = rows
-        self.cols = cols
-        self.fov = 90
-        self.camera: Camera = Camera([0, 0, 0], 0, 0, self.rows, self.cols, self.fov) # TODO pass this in from json, as it helps describe the scene to trace.
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The ray parameter of each ray's hit on each shape, and
+        whether the hit exists, both (n, m).
+    """
+    o, d = origins, dirs
+    if kind == 'plane':
+        dir_dot_norm = np.sum(d * coords[:, 1], axis=2)
+        ok = np.abs(dir_dot_norm) >= 0.000001
+        t = np.sum((coords[:, 0] - o) * coords[:, 1], axis=2) / np.where(ok, dir_dot_norm, 1)
+        return t, ok & (t >= 0)
 
-        self.scene: List[Shape] = []
+    if kind == 'sphere':
+        to_origin = o - coords[:, 0]
+        a = np.sum(d * d, axis=2)
+        b = 2 * np.sum(d * to_origin, axis=2)
+        c = np.sum(to_origin * to_origin, axis=2) - coords[:, 1, 0] ** 2
+        discrim = b ** 2 - 4 * a * c
+        root = np.sqrt(np.maximum(discrim, 0))
+        t1 = (-b + root) / (2 * a)
+        t2 = (-b - root) / (2 * a)
+        t = np.where(t2 > 0, t2, t1)
+        return t, (discrim >= 0) & ~((t1 < 0) & (t2 < 0))
 
-        # Can be used for accumulating / calculating pixel colors.
-        self.pixels = np.zeros((self.rows, self.cols, 3))
+    edge1 = coords[:, 1] - coords[:, 0]
+    edge2 = coords[:, 2] - coords[:, 0]
+    ray_cross_edge2 = np.cross(d, edge2)
+    det = np.sum(edge1 * ray_cross_edge2, axis=2)
+    ok = np.abs(det) >= 0.000001
+    inv_det = 1.0 / np.where(ok, det, 1)
+    s = o - coords[:, 0]
+    u = inv_det * np.sum(s * ray_cross_edge2, axis=2)
+    s_cross_edge1 = np.cross(s, edge1)
+    v = inv_det * np.sum(d * s_cross_edge1, axis=2)
+    t = inv_det * np.sum(edge2 * s_cross_edge1, axis=2)
+    inside = (v <= 1) if kind == 'quad' else (u + v <= 1)
+    return t, ok & (u >= 0) & (u <= 1) & (v >= 0) & inside & (t >= 0.000001)
 
-        # Must contain the final pixel colors.
-        self.final_pixels = np.zeros((self.rows, self.cols, 3))
+def sphere_vectors_from(u, v) -> np.ndarray:
+    """
+    Map arrays of uniform numbers to 3D vectors on the unit sphere, as random_vector_from does.
 
-        self.iters = 0
-        self.done = 0
+    Parameters:
+        u: Uniform numbers in [0, 1), selecting the azimuths, (n,).
+        v: Uniform numbers in [0, 1), selecting the inclinations, (n,).
+
+    Returns:
+        np.ndarray: The vectors, (n, 3).
+    """
+    theta = u * 2 * math.pi
+    phi = np.arccos(2 * v - 1)
+    return np.stack([np.sin(phi) * np.cos(theta), np.sin(phi) * np.sin(theta), np.cos(phi)], axis=1)
+
+def sample_shape_points(kind, coords, u, v) -> tuple:
+    """
+    Map arrays of uniform numbers to points spread uniformly over the area of a sphere, triangle or quad.
+
+    Parameters:
+        kind: The shape type, 'sphere', 'triangle' or 'quad'.
+        coords: The shape's coordinates, (2, 3) for spheres and (3, 3) for triangles and quads.
+        u: Uniform numbers in [0, 1), (n,).
+        v: Uniform numbers in [0, 1), (n,).
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, float]: The points and the unit normals there, (n, 3) each,
+        and the shape's area.
+    """
+    if kind == 'sphere':
+        normals = sphere_vectors_from(u, v)
+        radius = coords[1][0]
+        return coords[0] + radius * normals, normals, 4 * math.pi * radius ** 2
+    edge1 = coords[1] - coords[0]
+    edge2 = coords[2] - coords[0]
+    normal = np.cross(edge1, edge2)
+    area = np.linalg.norm(normal)
+    if kind == 'triangle':
+        # Fold the far half of the parallelogram back onto the triangle.
+        folded = u + v > 1
+        u, v = np.where(folded, 1 - u, u), np.where(folded, 1 - v, v)
+        area /= 2
+    points = coords[0] + u[:, np.newaxis] * edge1 + v[:, np.newaxis] * edge2
+    return points, np.broadcast_to(normal / np.linalg.norm(normal), points.shape), area
+
+def mis_weight(light_pdfs, camera_pdfs, s) -> np.ndarray:
+    """
+    Get the balance heuristic weight of the bidirectional strategy taking s vertices of a path
+    from its light subpath, against all the other strategies that could have made the same path.
+    Vertex 0 is on the light and the path's last vertex is the camera's first hit; that hit is
+    always found from the camera, so it is left out.
+
+    Parameters:
+        light_pdfs: Per vertex but the last, the area density of finding it from the light side, (n,) each.
+        camera_pdfs: Per vertex but the last, the area density of finding it from the camera side, (n,) each.
+        s: The number of light vertices of the strategy.
+
+    Returns:
+        np.ndarray: The weights, (n,).
+    """
+    # Paths of one vertex have only the one strategy, and a weight of 1 for all of them.
+    total = np.ones(len(camera_pdfs[0]) if camera_pdfs else 1)
+    # Strategies with fewer light vertices find the vertices before s from the camera instead.
+    ratio = np.ones_like(total)
+    for i in range(s - 1, -1, -1):
+        ratio = ratio * camera_pdfs[i] / light_pdfs[i]
+        total = total + ratio
+    # Strategies with more light vertices find the vertices from s on from the light instead.
+    ratio = np.ones_like(total)
+    for i in range(s, len(light_pdfs)):
+        ratio = ratio * light_pdfs[i] / camera_pdfs[i]
+        total = total + ratio
+    return 1 / total
+
+def frustum_normals(corners) -> np.ndarray:
+    """
+    Get the inward facing unit normals of the side planes of the pyramid spanned by four directions.
+
+    Parameters:
+        corners: The four directions spanning the pyramid, (4, 3), in order around it.
+
+    Returns:
+        np.ndarray: The side plane normals, (4, 3).
+    """
+    center = np.sum(corners, axis=0)
+    normals = np.cross(corners, np.roll(corners, -1, axis=0))
+    normals = normals * np.sign(normals @ center)[:, np.newaxis]
+    return normals / np.linalg.norm(normals, axis=1)[:, np.newaxis]
+
+def transform_matrix(obj) -> np.ndarray:
+    """
+    Get the object to world transform of an instance from its JSON description. Either a full
+    "transform" matrix (3 or 4 rows of 4), or a "scale" (a number or 3), a "rotation" (degrees
+    about x, then y, then z) and a "translation", all optional.
 
-    def load_from_file(self, json_file) -> None:
+    Parameters:
+        obj: The instance's JSON object.
+
+    Returns:
+        np.ndarray: The transform, as a 3x4 matrix [linear | translation].
+    """
+    if 'transform' in obj:
+        return np.array(obj['transform'], dtype=float)[:3]
+    scale = np.diag(np.broadcast_to(np.array(obj.get('scale', 1.0), dtype=float), (3,)))
+    ax, ay, az = np.radians(obj.get('rotation', [0, 0, 0]))
+    rot_x = np.array([[1, 0, 0], [0, math.cos(ax), -math.sin(ax)], [0, math.sin(ax), math.cos(ax)]])
+    rot_y = np.array([[math.cos(ay), 0, math.sin(ay)], [0, 1, 0], [-math.sin(ay), 0, math.cos(ay)]])
+    rot_z = np.array([[math.cos(az), -math.sin(az), 0], [math.sin(az), math.cos(az), 0], [0, 0, 1]])
+    linear = rot_z @ rot_y @ rot_x @ scale
+    return np.hstack([linear, np.array(obj.get('translation', [0, 0, 0]), dtype=float)[:, np.newaxis]])
+
+class BVH():
+    """Represents a bounding volume hierarchy over primitives with axis-aligned bounds."""
+
+    def __init__(self, mins, maxs, leaf_size=BVH_LEAF_SIZE):
         """
-        Load a scene for this pathtracer from a JSON file.
+        Initialize a new BVH object, splitting at the median centroid along the widest axis.
+        The tree is built a level at a time, sorting the primitives of all of a level's nodes
+        at once, so building it for millions of primitives takes seconds.
 
         Parameters:
-            json_file: The JSON file to load.
+            mins: The minimum corners of the primitives' bounds, (n, 3).
+            maxs: The maximum corners of the primitives' bounds, (n, 3).
+            leaf_size: The most primitives held by a leaf.
         """
-        with open(json_file, 'r') as scene_file:
-            json_blob = scene_file.read()
-            self.scene = load_scene_from_json(json_blob)
+        mins = np.asarray(mins, dtype=float).reshape(-1, 3)
+        maxs = np.asarray(maxs, dtype=float).reshape(-1, 3)
+        centroids = (mins + maxs) / 2
+        n = len(mins)
+        # Primitive indices, reordered so every node's primitives are contiguous.
+        self.order = np.arange(n)
+        # The nodes of each level, as ranges of the order. Children are always stored next to each other.
+        levels = []
+        starts, ends = np.array([0]), np.array([n])
+        while len(starts):
+            split = ends - starts > leaf_size
+            levels.append((starts, ends, split))
+            if not np.any(split):
+                break
+            starts, ends = starts[split], ends[split]
+            lengths = ends - starts
+            offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+            segment = np.repeat(np.arange(len(starts)), lengths)
+            positions = np.arange(len(segment)) - offsets[segment] + starts[segment]
+            prims = self.order[positions]
+            points = centroids[prims]
+            axis = np.argmax(np.maximum.reduceat(points, offsets) - np.minimum.reduceat(points, offsets), axis=1)
+            # Stable sorts by the centroid, then by node, sort each node's primitives on its own.
+            by_key = np.argsort(points[np.arange(len(points)), axis[segment]], kind='stable')
+            self.order[positions] = prims[by_key[np.argsort(segment[by_key], kind='stable')]]
+            mids = (starts + ends) // 2
+            starts = np.stack([starts, mids], axis=1).reshape(-1)
+            ends = np.stack([mids, ends], axis=1).reshape(-1)
+
+        node_min, node_max, node_left, node_start, node_count = [], [], [], [], []
+        # Padded by a row, so node ranges ending at n can be reduced.
+        ordered_min = np.vstack([mins[self.order], np.zeros((1, 3))])
+        ordered_max = np.vstack([maxs[self.order], np.zeros((1, 3))])
+        first = 0
+        for starts, ends, split in levels:
+            bounds = np.stack([starts, ends], axis=1).reshape(-1)
+            if n:
+                node_min.append(np.minimum.reduceat(ordered_min, bounds)[::2])
+                node_max.append(np.maximum.reduceat(ordered_max, bounds)[::2])
+            else:
+                node_min.append(np.zeros((1, 3)))
+                node_max.append(np.zeros((1, 3)))
+            next_first = first + len(starts)
+            node_left.append(np.where(split, next_first + 2 * (np.cumsum(split) - 1), -1))
+            node_start.append(starts)
+            node_count.append(np.where(split, 0, ends - starts))
+            first = next_first
+
+        self.node_min = np.concatenate(node_min)
+        self.node_max = np.concatenate(node_max)
+        # The links as arrays, for traversing whole arrays of rays, and as lists, which single
+        # rays index faster.
+        self.left_array = np.concatenate(node_left)
+        self.start_array = np.concatenate(node_start)
+        self.count_array = np.concatenate(node_count)
+        self.node_left = self.left_array.tolist()
+        self.node_start = self.start_array.tolist()
+        self.node_count = self.count_array.tolist()
 
-    def cast_ray(self, ray) -> Optional[Intersection]:
+    def slabs(self, nodes, origin, inv_dir):
         """
-        Cast a ray into the scene and find the closest intersection.
+        Get the entry and exit ray parameters of nodes' bounds.
 
         Parameters:
-            ray: The ray to cast.
+            nodes: The node indices, or a slice of them.
+            origin: The ray origin.
+            inv_dir: The reciprocal of the ray direction.
 
         Returns:
-            Optional[Intersection]: The closest intersection, if it exists.
+            Tuple[np.ndarray, np.ndarray]: The entry and exit parameters. Missed where entry > exit.
         """
-        intersection: Optional[Intersection] = None
-        closest_dist = 99999
-        for shape in self.scene:
-            if isect := shape.intersection_with(ray):
-                if isect.dist < closest_dist and isect.dist > 0.0001:
-                    closest_dist = isect.dist
-                    intersection = isect
-        return intersection
+        t0 = (self.node_min[nodes] - origin) * inv_dir
+        t1 = (self.node_max[nodes] - origin) * inv_dir
+        return np.max(np.minimum(t0, t1), axis=-1), np.min(np.maximum(t0, t1), axis=-1)
 
-    def ray_color(self, ray: Ray):
+    def traverse(self, origin, dir, t_min, t_max, leaf_fn) -> float:
         """
-        Get the color of a given ray should it be bounced around the scene
-        subject to the pathtracing algorithm.
+        Visit the leaves a ray passes through, nearest first, skipping any beyond the nearest hit so far.
 
         Parameters:
-            ray: The ray to cast.
+            origin: The ray origin.
+            dir: The ray direction.
+            t_min: The smallest ray parameter of interest.
+            t_max: The largest ray parameter of interest.
+            leaf_fn: Called with the primitive indices of each leaf visited and the current t_max,
+                returning the new t_max (smaller when a nearer hit was found). Returning a t_max
+                below t_min ends the traversal, for queries satisfied by any hit.
 
         Returns:
-            np.ndarray: The color of the simulated ray, as an np.ndarray.
+            float: The final t_max.
         """
-        traced_ray = ray
-        traced_color = np.array([255, 255, 255])
+        dir = np.where(np.abs(dir) < 1e-12, 1e-12, dir)
+        inv_dir = 1.0 / dir
+        entry, exit = self.slabs(0, origin, inv_dir)
+        if entry > exit or exit < t_min or entry > t_max:
+            return t_max
+        stack = [(0, entry)]
+        while stack:
+            node, entry = stack.pop()
+            if entry > t_max:
+                continue
+            left = self.node_left[node]
+            if left < 0:
+                start = self.node_start[node]
+                t_max = leaf_fn(self.order[start:start + self.node_count[node]], t_max)
+                if t_max < t_min:
+                    break
+                continue
+            entries, exits = self.slabs(slice(left, left + 2), origin, inv_dir)
+            hit = (entries <= exits) & (exits >= t_min) & (entries <= t_max)
+            # Push the farther child first, so the nearer one is visited first.
+            for child in ((1, 0) if entries[0] <= entries[1] else (0, 1)):
+                if hit[child]:
+                    stack.append((left + child, entries[child]))
+        return t_max
 
-        for bounce_num in range(self.depth):
-            intersection: Optional[Intersection] = self.cast_ray(traced_ray)
-            self.iters += 1
+    def traverse_arrays(self, origins, dirs, t_min, t_max, leaf_fn) -> None:
+        """
+        Visit the leaves whole arrays of rays pass through, a level of the tree at a time, skipping
+        nodes beyond each ray's nearest hit so far.
 
-            if intersection is None:
-                return np.array([0, 0, 0])
+        Parameters:
+            origins: The ray origins, (n, 3).
+            dirs: The ray directions, (n, 3).
+            t_min: The smallest ray parameter of interest, (n,).
+            t_max: The largest ray parameter of interest, (n,). Lowered in place by leaf_fn.
+            leaf_fn: Called with pairs of ray indices and the indices of the primitives in the
+                leaves they reach, and t_max, which it lowers where it finds nearer hits. Setting
+                a ray's t_max below its t_min ends its traversal, for queries satisfied by any hit.
+        """
+        dirs = np.where(np.abs(dirs) < 1e-12, 1e-12, dirs)
+        inv_dirs = 1.0 / dirs
+        rays = np.arange(len(origins))
+        nodes = np.zeros(len(origins), dtype=np.int64)
+        while len(rays):
+            entries, exits = self.slabs(nodes, origins[rays], inv_dirs[rays])
+            keep = (entries <= exits) & (exits >= t_min[rays]) & (entries <= t_max[rays])
+            rays, nodes = rays[keep], nodes[keep]
+            lefts = self.left_array[nodes]
+            leaf = lefts < 0
+            if np.any(leaf):
+                counts = self.count_array[nodes[leaf]]
+                starts = np.repeat(self.start_array[nodes[leaf]], counts)
+                offsets = np.arange(len(starts)) - np.repeat(np.cumsum(counts) - counts, counts)
+                leaf_fn(np.repeat(rays[leaf], counts), self.order[starts + offsets], t_max)
+            rays = np.repeat(rays[~leaf], 2)
+            nodes = (lefts[~leaf][:, np.newaxis] + np.arange(2)).reshape(-1)
 
-            shape = intersection.shape 
+class Mesh():
+    """Represents triangle geometry defined once and placed in the scene by instances."""
 
-            if (emittance := shape.emittance) > 0:
-                traced_color = color_mult(traced_color, emittance * shape.color)
-                break
-            elif bounce_num == self.depth - 1:
-                # Last bounce needs to hit a light, else the ray will be dark.
-                return np.array([0, 0, 0])
+    def __init__(self, name, vertices, faces):
+        """
+        Initialize a new Mesh object and build its BVH.
 
-            normal = shape.normal(intersection.pt)
+        Parameters:
+            name: The name instances refer to the mesh by.
+            vertices: The vertex positions, (v, 3), in object space.
+            faces: The vertex indices of each triangle, (f, 3).
+        """
+        self.name = name
+        self.vertices = np.asarray(vertices, dtype=float)
+        self.faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+        triangles = self.vertices[self.faces]
+        self.v0 = triangles[:, 0]
+        self.edge1 = triangles[:, 1] - triangles[:, 0]
+        self.edge2 = triangles[:, 2] - triangles[:, 0]
+        self.bvh = BVH(triangles.min(axis=1), triangles.max(axis=1))
 
-            # If normal vector and ray point in same hemisphere, flip the normal.
-            if np.dot(normal, traced_ray.dir) > 0.0:
-                normal = normal * -1
+    def triangle_hits(self, tris, origin, dir, t_min, t_max):
+        """
+        Intersect a ray with some of the mesh's triangles at once, or pairs of rays and triangles
+        when given a ray per triangle.
 
-            # XXX: Ambient light not used at the moment.
-            ambient_color = shape.color * shape.emittance
-            diffuse_dir = random_hemisphere_vector(normal)
-            traced_color = color_mult(traced_color, shape.color) * np.dot(normal, diffuse_dir) # XXX: * 2
+        Parameters:
+            tris: The triangle indices.
+            origin: The ray origin, in object space, or one per triangle.
+            dir: The ray direction, in object space, or one per triangle.
+            t_min: The smallest ray parameter accepted, or one per triangle.
+            t_max: The ray parameter hits must be nearer than, or one per triangle.
 
-            # TODO: Maybe allow for specular bouncing eventually.
-            #       Requires splitting rays, or randomly selecting if to do diffuse or spec bouncing.
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The ray parameter of each triangle's hit, and whether it is accepted.
+        """
+        edge1 = self.edge1[tris]
+        edge2 = self.edge2[tris]
+        ray_cross_edge2 = np.cross(dir, edge2)
+        det = np.sum(edge1 * ray_cross_edge2, axis=1)
+        ok = np.abs(det) >= 0.000001
+        inv_det = 1.0 / np.where(ok, det, 1)
+        s = origin - self.v0[tris]
+        u = inv_det * np.sum(s * ray_cross_edge2, axis=1)
+        s_cross_edge1 = np.cross(s, edge1)
+        v = inv_det * np.sum(s_cross_edge1 * dir, axis=1)
+        t = inv_det * np.sum(edge2 * s_cross_edge1, axis=1)
+        ok &= (u >= 0) & (u <= 1) & (v >= 0) & (u + v <= 1) & (t >= 0.000001) & (t > t_min) & (t < t_max)
+        return t, ok
 
-            traced_ray = Ray(intersection.pt, diffuse_dir)
+    def intersect_triangles(self, tris, origin, dir, t_min, t_max):
+        """
+        Find the nearest hit of a ray among some of the mesh's triangles at once.
 
-        return traced_color
+        Parameters:
+            tris: The triangle indices.
+            origin: The ray origin, in object space.
+            dir: The ray direction, in object space.
+            t_min: The smallest ray parameter accepted.
+            t_max: The ray parameter hits must be nearer than.
 
-    def init_hardware(self):
-        global allocate
-        from pynq import Overlay
-        from pynq import allocate
+        Returns:
+            Tuple[float, int]: The ray parameter and index of the nearest hit, or (t_max, -1).
+        """
+        t, ok = self.triangle_hits(tris, origin, dir, t_min, t_max)
+        if not np.any(ok):
+            return t_max, -1
+        t = np.where(ok, t, np.inf)
+        best = np.argmin(t)
+        return t[best], tris[best]
 
-        self.ol = Overlay('/home/xilinx/pynq/overlays/raycast/raycast.bit')
+    def intersect(self, origin, dir, t_min, t_max):
+        """
+        Find the nearest hit of a ray with the mesh, through its BVH.
 
-        self.raycast_ip = self.ol.raycast_0
-        self.dma = self.ol.axi_dma
-        self.dma_send = self.dma.sendchannel
-        self.dma_recv = self.dma.recvchannel
+        Parameters:
+            origin: The ray origin, in object space.
+            dir: The ray direction, in object space.
+            t_min: The smallest ray parameter accepted.
+            t_max: The ray parameter hits must be nearer than.
 
-        self.scene_bram = self.ol.axi_bram_ctrl_0
+        Returns:
+            Tuple[float, int]: The ray parameter and triangle index of the nearest hit, or (t_max, -1).
+        """
+        best_tri = -1
 
-    def send_scene_to_hardware(self):
+        def leaf(tris, t_max):
+            nonlocal best_tri
+            t, tri = self.intersect_triangles(tris, origin, dir, t_min, t_max)
+            if tri >= 0:
+                best_tri = tri
+            return t
+
+        t_max = self.bvh.traverse(origin, dir, t_min, t_max, leaf)
+        return t_max, best_tri
+
+    def occludes(self, origin, dir, t_min, t_max) -> bool:
+        """
+        Check whether any triangle of the mesh blocks a ray, stopping the BVH traversal at the first one found.
+
+        Parameters:
+            origin: The ray origin, in object space.
+            dir: The ray direction, in object space.
+            t_min: The smallest ray parameter accepted.
+            t_max: The ray parameter hits must be nearer than.
+
+        Returns:
+            bool: Whether the ray hits a triangle between t_min and t_max.
+        """
+        def leaf(tris, t_max):
+            return -np.inf if np.any(self.triangle_hits(tris, origin, dir, t_min, t_max)[1]) else t_max
+
+        return self.bvh.traverse(origin, dir, t_min, t_max, leaf) == -np.inf
+
+    def intersect_arrays(self, origins, dirs, t_min, t_max) -> tuple:
+        """
+        Find the nearest hits of whole arrays of rays with the mesh, through its BVH.
+
+        Parameters:
+            origins: The ray origins, in object space, (n, 3).
+            dirs: The ray directions, in object space, (n, 3).
+            t_min: The smallest ray parameter accepted, (n,).
+            t_max: The ray parameter hits must be nearer than, (n,).
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Per ray, the ray parameter and triangle index of the
+            nearest hit, or t_max and -1.
+        """
+        best_t = np.array(t_max, dtype=float)
+        best_tri = np.full(len(origins), -1, dtype=np.int64)
+
+        def leaf(rays, tris, t_max):
+            t, ok = self.triangle_hits(tris, origins[rays], dirs[rays], t_min[rays], t_max[rays])
+            rays, tris, t = rays[ok], tris[ok], t[ok]
+            # The nearest hit of each ray, the lowest triangle index on ties.
+            order = np.lexsort((tris, t, rays))
+            first = order[np.r_[True, rays[order][1:] != rays[order][:-1]]] if len(order) else order
+            t_max[rays[first]] = t[first]
+            best_tri[rays[first]] = tris[first]
+
+        self.bvh.traverse_arrays(origins, dirs, t_min, best_t, leaf)
+        return best_t, best_tri
+
+    def occludes_arrays(self, origins, dirs, t_min, t_max) -> np.ndarray:
+        """
+        Check whether any triangle of the mesh blocks each of whole arrays of rays, dropping rays
+        from the BVH traversal at the first triangle found.
+
+        Parameters:
+            origins: The ray origins, in object space, (n, 3).
+            dirs: The ray directions, in object space, (n, 3).
+            t_min: The smallest ray parameter accepted, (n,).
+            t_max: The ray parameter hits must be nearer than, (n,).
+
+        Returns:
+            np.ndarray: Per ray, whether it hits a triangle between t_min and t_max.
+        """
+        t_max = np.array(t_max, dtype=float)
+
+        def leaf(rays, tris, t_max):
+            ok = self.triangle_hits(tris, origins[rays], dirs[rays], t_min[rays], t_max[rays])[1]
+            t_max[rays[ok]] = -np.inf
+
+        self.bvh.traverse_arrays(origins, dirs, t_min, t_max, leaf)
+        return t_max == -np.inf
+
+def fan_triangles(polygon) -> List[List[int]]:
+    """
+    Split a convex polygon into a fan of triangles around its first vertex.
+
+    Parameters:
+        polygon: The polygon's vertex indices.
+
+    Returns:
+        List[List[int]]: The triangles' vertex indices.
+    """
+    return [[polygon[0], polygon[i], polygon[i + 1]] for i in range(1, len(polygon) - 1)]
+
+def load_obj(fname):
+    """
+    Read the vertices and faces of a Wavefront OBJ file, streaming it in chunks of
+    MESH_CHUNK_BYTES. Polygons are split into triangle fans. Texture coordinates, normals,
+    groups and materials are ignored.
+
+    Parameters:
+        fname: The OBJ file.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The vertices, (v, 3), and the zero based vertex indices
+        of the triangles, (f, 3).
+    """
+    vertex_chunks = []
+    face_chunks = []
+    vertex_count = 0
+    with open(fname, 'r') as obj_file:
+        while True:
+            lines = obj_file.readlines(MESH_CHUNK_BYTES)
+            if not lines:
+                break
+            vertex_lines = [line[2:] for line in lines if line.startswith('v ')]
+            face_lines = [line[2:] for line in lines if line.startswith('f ')]
+            # Parse whole chunks at once where every line is plain, else line by line.
+            values = np.fromstring(' '.join(vertex_lines), sep=' ') if vertex_lines else np.zeros(0)
+            if len(values) != 3 * len(vertex_lines):
+                values = np.array([line.split()[:3] for line in vertex_lines], dtype=float)
+            faces = None
+            text = re.sub(r'/\S*', '', ' '.join(face_lines))
+            if '-' not in text:
+                indices = np.fromstring(text, dtype=np.int64, sep=' ') if face_lines else np.zeros(0, dtype=np.int64)
+                if len(indices) == 3 * len(face_lines):
+                    faces = indices.reshape(-1, 3) - 1
+            if faces is None:
+                # Negative indices count back from the vertices read so far, so go in file order.
+                faces = []
+                count = vertex_count
+                for line in lines:
+                    if line.startswith('v '):
+                        count += 1
+                    elif line.startswith('f '):
+                        polygon = [int(token.split('/')[0]) for token in line.split()[1:]]
+                        polygon = [i + count if i < 0 else i - 1 for i in polygon]
+                        faces.extend(fan_triangles(polygon))
+                faces = np.array(faces, dtype=np.int64).reshape(-1, 3)
+            vertex_count += len(vertex_lines)
+            vertex_chunks.append(values.reshape(-1, 3))
+            face_chunks.append(faces)
+    vertices = np.concatenate(vertex_chunks) if vertex_chunks else np.zeros((0, 3))
+    faces = np.concatenate(face_chunks) if face_chunks else np.zeros((0, 3), dtype=np.int64)
+    return vertices, faces
+
+def load_ply(fname):
+    """
+    Read the vertices and faces of a binary PLY file, streaming its elements in chunks of
+    MESH_CHUNK_ELEMENTS. Polygons are split into triangle fans. Other properties and
+    elements are skipped.
+
+    Parameters:
+        fname: The PLY file.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The vertices, (v, 3), and the zero based vertex indices
+        of the triangles, (f, 3).
+    """
+    with open(fname, 'rb') as ply_file:
+        if ply_file.readline().strip() != b'ply':
+            raise Exception(f"{fname} is not a PLY file.")
+        elements = []
+        endian = None
+        while True:
+            line = ply_file.readline()
+            if not line:
+                raise Exception(f"{fname} has no end_header.")
+            words = line.decode('ascii').split()
+            if not words or words[0] in ('comment', 'obj_info'):
+                continue
+            if words[0] == 'end_header':
+                break
+            if words[0] == 'format':
+                if words[1] not in ('binary_little_endian', 'binary_big_endian'):
+                    raise Exception(f"Unsupported PLY format {words[1]}; only binary PLY files are supported.")
+                endian = '<' if words[1] == 'binary_little_endian' else '>'
+            elif words[0] == 'element':
+                elements.append((words[1], int(words[2]), []))
+            elif words[0] == 'property':
+                if words[1] == 'list':
+                    elements[-1][2].append((words[4], endian + PLY_TYPES[words[2]], endian + PLY_TYPES[words[3]]))
+                else:
+                    elements[-1][2].append((words[2], endian + PLY_TYPES[words[1]], None))
+
+        vertices = np.zeros((0, 3))
+        faces = np.zeros((0, 3), dtype=np.int64)
+        for name, count, properties in elements:
+            if all(item is None for _, _, item in properties):
+                record = np.dtype([(prop, dtype) for prop, dtype, _ in properties])
+                chunks = []
+                for start in range(0, count, MESH_CHUNK_ELEMENTS):
+                    size = min(MESH_CHUNK_ELEMENTS, count - start)
+                    data = np.frombuffer(ply_file.read(size * record.itemsize), dtype=record, count=size)
+                    if name == 'vertex':
+                        chunks.append(np.stack([data['x'], data['y'], data['z']], axis=1).astype(float))
+                if name == 'vertex':
+                    vertices = np.concatenate(chunks) if chunks else vertices
+                continue
+            if name != 'face':
+                raise Exception(f"Unsupported PLY element {name} with list properties.")
+            index_prop = next(
+                (prop for prop, _, item in properties if prop in ('vertex_indices', 'vertex_index')),
+                None,
+            )
+            if index_prop is None:
+                raise Exception(f"{fname} has faces without vertex indices.")
+            # Read chunks as if every face was a triangle, and reread those that aren't one at a time.
+            fields = []
+            for prop, dtype, item in properties:
+                fields.append((prop, dtype) if item is None else (prop + '_count', dtype))
+                if item is not None:
+                    fields.append((prop, item, 3))
+            record = np.dtype(fields)
+            chunks = []
+            for start in range(0, count, MESH_CHUNK_ELEMENTS):
+                size = min(MESH_CHUNK_ELEMENTS, count - start)
+                offset = ply_file.tell()
+                data = np.frombuffer(ply_file.read(size * record.itemsize), dtype=record)
+                if len(data) == size and all(
+                    np.all(data[prop + '_count'] == 3) for prop, _, item in properties if item is not None
+                ):
+                    chunks.append(data[index_prop].astype(np.int64))
+                    continue
+                ply_file.seek(offset)
+                polygons = []
+                for _ in range(size):
+                    for prop, dtype, item in properties:
+                        if item is None:
+                            ply_file.read(np.dtype(dtype).itemsize)
+                            continue
+                        length = int(np.frombuffer(ply_file.read(np.dtype(dtype).itemsize), dtype=dtype)[0])
+                        values = np.frombuffer(ply_file.read(length * np.dtype(item).itemsize), dtype=item)
+                        if prop == index_prop:
+                            polygons.extend(fan_triangles(values.tolist()))
+                chunks.append(np.array(polygons, dtype=np.int64).reshape(-1, 3))
+            faces = np.concatenate(chunks) if chunks else faces
+    return vertices, faces
+
+def load_mesh_file(fname, name=None) -> Mesh:
+    """
+    Load a mesh from an OBJ or binary PLY file.
+
+    Parameters:
+        fname: The mesh file, ending in .obj or .ply.
+        name: The name instances refer to the mesh by. Defaults to the file name.
+
+    Returns:
+        Mesh: The mesh.
+    """
+    extension = os.path.splitext(fname)[1].lower()
+    if extension == '.obj':
+        vertices, faces = load_obj(fname)
+    elif extension == '.ply':
+        vertices, faces = load_ply(fname)
+    else:
+        raise Exception(f"Unsupported mesh file {fname}; expected .obj or .ply.")
+    if len(faces) and (faces.min() < 0 or faces.max() >= len(vertices)):
+        raise Exception(f"{fname} has faces referring to missing vertices.")
+    return Mesh(name or os.path.basename(fname), vertices, faces)
+
+class InstancedGeometry():
+    """
+    Represents the mesh instances of a scene. Rays are intersected through a two level BVH: a
+    top level BVH over the instances' world bounds, and a bottom level BVH per mesh, shared by
+    all of its instances, which rays are transformed into object space to traverse.
+    """
+
+    def __init__(self, meshes, instances):
+        """
+        Initialize a new InstancedGeometry object and build its top level BVH.
+
+        Parameters:
+            meshes: The meshes, by name.
+            instances: The instances' JSON objects. Each names its "mesh", and may override the
+                mesh's "color", "specularity" and "emittance".
+        """
+        self.meshes: List[Mesh] = list(meshes.values())
+        mesh_ids = {name: i for i, name in enumerate(meshes)}
+        count = len(instances)
+        self.mesh_index = np.zeros(count, dtype=np.int64)
+        self.linear = np.zeros((count, 3, 3))
+        self.translation = np.zeros((count, 3))
+        self.colors = np.zeros((count, 3))
+        self.specularity = np.zeros(count)
+        self.emittance = np.zeros(count)
+        for k, obj in enumerate(instances):
+            if obj['mesh'] not in mesh_ids:
+                raise Exception(f"Instance of unknown mesh {obj['mesh']}.")
+            self.mesh_index[k] = mesh_ids[obj['mesh']]
+            transform = transform_matrix(obj)
+            self.linear[k] = transform[:, :3]
+            self.translation[k] = transform[:, 3]
+            self.colors[k] = obj['color']
+            self.specularity[k] = obj['specularity']
+            self.emittance[k] = obj['emittance']
+        self.inverse = np.linalg.inv(self.linear)
+
+        # World bounds of each instance, from the transformed corners of its mesh's bounds.
+        mins = np.zeros((count, 3))
+        maxs = np.zeros((count, 3))
+        for k in range(count):
+            bvh = self.meshes[self.mesh_index[k]].bvh
+            corners = np.array([[x, y, z] for x in (bvh.node_min[0][0], bvh.node_max[0][0])
+                                for y in (bvh.node_min[0][1], bvh.node_max[0][1])
+                                for z in (bvh.node_min[0][2], bvh.node_max[0][2])])
+            world = corners @ self.linear[k].T + self.translation[k]
+            mins[k] = world.min(axis=0)
+            maxs[k] = world.max(axis=0)
+        self.tlas = BVH(mins, maxs)
+
+    def __len__(self) -> int:
+        return len(self.mesh_index)
+
+    def world_shape(self, k, tri) -> Shape:
+        """
+        Get one triangle of an instance as a world space Shape.
+
+        Parameters:
+            k: The instance index.
+            tri: The triangle index within the instance's mesh.
+
+        Returns:
+            Shape: The triangle, with the instance's material.
+        """
+        mesh = self.meshes[self.mesh_index[k]]
+        coords = mesh.vertices[mesh.faces[tri]] @ self.linear[k].T + self.translation[k]
+        return Shape("triangle", self.colors[k], self.specularity[k], self.emittance[k], list(coords))
+
+    def flatten(self) -> List[Shape]:
+        """
+        Get every triangle of every instance as world space Shapes, for backends without instancing.
+
+        Returns:
+            List[Shape]: The triangles.
+        """
+        return [
+            self.world_shape(k, tri)
+            for k in range(len(self))
+            for tri in range(len(self.meshes[self.mesh_index[k]].faces))
+        ]
+
+    def intersection_with(self, ray) -> Optional[Intersection]:
+        """
+        Get the nearest intersection between the instances and the given ray.
+
+        Parameters:
+            ray: The ray to check for intersection.
+
+        Returns:
+            Optional[Intersection]: The nearest intersection, if it exists.
+        """
+        origin = np.asarray(ray.pos, dtype=float)
+        dir = np.asarray(ray.dir, dtype=float)
+        dir_len = np.linalg.norm(dir)
+        # Object space directions are not renormalized, so ray parameters agree across spaces.
+        t_min = MIN_HIT_DIST / dir_len
+        best = None
+
+        def leaf(instances, t_max):
+            nonlocal best
+            for k in instances:
+                inverse = self.inverse[k]
+                t, tri = self.meshes[self.mesh_index[k]].intersect(
+                    inverse @ (origin - self.translation[k]), inverse @ dir, t_min, t_max
+                )
+                if tri >= 0:
+                    t_max = t
+                    best = (k, tri)
+            return t_max
+
+        t = self.tlas.traverse(origin, dir, t_min, np.inf, leaf)
+        if best is None:
+            return None
+        traversed_ray = t * dir
+        return Intersection(origin + traversed_ray, self.world_shape(*best), np.linalg.norm(traversed_ray), instance=(self, *best))
+
+    def occludes(self, origin, dir, t_min, t_max) -> bool:
+        """
+        Check whether any instance blocks a ray, stopping both BVH levels at the first hit found.
+
+        Parameters:
+            origin: The ray origin.
+            dir: The ray direction.
+            t_min: The smallest ray parameter accepted.
+            t_max: The ray parameter hits must be nearer than.
+
+        Returns:
+            bool: Whether the ray hits an instance between t_min and t_max.
+        """
+        def leaf(instances, t_max):
+            for k in instances:
+                inverse = self.inverse[k]
+                if self.meshes[self.mesh_index[k]].occludes(inverse @ (origin - self.translation[k]), inverse @ dir, t_min, t_max):
+                    return -np.inf
+            return t_max
+
+        return self.tlas.traverse(origin, dir, t_min, t_max, leaf) == -np.inf
+
+    def instance_rays(self, rays, instances, origins, dirs):
+        """
+        Group the rays reaching the instances by instance, and transform each group into its
+        instance's object space at once.
+
+        Parameters:
+            rays: The ray indices, paired with instances.
+            instances: The instance indices.
+            origins: The world space ray origins, (n, 3).
+            dirs: The world space ray directions, (n, 3).
+
+        Yields:
+            Tuple: An instance index, its rays' indices, and their object space origins and directions.
+        """
+        if not len(rays):
+            return
+        order = np.argsort(instances, kind='stable')
+        rays, instances = rays[order], instances[order]
+        splits = np.flatnonzero(instances[1:] != instances[:-1]) + 1
+        for group, k in zip(np.split(rays, splits), instances[np.r_[0, splits]]):
+            inverse = self.inverse[k]
+            yield k, group, (origins[group] - self.translation[k]) @ inverse.T, dirs[group] @ inverse.T
+
+    def intersect_arrays(self, origins, dirs, t_min, t_max) -> tuple:
+        """
+        Find the nearest hits of whole arrays of rays with the instances: through the top level
+        BVH, then each instance's rays through its mesh's BVH.
+
+        Parameters:
+            origins: The ray origins, (n, 3).
+            dirs: The ray directions, (n, 3).
+            t_min: The smallest ray parameter accepted, (n,).
+            t_max: The ray parameter hits must be nearer than, (n,).
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: Per ray, the ray parameter of the nearest
+            hit (t_max if none), and the instance and triangle hit (-1 if none).
+        """
+        best_t = np.array(t_max, dtype=float)
+        best_k = np.full(len(origins), -1, dtype=np.int64)
+        best_tri = np.full(len(origins), -1, dtype=np.int64)
+
+        def leaf(rays, instances, t_max):
+            for k, group, o, d in self.instance_rays(rays, instances, origins, dirs):
+                t, tri = self.meshes[self.mesh_index[k]].intersect_arrays(o, d, t_min[group], t_max[group])
+                hit = tri >= 0
+                t_max[group[hit]] = t[hit]
+                best_k[group[hit]] = k
+                best_tri[group[hit]] = tri[hit]
+
+        self.tlas.traverse_arrays(origins, dirs, t_min, best_t, leaf)
+        return best_t, best_k, best_tri
+
+    def occludes_arrays(self, origins, dirs, t_min, t_max) -> np.ndarray:
+        """
+        Check whether any instance blocks each of whole arrays of rays, dropping rays from both
+        BVH levels at the first hit found.
+
+        Parameters:
+            origins: The ray origins, (n, 3).
+            dirs: The ray directions, (n, 3).
+            t_min: The smallest ray parameter accepted, (n,).
+            t_max: The ray parameter hits must be nearer than, (n,).
+
+        Returns:
+            np.ndarray: Per ray, whether it hits an instance between t_min and t_max.
+        """
+        t_max = np.array(t_max, dtype=float)
+
+        def leaf(rays, instances, t_max):
+            for k, group, o, d in self.instance_rays(rays, instances, origins, dirs):
+                blocked = self.meshes[self.mesh_index[k]].occludes_arrays(o, d, t_min[group], t_max[group])
+                t_max[group[blocked]] = -np.inf
+
+        self.tlas.traverse_arrays(origins, dirs, t_min, t_max, leaf)
+        return t_max == -np.inf
+
+    def world_triangles(self, instances, tris) -> np.ndarray:
+        """
+        Get triangles of instances in world space, as world_shape does one at a time.
+
+        Parameters:
+            instances: The instance indices, (n,).
+            tris: The triangle indices within the instances' meshes, (n,).
+
+        Returns:
+            np.ndarray: The triangles' world space corners, (n, 3, 3).
+        """
+        coords = np.zeros((len(instances), 3, 3))
+        for m in np.unique(self.mesh_index[instances]):
+            mesh = self.meshes[m]
+            of_mesh = np.flatnonzero(self.mesh_index[instances] == m)
+            corners = mesh.vertices[mesh.faces[tris[of_mesh]]]
+            k = instances[of_mesh]
+            coords[of_mesh] = np.einsum('nij,nvj->nvi', self.linear[k], corners) + self.translation[k][:, np.newaxis, :]
+        return coords
+
+    def outside_frustum(self, apex, corners) -> bool:
+        """
+        Check whether no ray from the apex pointing into the pyramid spanned by the corner
+        directions can hit any instance, using the bounds of all of them.
+
+        Parameters:
+            apex: The origin shared by the rays.
+            corners: The four directions spanning the pyramid, (4, 3), in order around it.
+
+        Returns:
+            bool: Whether the instances can be skipped for all the rays.
+        """
+        if len(self) == 0:
+            return True
+        lo, hi = self.tlas.node_min[0], self.tlas.node_max[0]
+        box = np.array([[x, y, z] for x in (lo[0], hi[0]) for y in (lo[1], hi[1]) for z in (lo[2], hi[2])])
+        offsets = (box - apex) @ frustum_normals(corners).T
+        return bool(np.any(np.all(offsets < -1e-9, axis=0)))
+
+def morton_codes(points) -> np.ndarray:
+    """
+    Get the Morton (Z-order) codes of points within their bounds, so that sorting by them
+    keeps points that are close in space close in order.
+
+    Parameters:
+        points: The points, (n, 3).
+
+    Returns:
+        np.ndarray: The codes, with MORTON_BITS bits per axis interleaved.
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    if len(points) == 0:
+        return np.zeros(0, dtype=np.int64)
+    lo = points.min(axis=0)
+    extent = np.maximum(points.max(axis=0) - lo, OPTIMIZE_TOLERANCE)
+    cells = np.minimum(((points - lo) / extent * (1 << MORTON_BITS)).astype(np.int64), (1 << MORTON_BITS) - 1)
+    codes = np.zeros(len(points), dtype=np.int64)
+    for bit in range(MORTON_BITS):
+        for axis in range(3):
+            codes |= ((cells[:, axis] >> bit) & 1) << (3 * bit + axis)
+    return codes
+
+def optimize_scene(shapes, tolerance=OPTIMIZE_TOLERANCE):
+    """
+    Reduce the number of primitives every ray is tested against, without changing what the
+    scene looks like:
+
+    - triangle and quad corners are welded, so primitives sharing a vertex share its array,
+    - degenerate primitives (zero area triangles and quads, zero radius spheres, planes without
+      a normal) and exact duplicates of earlier primitives are dropped,
+    - pairs of triangles with the same material sharing an edge are merged into one quad
+      wherever they form an exact parallelogram,
+    - planes are kept first, and the remaining primitives are sorted along a Morton curve of
+      their centers, so neighbouring primitives land in the same hardware chunks and BVH leaves.
+
+    Mesh instances are already indexed, and are kept as they are at the end of the scene.
+
+    Parameters:
+        shapes: The scene, as loaded by load_scene_from_json.
+        tolerance: How close coordinates must be to be treated as the same.
+
+    Returns:
+        Tuple[List[Shape], dict]: The optimized scene, and a report of what was done: primitive
+        counts by type before and after, vertices before and after welding, the primitives
+        dropped and merged, and the intersection tests per ray before and after.
+    """
+    def counts(scene):
+        result = {}
+        for shape in scene:
+            if isinstance(shape, Shape):
+                name = shape.shape_type.name.lower()
+                result[name] = result.get(name, 0) + 1
+        return result
+
+    def key(values):
+        return tuple(np.round(np.asarray(values, dtype=float).reshape(-1) / tolerance).astype(np.int64))
+
+    def material(shape):
+        return (key(shape.color), shape.specularity, shape.emittance)
+
+    vertex_ids = {}
+    vertices = []
+
+    def weld(point):
+        k = key(point)
+        if k not in vertex_ids:
+            vertex_ids[k] = len(vertices)
+            vertices.append(np.array(point, dtype=float))
+        return vertex_ids[k]
+
+    report = {'before': counts(shapes), 'degenerate': 0, 'duplicate': 0, 'merged': 0}
+    report['vertices_before'] = sum(
+        len(s.corners()) for s in shapes if isinstance(s, Shape) and s.shape_type in (ShapeType.TRIANGLE, ShapeType.QUAD)
+    )
+
+    # Weld the corners, and drop degenerate and duplicate primitives. A later exact duplicate
+    # never wins a hit over the first copy, so dropping it cannot change the render.
+    kept = []
+    seen = set()
+    instanced = []
+    for shape in shapes:
+        if not isinstance(shape, Shape):
+            instanced.append(shape)
+            continue
+        if shape.shape_type in (ShapeType.TRIANGLE, ShapeType.QUAD):
+            if np.linalg.norm(shape.normal(None)) <= tolerance:
+                report['degenerate'] += 1
+                continue
+            ids = [weld(p) for p in shape.corners()]
+            identity = (shape.shape_type, frozenset(ids))
+        elif shape.shape_type == ShapeType.PLANE:
+            ids = None
+            length = np.linalg.norm(shape.coordinates[1])
+            if length <= tolerance:
+                report['degenerate'] += 1
+                continue
+            # The same plane, whichever way its normal faces.
+            unit = np.asarray(shape.coordinates[1], dtype=float) / length
+            unit = unit * np.sign(unit[np.flatnonzero(np.abs(unit) > tolerance)[0]])
+            identity = (shape.shape_type, key(unit), key(np.dot(shape.coordinates[0], unit)))
+        else:
+            ids = None
+            if shape.coordinates[1][0] <= tolerance:
+                report['degenerate'] += 1
+                continue
+            identity = (shape.shape_type, key(shape.coordinates[0]), key(shape.coordinates[1][0]))
+        if identity in seen:
+            report['duplicate'] += 1
+            continue
+        seen.add(identity)
+        kept.append((shape, ids))
+    report['vertices_after'] = len(vertices)
+
+    # Merge triangle pairs across their shared edges. The pair a, b, c and a, b, d is the
+    # parallelogram with corner c and edges towards a and b exactly when a + b = c + d.
+    edges = {}
+    for i, (shape, ids) in enumerate(kept):
+        if shape.shape_type == ShapeType.TRIANGLE:
+            for j in range(3):
+                edges.setdefault(frozenset((ids[j], ids[(j + 1) % 3])), []).append(i)
+    merged_into = {}
+    for i, (shape, ids) in enumerate(kept):
+        if shape.shape_type != ShapeType.TRIANGLE or i in merged_into:
+            continue
+        for j in range(3):
+            a, b, c = ids[j], ids[(j + 1) % 3], ids[(j + 2) % 3]
+            partners = [k for k in edges[frozenset((a, b))] if k != i and k not in merged_into]
+            if not partners:
+                continue
+            other, other_ids = kept[partners[0]]
+            d = next(v for v in other_ids if v not in (a, b))
+            if material(other) != material(shape):
+                continue
+            if np.linalg.norm(vertices[a] + vertices[b] - vertices[c] - vertices[d]) > tolerance:
+                continue
+            # c, a, b runs the same way round as the triangle, so the quad keeps its normal.
+            quad = Shape("quad", shape.color, shape.specularity, shape.emittance, [vertices[c], vertices[a], vertices[b]])
+            kept[i] = (quad, [c, a, b, d])
+            merged_into[partners[0]] = i
+            report['merged'] += 1
+            break
+
+    # Share the welded vertex arrays between primitives, then sort.
+    planes = []
+    bounded = []
+    for i, (shape, ids) in enumerate(kept):
+        if i in merged_into:
+            continue
+        if shape.shape_type == ShapeType.TRIANGLE:
+            shape = Shape("triangle", shape.color, shape.specularity, shape.emittance, [vertices[v] for v in ids])
+        (planes if shape.shape_type == ShapeType.PLANE else bounded).append(shape)
+    centers = [
+        s.coordinates[0] if s.shape_type == ShapeType.SPHERE else s.corners().mean(axis=0)
+        for s in bounded
+    ]
+    order = np.argsort(morton_codes(centers), kind='stable')
+    optimized = planes + [bounded[i] for i in order] + instanced
+
+    report['after'] = counts(optimized)
+    report['tests_before'] = sum(report['before'].values())
+    report['tests_after'] = sum(report['after'].values())
+    return optimized, report
+
+def to_fixed_raw(values) -> np.ndarray:
+    """
+    Quantize values to the raw bits of the kernel's fp_t (ap_fixed<16, 8, AP_TRN, AP_SAT>):
+    truncated towards minus infinity, and saturated to the representable range.
+
+    Parameters:
+        values: The values to quantize.
+
+    Returns:
+        np.ndarray: The raw values, as int16. Divide by 2 ** FIXED_FRAC_BITS for the value.
+    """
+    raw = np.floor(np.asarray(values, dtype=np.float64) * (1 << FIXED_FRAC_BITS))
+    return np.clip(raw, np.iinfo(np.int16).min, np.iinfo(np.int16).max).astype(np.int16)
+
+def pack_rays_compact(origins, dirs) -> np.ndarray:
+    """
+    Pack rays into the compact wire format: origin and direction as six fixed point values
+    and two zero pad values, 16 bytes per ray instead of the 32 of the float format.
+
+    Parameters:
+        origins: The ray origins, (n, 3).
+        dirs: The ray directions, (n, 3).
+
+    Returns:
+        np.ndarray: The packed rays, as a RAY_COMPACT_DTYPE array.
+    """
+    packed = np.zeros(len(origins), dtype=RAY_COMPACT_DTYPE)
+    packed['origin'] = to_fixed_raw(origins)
+    packed['direction'] = to_fixed_raw(dirs)
+    return packed
+
+def unpack_rayhits_compact(data) -> np.ndarray:
+    """
+    Unpack rayhits in the compact wire format: hit point as three fixed point values and a
+    16 bit, one indexed, scene index. 8 bytes per hit instead of the 16 of the float format.
+
+    Parameters:
+        data: The received bytes.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The hit points, (n, 3), and scene indices, (n,).
+    """
+    hits = np.frombuffer(bytes(data), dtype=RAYHIT_COMPACT_DTYPE)
+    return hits['loc'] / (1 << FIXED_FRAC_BITS), hits['scene_index'].astype(np.int64)
+
+def fixed_point_error(origins, dirs) -> dict:
+    """
+    Measure what quantizing rays to the kernel's fixed point format loses against float.
+    The same is lost with the float wire format, where the kernel quantizes on arrival.
+
+    Parameters:
+        origins: The ray origins, (n, 3).
+        dirs: The ray directions, (n, 3).
+
+    Returns:
+        dict: The largest origin error, the largest angle between a direction and its
+        quantized version in degrees, and the number of values that saturated.
+    """
+    origins = np.asarray(origins, dtype=float).reshape(-1, 3)
+    dirs = np.asarray(dirs, dtype=float).reshape(-1, 3)
+    fixed_origins = to_fixed_raw(origins) / (1 << FIXED_FRAC_BITS)
+    fixed_dirs = to_fixed_raw(dirs) / (1 << FIXED_FRAC_BITS)
+    norms = np.linalg.norm(dirs, axis=1) * np.linalg.norm(fixed_dirs, axis=1)
+    cosines = np.sum(dirs * fixed_dirs, axis=1) / np.where(norms == 0, 1, norms)
+    limit = (1 << (15 - FIXED_FRAC_BITS))
+    return {
+        'origin_error': float(np.max(np.abs(origins - fixed_origins), initial=0)),
+        'direction_error': float(np.degrees(np.max(np.arccos(np.clip(cosines, -1, 1)), initial=0))),
+        'saturated': int(np.count_nonzero((origins >= limit) | (origins < -limit)) + np.count_nonzero((dirs >= limit) | (dirs < -limit))),
+    }
+
+class RaycastUnit():
+    """Represents one raycast IP of the overlay, with the DMA feeding it and the scene BRAM behind it."""
+
+    def __init__(self, index, raycast_ip, dma, scene_bram) -> None:
+        """
+        Initialize a new RaycastUnit object.
+
+        Parameters:
+            index: The instance number of the IP in the overlay.
+            raycast_ip: The raycast IP's control interface.
+            dma: The AXI DMA streaming rays to the IP and rayhits back.
+            scene_bram: The BRAM controller of the IP's scene memory.
+        """
+        self.index = index
+        self.raycast_ip = raycast_ip
+        self.dma = dma
+        self.dma_send = dma.sendchannel
+        self.dma_recv = dma.recvchannel
+        self.scene_bram = scene_bram
+        self.input_buffer = None
+        self.output_buffer = None
+        self.hw_batches = 0
+        # The (start, end) slots of the dispatched group in flight on the IP, if any.
+        self.in_flight = None
+        self.rays_cast = 0
+        self.transfers = 0
+
+
+def find_raycast_units(overlay) -> List[RaycastUnit]:
+    """
+    Discover the raycast IPs of an overlay, each with its DMA and scene BRAM.
+    Instance i is raycast_i behind axi_dma_i (or axi_dma, for a single instance) and axi_bram_ctrl_i.
+
+    Parameters:
+        overlay: The loaded overlay.
+
+    Returns:
+        List[RaycastUnit]: The units, in instance order.
+    """
+    units: List[RaycastUnit] = []
+    while True:
+        i = len(units)
+        raycast_ip = getattr(overlay, f'raycast_{i}', None)
+        dma = getattr(overlay, f'axi_dma_{i}', None)
+        if dma is None and i == 0:
+            dma = getattr(overlay, 'axi_dma', None)
+        scene_bram = getattr(overlay, f'axi_bram_ctrl_{i}', None)
+        if raycast_ip is None or dma is None or scene_bram is None:
+            break
+        units.append(RaycastUnit(i, raycast_ip, dma, scene_bram))
+    if not units:
+        raise Exception("The overlay has no raycast IP with a DMA and scene BRAM.")
+    return units
+
+
+def load_scene_from_json(json_blob, base_dir=None):
+    """
+    Load a scene from a JSON blob.
+
+    Parameters:
+        json_blob: The JSON blob to load.
+        base_dir: The directory mesh "file" paths are relative to. Defaults to the working directory.
+
+    Returns:
+        List[Shape]: List of shapes representing the loaded scene. Mesh instances are
+        gathered into one InstancedGeometry at the end of the list.
+    """
+    shapes = []
+    meshes: Dict[str, Mesh] = {}
+    mesh_materials = {}
+    instances = []
+    data = json.loads(json_blob)
+    for obj in data:
+        shape_type = obj['shape_type']
+        if shape_type == "mesh":
+            # Defined once, and only placed in the scene by instances.
+            if 'file' in obj:
+                meshes[obj['name']] = load_mesh_file(os.path.join(base_dir or '', obj['file']), obj['name'])
+            else:
+                meshes[obj['name']] = Mesh(obj['name'], obj['vertices'], obj['faces'])
+            mesh_materials[obj['name']] = obj
+            continue
+        if shape_type == "instance":
+            instances.append(obj)
+            continue
+        color = np.array(obj['color'])
+        specularity = obj['specularity']
+        emittance = obj['emittance']
+        coordinates = [np.array(coord) for coord in obj['coordinates']]
+        shape = Shape(shape_type, color, specularity, emittance, coordinates)
+        shapes.append(shape)
+    if instances:
+        # Instances without their own material take the mesh's.
+        for i, obj in enumerate(instances):
+            material = mesh_materials.get(obj['mesh'], {})
+            instances[i] = {**{key: material[key] for key in ('color', 'specularity', 'emittance') if key in material}, **obj}
+        shapes.append(InstancedGeometry(meshes, instances))
+    return shapes
+
+class PrimaryHitCache():
+    """Represents the first hits of the camera rays through each pixel's fixed sub-pixel positions."""
+
+    def __init__(self, rows, cols, strata, key) -> None:
+        """
+        Initialize a new, empty PrimaryHitCache object.
+
+        Parameters:
+            rows: The render height.
+            cols: The render width.
+            strata: The number of sub-pixel positions along each axis of a pixel.
+            key: The key of the camera, geometry and backend the hits are valid for.
+        """
+        self.cols = cols
+        self.strata = strata
+        self.key = key
+        positions = strata * strata
+        # Stratum j is the center of cell (j % strata, j // strata) of the pixel's grid.
+        cells = np.arange(positions)
+        self.offsets = np.stack([(cells % strata + 0.5) / strata, (cells // strata + 0.5) / strata], axis=1)
+        self.filled = np.zeros((positions, rows * cols), dtype=bool)
+        # Scene index of the hit (-1 for misses), and the instance and triangle for instanced geometry (else -1).
+        self.shape_idx = np.full((positions, rows * cols), -1, dtype=np.int32)
+        self.instance = np.full((positions, rows * cols), -1, dtype=np.int32)
+        self.triangle = np.full((positions, rows * cols), -1, dtype=np.int32)
+        self.points = np.zeros((positions, rows * cols, 3), dtype=np.float32)
+        self.normals = np.zeros((positions, rows * cols, 3), dtype=np.float32)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(a.nbytes for a in (self.filled, self.shape_idx, self.instance, self.triangle, self.points, self.normals))
+
+    def slot(self, ray: Ray) -> tuple:
+        """
+        Get the position of a camera ray's hit in the cache arrays.
+        """
+        return (ray.sample % len(self.offsets), ray.r * self.cols + ray.c)
+
+
+class RenderCache():
+    """
+    Represents an on-disk cache of progressive render state (accumulated sums and sample
+    counts), keyed by Pathtracer.render_key. Entries are evicted least recently used first
+    once the cache grows past its size limit.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_RENDER_CACHE_BYTES):
+        """
+        Initialize a new RenderCache object.
+
+        Parameters:
+            directory: The directory holding the cached renders. Created if missing.
+            max_bytes: The most bytes the cached renders may take up together.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key) -> str:
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def get(self, key):
+        """
+        Look up a cached render, marking it as recently used.
+
+        Parameters:
+            key: The render key.
+
+        Returns:
+            Optional[Tuple[np.ndarray, np.ndarray]]: The accumulated sums and sample counts, if cached.
+        """
+        fname = self.path(key)
+        try:
+            with np.load(fname) as entry:
+                accum, sample_counts = entry["accum"], entry["sample_counts"]
+        except (OSError, ValueError, KeyError):
+            return None
+        os.utime(fname)
+        return accum, sample_counts
+
+    def put(self, key, accum, sample_counts) -> None:
+        """
+        Store a render, replacing any earlier one with the same key, then evict the least
+        recently used renders until the cache fits in max_bytes.
+
+        Parameters:
+            key: The render key.
+            accum: The accumulated sums.
+            sample_counts: The sample counts.
+        """
+        fname = self.path(key)
+        tmp_fname = f"{fname}.tmp"
+        with open(tmp_fname, 'wb') as entry:
+            np.savez_compressed(entry, accum=accum, sample_counts=sample_counts)
+        os.replace(tmp_fname, fname)
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        Delete the least recently used renders until the cache fits in max_bytes.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz"):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+class SubpathVertices():
+    """
+    Represents the vertices at one depth of a wave of bidirectional subpaths, as arrays over
+    the wave's paths. Paths that end before this depth, or end on a light, have no vertex here.
+    """
+
+    def __init__(self, n) -> None:
+        """
+        Initialize a new SubpathVertices object, with no vertices.
+
+        Parameters:
+            n: The number of paths in the wave.
+        """
+        self.valid = np.zeros(n, dtype=bool)
+        self.pos = np.zeros((n, 3))
+        # Unit normals, facing the side the subpath arrived from (the light's own normal on a light).
+        self.normal = np.zeros((n, 3))
+        # The reflectance, as ray_color scatters light: color / 255 * |shape normal| / (2 pi), per sr.
+        self.brdf = np.zeros((n, 3))
+        # The throughput of the subpath up to the vertex.
+        self.alpha = np.zeros((n, 3))
+        # The area density of the vertex, as found from its own subpath's side.
+        self.pdf_fwd = np.zeros(n)
+        # |cos| / distance^2 of the edge to the subpath's next vertex, at this vertex, for the area
+        # density of finding this vertex from the other side.
+        self.geom_next = np.zeros(n)
+
+class RenderSession():
+    """
+    Represents the setup of a pathtracer's renders, kept resident across many renders: the
+    raycast overlay and the DMA buffers of its IPs, the scene uploaded to their scene BRAMs,
+    the wavefront scene arrays and the camera ray directions of each sample. While the session
+    is open, the pathtracer's render methods reuse them, redoing only what a change of scene,
+    camera or buffer size invalidates. Close the session, or use it as a context manager, to
+    free the DMA buffers and release the overlay.
+    """
+
+    def __init__(self, pathtracer, hardware=False, emulate=False, compact_wire=False, bitfile=None, dispatch='queue_depth'):
+        """
+        Initialize a new RenderSession object and attach it to the pathtracer.
+
+        Parameters:
+            pathtracer: The pathtracer rendering in the session.
+            hardware: Load the raycast overlay for the session, as Pathtracer.init_hardware does
+                with the remaining arguments. Without it, a pathtracer already bound to an
+                overlay keeps it after the session closes.
+            emulate: Use the local hw_emulator stand-in instead of pynq.
+            compact_wire: Load the overlay built with the compact fixed point wire format.
+            bitfile: The overlay to load, instead of the one picked by compact_wire.
+            dispatch: How transfers are handed to the raycast IPs, one of DISPATCH_POLICIES.
+        """
+        if pathtracer.session is not None:
+            raise Exception("The pathtracer already has an open RenderSession.")
+        self.pathtracer = pathtracer
+        self.owns_overlay = hardware
+        if hardware:
+            pathtracer.init_hardware(emulate, compact_wire, bitfile, dispatch)
+        # The scene key of what is resident in the scene BRAMs and the wavefront arrays, and
+        # the group size the DMA buffers hold.
+        self.hardware_scene_key: Optional[str] = None
+        self.buffer_group_size: Optional[int] = None
+        self.wave_shapes_key: Optional[str] = None
+        self.wave_shapes: Optional[dict] = None
+        # Camera ray directions per sample, (rows * cols, 3) each, for the camera they were made
+        # for. At most SESSION_CAMERA_SAMPLES of them, or one per primary hit cache position.
+        self.camera_key: Optional[tuple] = None
+        self.camera_dirs: Dict[int, np.ndarray] = {}
+        self.scene_uploads = 0
+        self.scene_reuses = 0
+        self.buffer_allocations = 0
+        self.closed = False
+        pathtracer.session = self
+
+    def __enter__(self) -> "RenderSession":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def scene_key(self) -> str:
+        """
+        Get a hash of the pathtracer's scene, materials included, as those are held by the
+        hardware shapes and the wavefront arrays too.
+
+        Returns:
+            str: The hex digest.
+        """
+        digest = hashlib.sha256()
+        self.pathtracer.digest_scene(digest)
+        return digest.hexdigest()
+
+    def send_scene_to_hardware(self) -> None:
+        """
+        Send the scene to the hardware, unless it is already resident there. A resident scene
+        only has its statistics reset, and keeps the chunk left in the scene BRAMs.
+        """
+        p = self.pathtracer
+        key = self.scene_key()
+        if key == self.hardware_scene_key:
+            p.reset_hardware_stats()
+            self.scene_reuses += 1
+            print(f"Scene already resident on hardware ({len(p.hw_shapes)} shapes in {len(p.hw_chunks)} chunks).")
+            return
+        p.send_scene_to_hardware()
+        self.hardware_scene_key = key
+        self.scene_uploads += 1
+
+    def allocate_buffers(self, group_size) -> None:
+        """
+        Allocate the DMA buffers for groups of rays, unless the ones allocated already are for the same group size.
+
+        Parameters:
+            group_size: The most rays sent at once.
+        """
+        if group_size == self.buffer_group_size:
+            return
+        self.pathtracer.allocate_buffers(group_size)
+        self.buffer_group_size = group_size
+        self.buffer_allocations += 1
+
+    def wavefront_shapes(self) -> dict:
+        """
+        Get the wavefront scene arrays, rebuilding them only when the scene changed.
+
+        Returns:
+            dict: The arrays, as from Pathtracer.wavefront_shapes.
+        """
+        key = self.scene_key()
+        if key != self.wave_shapes_key:
+            self.wave_shapes = self.pathtracer.wavefront_shapes()
+            self.wave_shapes_key = key
+        return self.wave_shapes
+
+    def camera_ray_dirs(self, sample) -> np.ndarray:
+        """
+        Get the camera ray directions of one sample of every pixel, keeping those of the first
+        SESSION_CAMERA_SAMPLES samples for later renders. With the primary hit cache enabled, the
+        directions only depend on the sample's sub-pixel position, so one per position is kept.
+        All samples are dropped when the camera, the resolution, the seed or the primary hit cache
+        settings change.
+
+        Parameters:
+            sample: The index of the sample.
+
+        Returns:
+            np.ndarray: The directions, (rows * cols, 3).
+        """
+        p = self.pathtracer
+        key = (p.rows, p.cols, p.fov, tuple(float(x) for x in p.camera.pos), float(p.camera.pitch), float(p.camera.yaw),
+               p.rng.seed, p.primary_cache_enabled, p.primary_strata)
+        if key != self.camera_key:
+            self.camera_dirs = {}
+            self.camera_key = key
+        if p.primary_cache_enabled:
+            sample %= p.primary_strata ** 2
+        elif sample >= SESSION_CAMERA_SAMPLES:
+            return p.camera_ray_dirs(sample)
+        if sample not in self.camera_dirs:
+            self.camera_dirs[sample] = p.camera_ray_dirs(sample)
+        return self.camera_dirs[sample]
+
+    def close(self) -> None:
+        """
+        Free the DMA buffers, release the overlay if the session loaded it, drop everything kept
+        resident and detach from the pathtracer. Closing twice does nothing.
+        """
+        if self.closed:
+            return
+        p = self.pathtracer
+        p.free_buffers()
+        if self.owns_overlay:
+            p.hw_units = []
+            p.ol = None
+        self.hardware_scene_key = None
+        self.buffer_group_size = None
+        self.wave_shapes = None
+        self.wave_shapes_key = None
+        self.camera_dirs = {}
+        self.camera_key = None
+        p.session = None
+        self.closed = True
+
+class Pathtracer():
+    """Represents a path tracer."""
+
+    def __init__(self, rows=360, cols=480, camera = None) -> None:
+        """
+        Initialize a new Pathtracer object.
+
+        Parameters:
+            camera: The camera to use for rendering.
+        """
+        self.rays_per_pixel = 4
+        self.depth = 4
+        
+        self.rows = rows
+        self.cols = cols
+        self.fov = 90
+        self.camera: Camera = Camera([0, 0, 0], 0, 0, self.rows, self.cols, self.fov) # TODO pass this in from json, as it helps describe the scene to trace.
+
+        self.scene: List[Shape] = []
+
+        # Can be used for accumulating / calculating pixel colors.
+        self.pixels = np.zeros((self.rows, self.cols, 3))
+
+        # Must contain the final pixel colors.
+        self.final_pixels = np.zeros((self.rows, self.cols, 3))
+
+        self.iters = 0
+        self.done = 0
+
+        # Source of all randomness in renders. Replace with a differently seeded CounterRNG for a new noise pattern.
+        self.rng = CounterRNG(0)
+
+        # Auxiliary buffers describing the first hit of each pixel's camera rays, filled in when enabled.
+        # Albedo, normal and depth are averaged over the samples that hit something; misses leave zeros.
+        # Shape ids index into the scene, with -1 for pixels whose first sample missed.
+        self.aovs_enabled = False
+        self.aov_albedo = np.zeros((self.rows, self.cols, 3))
+        self.aov_normal = np.zeros((self.rows, self.cols, 3))
+        self.aov_depth = np.zeros((self.rows, self.cols))
+        self.aov_shape_id = -1 * np.ones((self.rows, self.cols), dtype=np.int32)
+        self.aov_hits = np.zeros((self.rows, self.cols), dtype=np.int32)
+        self.shape_ids = {}
+
+        # Running sum of sample colors and number of samples per pixel, for progressive renders.
+        self.accum = np.zeros((self.rows, self.cols, 3))
+        self.sample_counts = np.zeros((self.rows, self.cols), dtype=np.int32)
+
+        # JSON of the loaded scene, kept so checkpoints can restore it, whether it was optimized,
+        # and the directory its mesh files are relative to.
+        self.scene_json: Optional[str] = None
+        self.scene_optimized = False
+        self.scene_dir: Optional[str] = None
+
+        # Cull the scene once per tile of camera rays, so their first casts only test shapes
+        # the tile can see. Counts of the primary ray-shape tests made and skipped are kept.
+        self.packets_enabled = False
+        self.primary_tests = 0
+        self.primary_tests_saved = 0
+
+        # Record, per pixel, a bitset of the scene indices its paths hit during wavefront
+        # renders (bit i % 64 of word i // 64), so material edits only re-render the pixels
+        # that can see the edited shapes.
+        self.track_touched = False
+        self.touched: Optional[np.ndarray] = None
+
+        # Aim camera rays in render_scene_grouped through primary_strata x primary_strata fixed
+        # positions per pixel, and keep their first hits across passes and renders. The cache
+        # is dropped when the camera, the geometry or the backend changes, but survives depth
+        # and material changes.
+        self.primary_cache_enabled = False
+        self.primary_strata = PRIMARY_STRATA
+        self.primary_cache: Optional[PrimaryHitCache] = None
+
+        # The open RenderSession, if any, keeping the hardware buffers, the uploaded scene,
+        # the wavefront arrays and the camera rays resident across renders.
+        self.session: Optional[RenderSession] = None
+        self.hw_units: List[RaycastUnit] = []
+
+    def load_from_file(self, json_file, optimize=False) -> None:
+        """
+        Load a scene for this pathtracer from a JSON file.
+
+        Parameters:
+            json_file: The JSON file to load. Mesh files it names are relative to its directory.
+            optimize: Whether to run the scene through optimize_scene.
+        """
+        with open(json_file, 'r') as scene_file:
+            json_blob = scene_file.read()
+            self.load_from_json(json_blob, optimize, os.path.dirname(os.path.abspath(json_file)))
+
+    def load_from_json(self, json_blob, optimize=False, base_dir=None) -> None:
+        """
+        Load a scene for this pathtracer from a JSON blob.
+
+        Parameters:
+            json_blob: The JSON blob to load.
+            optimize: Whether to run the scene through optimize_scene, printing its report.
+            base_dir: The directory mesh files are relative to. Defaults to the working directory.
+        """
+        self.scene = load_scene_from_json(json_blob, base_dir)
+        self.scene_json = json_blob
+        self.scene_optimized = optimize
+        self.scene_dir = base_dir
+        if optimize:
+            self.scene, self.optimize_report = optimize_scene(self.scene)
+            report = self.optimize_report
+            saved = 1 - report['tests_after'] / max(report['tests_before'], 1)
+            print(
+                f"Scene optimized: {report['tests_before']} -> {report['tests_after']} primitives "
+                f"({report['degenerate']} degenerate and {report['duplicate']} duplicates dropped, "
+                f"{report['merged']} triangle pairs merged into quads), "
+                f"{report['vertices_before']} -> {report['vertices_after']} vertices; "
+                f"{saved:.0%} fewer intersection tests per ray."
+            )
+
+    def set_camera(self, pos, pitch, yaw, fov=None) -> None:
+        """
+        Replace the camera used for rendering, keeping the current resolution.
+
+        Parameters:
+            pos: The position of the camera.
+            pitch: The pitch of the camera.
+            yaw: The yaw of the camera.
+            fov: The field of view of the camera. Defaults to the pathtracer's fov.
+        """
+        if fov is not None:
+            self.fov = fov
+        self.camera = Camera(np.array(pos), pitch, yaw, self.rows, self.cols, self.fov)
+
+    def cast_ray(self, ray, shapes=None) -> Optional[Intersection]:
+        """
+        Cast a ray into the scene and find the closest intersection.
+
+        Parameters:
+            ray: The ray to cast.
+            shapes: The shapes to test, in scene order. Defaults to the whole scene.
+
+        Returns:
+            Optional[Intersection]: The closest intersection, if it exists.
+        """
+        intersection: Optional[Intersection] = None
+        closest_dist = 99999
+        for shape in (self.scene if shapes is None else shapes):
+            if isect := shape.intersection_with(ray):
+                if isect.dist < closest_dist and isect.dist > MIN_HIT_DIST:
+                    closest_dist = isect.dist
+                    intersection = isect
+        return intersection
+
+    def occluded(self, origins, dirs, max_dists, backend='wavefront') -> np.ndarray:
+        """
+        Check, for a batch of rays, whether anything blocks each one before a given distance.
+        Unlike cast_ray, the search for a ray stops at the first blocker found, whichever it is.
+
+        Parameters:
+            origins: The ray origins, (n, 3).
+            dirs: The ray directions, (n, 3), not necessarily normalized.
+            max_dists: The distance along each ray hits must be nearer than, (n,).
+            backend: One of OCCLUSION_BACKENDS. 'hardware' needs the scene sent with
+                send_scene_to_hardware and the buffers allocated with allocate_buffers.
+
+        Returns:
+            np.ndarray: Per ray, whether a shape is hit further than MIN_HIT_DIST and nearer than its max distance.
+        """
+        origins = np.asarray(origins, dtype=float).reshape(-1, 3)
+        dirs = np.asarray(dirs, dtype=float).reshape(-1, 3)
+        max_dists = np.broadcast_to(np.asarray(max_dists, dtype=float), len(origins))
+        occluded = np.zeros(len(origins), dtype=bool)
+        # Nothing can be hit within MIN_HIT_DIST, so those rays are answered straight away.
+        active = np.nonzero(max_dists > MIN_HIT_DIST)[0]
+        if backend == 'software':
+            fn = self.occluded_in_software
+        elif backend == 'wavefront':
+            fn = self.occluded_wavefront
+        elif backend == 'hardware':
+            fn = self.occluded_in_hardware
+        else:
+            raise Exception(f"Unknown occlusion backend {backend}, expected one of {OCCLUSION_BACKENDS}.")
+        if len(active):
+            occluded[active] = fn(origins[active], dirs[active], max_dists[active])
+        return occluded
+
+    def visible(self, points, targets, backend='wavefront') -> np.ndarray:
+        """
+        Check, for a batch of point pairs, whether nothing lies between the points. Surfaces within
+        MIN_HIT_DIST of either point, such as the ones the points lie on, don't count.
+
+        Parameters:
+            points: The points looked from, (n, 3).
+            targets: The points looked at, (n, 3).
+            backend: One of OCCLUSION_BACKENDS.
+
+        Returns:
+            np.ndarray: Per pair, whether the points see each other.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        dirs = np.asarray(targets, dtype=float).reshape(-1, 3) - points
+        return ~self.occluded(points, dirs, np.linalg.norm(dirs, axis=1) - MIN_HIT_DIST, backend)
+
+    def occluded_in_software(self, origins, dirs, max_dists) -> np.ndarray:
+        """
+        Answer occlusion queries one ray at a time, testing the scene's shapes in order until one
+        blocks the ray. Instances are tested through their BVHs, which stop at the first hit too.
+
+        Parameters:
+            origins: The ray origins, (n, 3).
+            dirs: The ray directions, (n, 3).
+            max_dists: The distance along each ray hits must be nearer than, (n,), each above MIN_HIT_DIST.
+
+        Returns:
+            np.ndarray: Per ray, whether it is blocked.
+        """
+        dir_lens = np.linalg.norm(dirs, axis=1)
+        occluded = np.zeros(len(origins), dtype=bool)
+        for i in range(len(origins)):
+            # Compare ray parameters rather than distances, to skip the norm per hit.
+            t_min = MIN_HIT_DIST / dir_lens[i]
+            t_max = max_dists[i] / dir_lens[i]
+            occluded[i] = any(shape.occludes(origins[i], dirs[i], t_min, t_max) for shape in self.scene)
+        return occluded
+
+    def occluded_wavefront(self, origins, dirs, max_dists) -> np.ndarray:
+        """
+        Answer occlusion queries for whole arrays of rays at once, with the tests of wavefront_extend.
+        Each shape type is only tested against the rays no earlier type blocked, and instances only
+        against the rays no shape blocked, through their BVHs a level at a time.
+
+        Parameters:
+            origins: The ray origins, (n, 3).
+            dirs: The ray directions, (n, 3).
+            max_dists: The distance along each ray hits must be nearer than, (n,), each above MIN_HIT_DIST.
+
+        Returns:
+            np.ndarray: Per ray, whether it is blocked.
+        """
+        shapes = self.wavefront_shapes()
+        dir_lens = np.linalg.norm(dirs, axis=1)
+        t_min = MIN_HIT_DIST / dir_lens
+        t_max = max_dists / dir_lens
+        occluded = np.zeros(len(origins), dtype=bool)
+        # Planes and quads first: they are the walls, which block the most rays for the fewest tests.
+        for kind in ('plane', 'quad', 'triangle', 'sphere'):
+            idx, coords = shapes[kind]
+            if not len(idx):
+                continue
+            active = np.nonzero(~occluded)[0]
+            step = max(WAVEFRONT_EXTEND_ELEMENTS // len(idx), 1)
+            for lo in range(0, len(active), step):
+                rays = active[lo:lo + step]
+                t, ok = intersect_shape_arrays(kind, coords, origins[rays, np.newaxis, :], dirs[rays, np.newaxis, :])
+                ok &= (t > t_min[rays, np.newaxis]) & (t < t_max[rays, np.newaxis])
+                occluded[rays] = np.any(ok, axis=1)
+
+        for scene_idx in shapes['instanced']:
+            active = np.nonzero(~occluded)[0]
+            occluded[active] = self.scene[scene_idx].occludes_arrays(origins[active], dirs[active], t_min[active], t_max[active])
+        return occluded
+
+    def occluded_in_hardware(self, origins, dirs, max_dists) -> np.ndarray:
+        """
+        Answer occlusion queries with the raycast IPs. The IPs only find closest hits, so each
+        ray's hit distance is compared with its max distance; the early exit is per ray set
+        rather than per ray. Spheres are tested on the CPU first and the rays they block are not
+        sent, and with a chunked scene each chunk is only sent the rays no earlier chunk blocked.
+        Rays hit within HW_OCCLUSION_SLACK of their max distance are tested again against the
+        chunk's shapes on the CPU.
+
+        Parameters:
+            origins: The ray origins, (n, 3).
+            dirs: The ray directions, (n, 3).
+            max_dists: The distance along each ray hits must be nearer than, (n,), each above MIN_HIT_DIST.
+
+        Returns:
+            np.ndarray: Per ray, whether it is blocked.
+        """
+        sphere_dist, _ = intersect_spheres(origins, dirs, self.sphere_centers, self.sphere_radii)
+        occluded = sphere_dist < max_dists
+        group_size = self.unit_capacity * self.unit_transfers
+
+        start = self.resident_chunk or 0
+        for chunk_idx in list(range(start, len(self.hw_chunks))) + list(range(start)):
+            active = np.nonzero(~occluded)[0]
+            if not len(active):
+                break
+            if chunk_idx != self.resident_chunk:
+                self.upload_chunk(chunk_idx)
+            self.chunk_passes += 1
+            for lo in range(0, len(active), group_size):
+                group = active[lo:lo + group_size]
+                self.dispatch_send([Ray(origins[i], dirs[i]) for i in group], self.hw_chunks[chunk_idx])
+                for i, hit in zip(group, self.dispatch_recv()):
+                    if hit is None:
+                        continue
+                    dist = np.linalg.norm(hit.pt - origins[i])
+                    if dist < max_dists[i] - HW_OCCLUSION_SLACK:
+                        occluded[i] = True
+                    elif dist < max_dists[i] + HW_OCCLUSION_SLACK:
+                        dir_len = np.linalg.norm(dirs[i])
+                        occluded[i] = any(
+                            shape.occludes(origins[i], dirs[i], MIN_HIT_DIST / dir_len, max_dists[i] / dir_len)
+                            for shape in self.hw_chunks[chunk_idx]
+                        )
+        return occluded
+
+    def packet_shapes(self, row_start, row_end, col_start, col_end) -> List[Shape]:
+        """
+        Get the shapes the camera rays of a tile of pixels can hit.
+
+        Parameters:
+            row_start: The first row of the tile.
+            row_end: One past the last row of the tile.
+            col_start: The first column of the tile.
+            col_end: One past the last column of the tile.
+
+        Returns:
+            List[Shape]: The shapes not culled by the tile's frustum, in scene order.
+        """
+        corners = self.camera.tile_corners(row_start, row_end, col_start, col_end)
+        apex = np.asarray(self.camera.pos, dtype=float)
+        return [shape for shape in self.scene if not shape.outside_frustum(apex, corners)]
+
+    def primary_shapes(self, r, c, bounds, cache) -> Optional[List[Shape]]:
+        """
+        Get the shapes to test the camera rays of a pixel against, when packets are enabled.
+
+        Parameters:
+            r: The row of the pixel.
+            c: The column of the pixel.
+            bounds: The (row_start, row_end, col_start, col_end) of the region being rendered.
+                Tiles are clipped to it.
+            cache: A dict of the tiles culled so far in the region.
+
+        Returns:
+            Optional[List[Shape]]: The shapes, or None to test the whole scene.
+        """
+        if not self.packets_enabled:
+            return None
+        key = (r // PACKET_TILE_SIZE, c // PACKET_TILE_SIZE)
+        if key not in cache:
+            row_start, row_end, col_start, col_end = bounds
+            cache[key] = self.packet_shapes(
+                max(key[0] * PACKET_TILE_SIZE, row_start), min((key[0] + 1) * PACKET_TILE_SIZE, row_end),
+                max(key[1] * PACKET_TILE_SIZE, col_start), min((key[1] + 1) * PACKET_TILE_SIZE, col_end),
+            )
+        return cache[key]
+
+    def reset_aovs(self, mask=None) -> None:
+        """
+        Clear the auxiliary buffers before a render.
+
+        Parameters:
+            mask: The pixels to clear, (rows, cols). Defaults to all of them.
+        """
+        if mask is None:
+            self.aov_albedo = np.zeros((self.rows, self.cols, 3))
+            self.aov_normal = np.zeros((self.rows, self.cols, 3))
+            self.aov_depth = np.zeros((self.rows, self.cols))
+            self.aov_shape_id = -1 * np.ones((self.rows, self.cols), dtype=np.int32)
+            self.aov_hits = np.zeros((self.rows, self.cols), dtype=np.int32)
+        else:
+            self.aov_albedo[mask] = 0
+            self.aov_normal[mask] = 0
+            self.aov_depth[mask] = 0
+            self.aov_shape_id[mask] = -1
+            self.aov_hits[mask] = 0
+        self.shape_ids = {id(shape): i for i, shape in enumerate(self.scene)}
+
+    def hit_source(self, intersection: Intersection) -> tuple:
+        """
+        Get where in the scene a hit comes from, whether a backend returned the scene's own shape
+        or one derived from it (an instance's world space triangle, or half a quad).
+
+        Parameters:
+            intersection: The hit.
+
+        Returns:
+            tuple: The scene index, and the instance and triangle index for instanced geometry
+            (else -1). The scene index is -1 if the shape can't be traced back to the scene.
+        """
+        if intersection.instance is not None:
+            geometry, k, tri = intersection.instance
+            return (self.shape_ids.get(id(geometry), -1), k, tri)
+        shape_id = id(intersection.shape)
+        if shape_id in self.shape_ids:
+            return (self.shape_ids[shape_id], -1, -1)
+        return getattr(self, 'shape_sources', {}).get(shape_id, (-1, -1, -1))
+
+    def record_first_hit(self, ray: Ray, intersection: Intersection, normal) -> None:
+        """
+        Add a camera ray's first hit to the auxiliary buffer sums.
+
+        Parameters:
+            ray: The camera ray.
+            intersection: The ray's first intersection.
+            normal: The normal at the intersection, facing the ray.
+        """
+        r, c = ray.r, ray.c
+        self.aov_albedo[r][c] += intersection.shape.color / 255
+        self.aov_normal[r][c] += normalize(normal)
+        self.aov_depth[r][c] += np.linalg.norm(intersection.pt - ray.pos)
+        if ray.sample == 0:
+            self.aov_shape_id[r][c] = self.hit_source(intersection)[0]
+        self.aov_hits[r][c] += 1
+
+    def record_first_hits(self, pixels, sample, points, origins, normals, colors, shape_idx) -> None:
+        """
+        Add the first hits of a wave of camera rays to the auxiliary buffer sums.
+
+        Parameters:
+            pixels: The pixel indices (row * cols + col) of the rays that hit something.
+            sample: The index of the pixel sample.
+            points: The hit points.
+            origins: The ray origins.
+            normals: The normals at the hit points, facing the rays.
+            colors: The colors of the shapes hit.
+            shape_idx: The scene indices of the shapes hit.
+        """
+        rows, cols = pixels // self.cols, pixels % self.cols
+        norms = np.linalg.norm(normals, axis=1)
+        np.add.at(self.aov_albedo, (rows, cols), colors / 255)
+        np.add.at(self.aov_normal, (rows, cols), normals / np.where(norms == 0, 1, norms)[:, np.newaxis])
+        np.add.at(self.aov_depth, (rows, cols), np.linalg.norm(points - origins, axis=1))
+        if sample == 0:
+            self.aov_shape_id[rows, cols] = shape_idx
+        np.add.at(self.aov_hits, (rows, cols), 1)
+
+    def finish_aovs(self, mask=None) -> None:
+        """
+        Turn the auxiliary buffer sums into averages after a render.
+
+        Parameters:
+            mask: The pixels that were rendered, (rows, cols). Defaults to all of them.
+        """
+        if mask is None:
+            mask = np.ones((self.rows, self.cols), dtype=bool)
+        hits = np.maximum(self.aov_hits[mask], 1)
+        self.aov_albedo[mask] /= hits[:, np.newaxis]
+        self.aov_depth[mask] /= hits
+        norms = np.linalg.norm(self.aov_normal[mask], axis=1)
+        self.aov_normal[mask] /= np.where(norms == 0, 1, norms)[:, np.newaxis]
+
+    def record_touched(self, pixels, shape_idx) -> None:
+        """
+        Mark the shapes hit by a wave of paths in their pixels' touched bitsets.
+
+        Parameters:
+            pixels: The pixel indices (row * cols + col) of the paths that hit something.
+            shape_idx: The scene indices of the shapes hit, -1 where the backend could not tell,
+                which marks every shape.
+        """
+        touched = self.touched.reshape(self.rows * self.cols, -1)
+        known = shape_idx >= 0
+        np.bitwise_or.at(
+            touched,
+            (pixels[known], shape_idx[known] // 64),
+            np.left_shift(np.uint64(1), (shape_idx[known] % 64).astype(np.uint64)),
+        )
+        touched[pixels[~known]] = np.iinfo(np.uint64).max
+
+    def pixels_touching(self, shape_indices) -> np.ndarray:
+        """
+        Get the pixels whose paths hit any of the given shapes in the last tracked render.
+
+        Parameters:
+            shape_indices: The scene indices of the shapes.
+
+        Returns:
+            np.ndarray: The pixel mask, (rows, cols).
+        """
+        if self.touched is None:
+            raise Exception("No touched shapes recorded; render with track_touched set first.")
+        mask = np.zeros((self.rows, self.cols), dtype=bool)
+        for i in shape_indices:
+            mask |= (self.touched[:, :, i // 64] >> np.uint64(i % 64)) & np.uint64(1) == 1
+        return mask
+
+    def path_uniforms(self, pixels, samples) -> np.ndarray:
+        """
+        Get the random numbers for whole paths, for every bounce up to the bounce depth.
+
+        Parameters:
+            pixels: The pixel indices (row * cols + col), as an array.
+            samples: The sample indices, as an array.
+
+        Returns:
+            np.ndarray: Uniforms of shape (len(pixels), len(samples), depth, 4).
+        """
+        return self.rng.uniforms(
+            np.asarray(pixels)[:, np.newaxis, np.newaxis],
+            np.asarray(samples)[np.newaxis, :, np.newaxis],
+            np.arange(self.depth)[np.newaxis, np.newaxis, :],
+        )
+
+    def ray_color(self, ray: Ray, uniforms=None, first_shapes=None):
+        """
+        Get the color of a given ray should it be bounced around the scene
+        subject to the pathtracing algorithm.
+
+        Parameters:
+            ray: The ray to cast.
+            uniforms: The path's uniforms, of shape (depth, 4). Drawn for the ray's pixel and sample if not given.
+            first_shapes: The shapes the first cast can hit, from packet culling. Defaults to the whole scene.
+
+        Returns:
+            np.ndarray: The color of the simulated ray, as an np.ndarray.
+        """
+        if uniforms is None:
+            uniforms = self.path_uniforms([ray.r * self.cols + ray.c], [ray.sample])[0][0]
+        traced_ray = ray
+        traced_color = np.array([255, 255, 255])
+
+        if first_shapes is not None:
+            self.primary_tests += len(first_shapes)
+            self.primary_tests_saved += len(self.scene) - len(first_shapes)
+
+        for bounce_num in range(self.depth):
+            intersection: Optional[Intersection] = self.cast_ray(traced_ray, first_shapes if bounce_num == 0 else None)
+            self.iters += 1
+
+            if intersection is None:
+                return np.array([0, 0, 0])
+
+            shape = intersection.shape 
+
+            if bounce_num == 0 and self.aovs_enabled:
+                first_normal = shape.normal(intersection.pt)
+                if np.dot(first_normal, ray.dir) > 0.0:
+                    first_normal = first_normal * -1
+                self.record_first_hit(ray, intersection, first_normal)
+
+            if (emittance := shape.emittance) > 0:
+                traced_color = color_mult(traced_color, emittance * shape.color)
+                break
+            elif bounce_num == self.depth - 1:
+                # Last bounce needs to hit a light, else the ray will be dark.
+                return np.array([0, 0, 0])
+
+            normal = shape.normal(intersection.pt)
+
+            # If normal vector and ray point in same hemisphere, flip the normal.
+            if np.dot(normal, traced_ray.dir) > 0.0:
+                normal = normal * -1
+
+            # XXX: Ambient light not used at the moment.
+            ambient_color = shape.color * shape.emittance
+            diffuse_dir = hemisphere_vector_from(uniforms[bounce_num][DIM_DIRECTION_U], uniforms[bounce_num][DIM_DIRECTION_V], normal)
+            traced_color = color_mult(traced_color, shape.color) * np.dot(normal, diffuse_dir) # XXX: * 2
+
+            # TODO: Maybe allow for specular bouncing eventually.
+            #       Requires splitting rays, or randomly selecting if to do diffuse or spec bouncing.
+
+            traced_ray = Ray(intersection.pt, diffuse_dir)
+
+        return traced_color
+
+    def init_hardware(self, emulate=False, compact_wire=False, bitfile=None, dispatch='queue_depth'):
+        """
+        Load the raycast overlay and bind its raycast IPs, each with its DMA and scene BRAM.
+
+        Parameters:
+            emulate: Use the local hw_emulator stand-in instead of pynq, for running off the board.
+            compact_wire: Load the overlay built with the compact fixed point wire format, and
+                send rays and receive rayhits in it.
+            bitfile: The overlay to load, instead of the one picked by compact_wire. Overlays with
+                several raycast IPs are driven as one, with the scene broadcast to every IP.
+            dispatch: How transfers are handed to the IPs, one of DISPATCH_POLICIES: 'round_robin'
+                cycles through them, 'queue_depth' gives the next transfer to the first idle one.
+        """
+        global allocate
+        if emulate:
+            from hw_emulator import Overlay
+            from hw_emulator import allocate
+        else:
+            from pynq import Overlay
+            from pynq import allocate
+
+        if dispatch not in DISPATCH_POLICIES:
+            raise Exception(f"Unknown dispatch policy {dispatch}, expected one of {DISPATCH_POLICIES}.")
+        if bitfile is None:
+            bitfile = RAYCAST_COMPACT_BITFILE if compact_wire else RAYCAST_BITFILE
+        self.ol = Overlay(bitfile)
+        self.compact_wire = compact_wire
+        if compact_wire:
+            self.ray_bytes = RAY_COMPACT_DTYPE.itemsize
+            self.rayhit_bytes = RAYHIT_COMPACT_DTYPE.itemsize
+        else:
+            self.ray_bytes = RAY_FIELDS * FIELD_WIDTH
+            self.rayhit_bytes = RAYHIT_FIELDS * FIELD_WIDTH
+
+        self.hw_units = find_raycast_units(self.ol)
+        self.dispatch_policy = dispatch
+        self.next_unit = 0
+
+        # The first unit is also bound directly, as in single IP overlays.
+        self.raycast_ip = self.hw_units[0].raycast_ip
+        self.dma = self.hw_units[0].dma
+        self.dma_send = self.hw_units[0].dma_send
+        self.dma_recv = self.hw_units[0].dma_recv
+
+        self.scene_bram = self.hw_units[0].scene_bram
+        if len(self.hw_units) > 1:
+            print(f"Found {len(self.hw_units)} raycast IPs, dispatching by {dispatch}.")
+
+    def partition_scene(self):
+        """
+        Split the scene into the shapes the hardware can intersect (planes and triangles)
+        and the spheres, which are intersected on the CPU.
+        """
+        # The hardware has no instancing or quads, so instances and quads are sent as world space triangles.
+        # The scene index, instance and triangle each came from are kept in shape_sources, by id.
+        shapes: List[Shape] = []
+        self.shape_sources: Dict[int, tuple] = {}
         for i, shape in enumerate(self.scene):
+            if isinstance(shape, InstancedGeometry):
+                derived = shape.flatten()
+                sources = [(i, k, tri) for k in range(len(shape)) for tri in range(len(shape.meshes[shape.mesh_index[k]].faces))]
+            else:
+                derived = shape.triangles()
+                sources = [(i, -1, -1)] * len(derived)
+            shapes.extend(derived)
+            self.shape_sources.update((id(s), source) for s, source in zip(derived, sources))
+        self.hw_shapes: List[Shape] = [s for s in shapes if s.shape_type != ShapeType.SPHERE]
+        self.sphere_shapes: List[Shape] = [s for s in shapes if s.shape_type == ShapeType.SPHERE]
+        self.sphere_centers = np.array([s.coordinates[0] for s in self.sphere_shapes], dtype=float).reshape(-1, 3)
+        self.sphere_radii = np.array([s.coordinates[1][0] for s in self.sphere_shapes], dtype=float)
+
+    def require_hardware(self) -> None:
+        """
+        Check that the pathtracer is bound to raycast IPs, which a closed RenderSession that
+        loaded the overlay unbinds.
+        """
+        if not self.hw_units:
+            raise Exception("Hardware not initialized; call init_hardware first.")
+
+    def send_scene_to_hardware(self):
+        self.require_hardware()
+        self.partition_scene()
+        # Scenes larger than the BRAM are uploaded one chunk at a time as rays are cast.
+        self.hw_chunks: List[List[Shape]] = [
+            self.hw_shapes[i:i + MAX_SCENE_OBJECTS] for i in range(0, len(self.hw_shapes), MAX_SCENE_OBJECTS)
+        ] or [[]]
+        self.resident_chunk: Optional[int] = None
+        self.reset_hardware_stats()
+        self.upload_chunk(0)
+        print(f"Scene synced to hardware ({len(self.hw_shapes)} shapes in {len(self.hw_chunks)} chunks).")
+
+    def reset_hardware_stats(self) -> None:
+        """
+        Reset the chunk, wire format and per IP statistics reported after hardware renders.
+        """
+        self.chunk_passes = 0
+        self.chunk_uploads = 0
+        self.chunk_upload_bytes = 0
+        self.chunk_upload_time = 0.0
+        self.wire_rays = 0
+        self.wire_error = {'origin_error': 0.0, 'direction_error': 0.0, 'saturated': 0}
+        for unit in self.hw_units:
+            unit.in_flight = None
+            unit.rays_cast = 0
+            unit.transfers = 0
+
+    def upload_chunk(self, chunk_idx) -> None:
+        """
+        Write one chunk of the hardware shapes to the scene BRAM of every raycast IP, clearing
+        the slots it doesn't fill.
+
+        Parameters:
+            chunk_idx: The index of the chunk in hw_chunks.
+        """
+        t0 = time()
+        chunk = self.hw_chunks[chunk_idx]
+        for i in range(MAX_SCENE_OBJECTS):
+            if i < len(chunk):
+                data = chunk[i].tobytes()
+            elif self.resident_chunk is not None and i >= len(self.hw_chunks[self.resident_chunk]):
+                # Already empty.
+                continue
+            else:
+                data = struct.pack('fffffffffc0i', *([0.0] * 9), bytes([SHAPETYPE_NOTHING]))
             # 64 byte offset from one shape to the next
-            self.scene_bram.write(64 * i, shape.tobytes())
-        print("Scene synced to hardware.")
+            for unit in self.hw_units:
+                unit.scene_bram.write(SHAPE_STRIDE * i, data)
+                self.chunk_upload_bytes += len(data)
+        self.resident_chunk = chunk_idx
+        self.chunk_uploads += 1
+        self.chunk_upload_time += time() - t0
+
+    def hardware_send(self, rays, unit=None) -> None:
+        """
+        Start casting a group of rays on one raycast IP. Returns as soon as the DMA transfers are started.
+
+        Parameters:
+            rays: The rays to cast, at most as many as fit in the unit's input buffer.
+            unit: The RaycastUnit to cast on. Defaults to the first.
+        """
+        unit = unit or self.hw_units[0]
+        if self.compact_wire:
+            origins = np.array([ray.pos for ray in rays], dtype=float).reshape(-1, 3)
+            dirs = np.array([ray.dir for ray in rays], dtype=float).reshape(-1, 3)
+            packed = pack_rays_compact(origins, dirs).view(np.uint8)
+            unit.input_buffer[:len(packed)] = packed.view(unit.input_buffer.dtype)
+            error = fixed_point_error(origins, dirs)
+            self.wire_rays += len(rays)
+            self.wire_error['saturated'] += error['saturated']
+            for key in ('origin_error', 'direction_error'):
+                self.wire_error[key] = max(self.wire_error[key], error[key])
+        else:
+            for i, ray in enumerate(rays):
+                struct.pack_into('ffffff', unit.input_buffer, i * self.ray_bytes, *ray.pos, *ray.dir)
+
+        # Only transfer the batches holding rays; the kernel works on whole batches.
+        unit.hw_batches = -(-len(rays) // NUM_PLL)
+        unit.transfers += 1
+        unit.raycast_ip.write(START_CONTROL_REG, 0x1)
+        unit.dma_send.transfer(unit.input_buffer, nbytes=unit.hw_batches * NUM_PLL * self.ray_bytes)
+        unit.dma_recv.transfer(unit.output_buffer, nbytes=unit.hw_batches * NUM_PLL * self.rayhit_bytes)
+
+    def hardware_recv(self, shapes=None, unit=None) -> List[Optional[Intersection]]:
+        """
+        Wait for a raycast IP to finish the group of rays started with hardware_send and collect the hits.
+
+        Parameters:
+            shapes: The shapes resident in the scene BRAM. Defaults to hw_shapes.
+            unit: The RaycastUnit the rays were sent to. Defaults to the first.
+
+        Returns:
+            List[Optional[Intersection]]: The intersection for each ray slot in the batch.
+        """
+        if shapes is None:
+            shapes = self.hw_shapes
+        unit = unit or self.hw_units[0]
+        unit.dma_send.wait()
+        unit.dma_recv.wait()
+
+        intersections = []
+
+        received = unit.output_buffer[:unit.hw_batches * NUM_PLL * self.rayhit_bytes]
+        if self.compact_wire:
+            points, indices = unpack_rayhits_compact(received)
+            rayhit_iter = ((*point, scene_idx) for point, scene_idx in zip(points, indices))
+        else:
+            rayhit_iter = struct.iter_unpack('fffi', received)
+
+        for rayhit in rayhit_iter:
+            (x, y, z, scene_idx) = rayhit
+            if scene_idx == 0: # Scene hits from hardware returned one indexed so that 0 repr. no hit.
+                intersections.append(None)
+                continue
+            intersections.append(Intersection(np.array([x,y,z]), shapes[scene_idx - 1], 0))
+
+        return intersections
+
+    def dispatch_send(self, rays, shapes=None) -> None:
+        """
+        Start casting a group of rays on the raycast IPs. The group is split into transfers of
+        at most unit_capacity rays, queued by the dispatch policy, and one is started on each IP;
+        dispatch_poll starts the rest as the IPs finish.
+
+        Parameters:
+            rays: The rays to cast, at most as many as allocate_buffers was given.
+            shapes: The shapes resident in the scene BRAMs. Defaults to hw_shapes.
+        """
+        n = len(rays)
+        self.dispatch_rays = rays
+        self.dispatch_shapes = shapes
+        self.dispatch_results: List[Optional[Intersection]] = [None] * n
+        # Split short groups finer too, so that every IP gets a share of them.
+        size = min(self.unit_capacity, -(-n // (self.unit_transfers * NUM_PLL)) * NUM_PLL)
+        transfers = [(start, min(start + size, n)) for start in range(0, n, size)]
+        if self.dispatch_policy == 'round_robin':
+            # Carry on the rotation from the previous group, so short groups don't all land on the first IP.
+            self.dispatch_queues = [deque() for _ in self.hw_units]
+            for k, transfer in enumerate(transfers):
+                self.dispatch_queues[(self.next_unit + k) % len(self.hw_units)].append(transfer)
+            self.next_unit = (self.next_unit + len(transfers)) % len(self.hw_units)
+        else:
+            shared = deque(transfers)
+            self.dispatch_queues = [shared] * len(self.hw_units)
+        self.dispatch_start()
+
+    def dispatch_start(self) -> None:
+        """
+        Start the next queued transfer on every idle raycast IP.
+        """
+        units = len(self.hw_units)
+        # Offer queue depth work to the idle IPs in turn, rather than always to the first.
+        first = 0 if self.dispatch_policy == 'round_robin' else self.next_unit
+        for k in range(units):
+            i = (first + k) % units
+            unit, queue = self.hw_units[i], self.dispatch_queues[i]
+            if unit.in_flight is None and queue:
+                start, end = queue.popleft()
+                self.hardware_send(self.dispatch_rays[start:end], unit)
+                unit.in_flight = (start, end)
+                if self.dispatch_policy == 'queue_depth':
+                    self.next_unit = (i + 1) % units
+
+    def dispatch_poll(self, block=False) -> bool:
+        """
+        Collect the transfers the raycast IPs have finished, in whatever order they finish,
+        and start queued transfers on the IPs they free.
+
+        Parameters:
+            block: Wait for a transfer when none has finished and only one is in flight,
+                rather than returning straight away.
+
+        Returns:
+            bool: Whether the whole group started with dispatch_send is done.
+        """
+        in_flight = [unit for unit in self.hw_units if unit.in_flight is not None]
+        finished = [unit for unit in in_flight if unit.dma_recv.idle]
+        if block and not finished and len(in_flight) == 1:
+            finished = in_flight
+        for unit in finished:
+            start, end = unit.in_flight
+            unit.in_flight = None
+            self.dispatch_results[start:end] = self.hardware_recv(self.dispatch_shapes, unit)[:end - start]
+            unit.rays_cast += end - start
+        self.dispatch_start()
+        return all(unit.in_flight is None for unit in self.hw_units) and not any(self.dispatch_queues)
+
+    def dispatch_recv(self) -> List[Optional[Intersection]]:
+        """
+        Wait for the group of rays started with dispatch_send to finish on every raycast IP.
+
+        Returns:
+            List[Optional[Intersection]]: The intersection for each ray of the group.
+        """
+        while not self.dispatch_poll(block=True):
+            pass
+        results = self.dispatch_results
+        # Don't keep the group's rays and intersections alive after it is handed back.
+        self.dispatch_rays = self.dispatch_shapes = self.dispatch_results = None
+        return results
+
+    def hardware_send_recv(self, rays) -> List[Optional[Intersection]]:
+        self.dispatch_send(rays)
+        return self.dispatch_recv()
+
+    def hybrid_send_recv(self, rays) -> List[Optional[Intersection]]:
+        """
+        Cast a group of rays with the planes and triangles on the hardware and the spheres on the CPU.
+        The sphere intersections are computed while the DMA transfers are in flight, and the nearer
+        of the two hits is kept for each ray.
+
+        Parameters:
+            rays: The rays to cast, at most NUM_PLL of them.
+
+        Returns:
+            List[Optional[Intersection]]: The nearest intersection for each ray.
+        """
+        self.dispatch_send(rays)
+        return self.hybrid_recv(rays)
+
+    def hybrid_recv(self, rays) -> List[Optional[Intersection]]:
+        """
+        Intersect the spheres on the CPU for a group of rays started with dispatch_send, then
+        wait for the hardware and keep the nearer of the two hits for each ray.
+
+        Parameters:
+            rays: The rays passed to dispatch_send.
+
+        Returns:
+            List[Optional[Intersection]]: The nearest intersection for each ray.
+        """
+        origins = np.array([ray.pos for ray in rays], dtype=float)
+        dirs = np.array([ray.dir for ray in rays], dtype=float)
+        sphere_dist, sphere_idx = intersect_spheres(origins, dirs, self.sphere_centers, self.sphere_radii)
+
+        hw_intersections = self.dispatch_recv()
+
+        intersections: List[Optional[Intersection]] = []
+        for i, ray in enumerate(rays):
+            hw_hit = hw_intersections[i]
+            hw_dist = np.inf if hw_hit is None else np.linalg.norm(hw_hit.pt - origins[i])
+            if sphere_idx[i] >= 0 and sphere_dist[i] < hw_dist:
+                dist = sphere_dist[i]
+                pt = origins[i] + dirs[i] * (dist / np.linalg.norm(dirs[i]))
+                intersections.append(Intersection(pt, self.sphere_shapes[sphere_idx[i]], dist))
+            else:
+                intersections.append(hw_hit)
+        return intersections
+
+    def software_send_recv(self, rays) -> List[Optional[Intersection]]:
+        intersections: List[Optional[Intersection]] = []
+        for ray in rays:
+            if ray:
+                intersections.append(self.cast_ray(ray))
+
+        return intersections
+
+    def hardware_share(self, group_size) -> int:
+        """
+        Get how many rays of a co-scheduled group to cast on the hardware, so that the CPU
+        finishes its share at about the time the hardware does. Split by the measured
+        throughputs, in whole batches, always leaving some rays to each side to keep measuring it.
+
+        Parameters:
+            group_size: The number of rays in the group.
+
+        Returns:
+            int: The number of rays for the hardware, taken from the front of the group.
+        """
+        if group_size <= NUM_PLL:
+            return group_size
+        if self.hw_rate is None or self.cpu_rate is None:
+            fraction = 0.5
+        else:
+            fraction = self.hw_rate / (self.hw_rate + self.cpu_rate)
+        batches = round(fraction * group_size / NUM_PLL)
+        return min(max(batches * NUM_PLL, NUM_PLL), group_size - 1)
+
+    def coscheduled_send_recv(self, rays) -> List[Optional[Intersection]]:
+        """
+        Cast a group of rays on the hardware and the CPU at once. The hardware's share is
+        started first, the CPU casts the rest against the whole scene while the DMA transfers
+        are in flight, and both throughputs are measured to rebalance the next group.
+
+        Parameters:
+            rays: The rays to cast, at most as many as fit in the input buffer.
+
+        Returns:
+            List[Optional[Intersection]]: The nearest intersection for each ray.
+        """
+        n_hw = self.hardware_share(len(rays))
+        hw_rays, cpu_rays = rays[:n_hw], rays[n_hw:]
+
+        t0 = time()
+        self.dispatch_send(hw_rays)
+        t_sent = time()
+        hw_done = None
+
+        cpu_intersections: List[Optional[Intersection]] = []
+        for ray in cpu_rays:
+            cpu_intersections.append(self.cast_ray(ray))
+            # Keep the IPs fed, and note when the hardware finished, to time it even when it had to wait for the CPU.
+            if hw_done is None and self.dispatch_poll():
+                hw_done = time()
+        t_cpu = time() - t_sent
+
+        if self.sphere_shapes:
+            hw_intersections = self.hybrid_recv(hw_rays)
+        else:
+            hw_intersections = self.dispatch_recv()[:n_hw]
+        if hw_done is None:
+            hw_done = time()
+
+        self.record_rates(n_hw, hw_done - t0, len(cpu_rays), t_cpu)
+        return hw_intersections + cpu_intersections
+
+    def record_rates(self, hw_rays, hw_seconds, cpu_rays, cpu_seconds) -> None:
+        """
+        Update the hardware and CPU throughput estimates with a finished co-scheduled group.
+
+        Parameters:
+            hw_rays: The number of rays cast on the hardware.
+            hw_seconds: How long the hardware took, from packing the rays to the results being ready.
+            cpu_rays: The number of rays cast on the CPU.
+            cpu_seconds: How long the CPU took.
+        """
+        self.cosched_hw_rays += hw_rays
+        self.cosched_cpu_rays += cpu_rays
+        for attr, rays, seconds in (("hw_rate", hw_rays, hw_seconds), ("cpu_rate", cpu_rays, cpu_seconds)):
+            if rays == 0:
+                continue
+            measured = rays / max(seconds, 1e-6)
+            old = getattr(self, attr)
+            setattr(self, attr, measured if old is None else 0.7 * old + 0.3 * measured)
+
+    def trace_ray_group(self, ray_queue, num_pll, send_recv_fn):
+        rays_to_run = min(len(ray_queue), num_pll)
+        traced_rays = [ray_queue.popleft() for _ in range(rays_to_run)]
+
+        self.iters += rays_to_run
+
+        intersections = send_recv_fn(traced_rays)
+
+        uniforms = self.rng.uniforms(
+            [ray.r * self.cols + ray.c for ray in traced_rays],
+            [ray.sample for ray in traced_rays],
+            [ray.bounces for ray in traced_rays],
+        )
+
+        for i, ray in enumerate(traced_rays):
+            intersection = intersections[i]
+
+            if intersection is None:
+                self.pixels[ray.r][ray.c] = np.array([0, 0, 0])
+                self.done += 1
+                continue
+
+            shape = intersection.shape 
+
+            if ray.bounces == 0 and self.aovs_enabled:
+                first_normal = shape.normal(intersection.pt) if intersection.normal is None else intersection.normal
+                if np.dot(first_normal, ray.dir) > 0.0:
+                    first_normal = first_normal * -1
+                self.record_first_hit(ray, intersection, first_normal)
+
+            if (emittance := shape.emittance) > 0:
+                self.pixels[ray.r][ray.c] = color_mult(self.pixels[ray.r][ray.c], emittance * shape.color)
+                self.done += 1
+                continue
+
+            if ray.bounces == self.depth - 1:
+                # Last bounce needs to hit a light, else the ray will be dark.
+                self.pixels[ray.r][ray.c] = np.array([0, 0, 0])
+                self.done += 1
+                continue
+
+            normal = shape.normal(intersection.pt) if intersection.normal is None else intersection.normal
+
+            # If normal vector and ray point in same hemisphere, flip the normal.
+            if np.dot(normal, traced_rays[i].dir) > 0.0:
+                normal = normal * -1
+
+            diffuse_dir = hemisphere_vector_from(uniforms[i][DIM_DIRECTION_U], uniforms[i][DIM_DIRECTION_V], normal)
+            self.pixels[ray.r][ray.c] = color_mult(self.pixels[ray.r][ray.c], shape.color) * np.dot(normal, diffuse_dir) # XXX: * 2
+
+            ray_queue.append(Ray(intersection.pt, diffuse_dir, ray.bounces + 1, ray.r, ray.c, ray.sample))
+
+    def chunked_send_recv(self, rays) -> List[Optional[Intersection]]:
+        """
+        Cast a group of rays against a scene with more hardware shapes than fit in the BRAM.
+        The whole group is streamed through each chunk of shapes in turn, keeping the nearest
+        hit per ray on the host. Each group starts with the chunk left resident by the previous
+        group, saving one upload per group. Spheres are intersected on the CPU while the first
+        chunk is in flight.
+
+        Parameters:
+            rays: The rays to cast, at most as many as fit in the input buffer.
+
+        Returns:
+            List[Optional[Intersection]]: The nearest intersection for each ray.
+        """
+        origins = np.array([ray.pos for ray in rays], dtype=float)
+        dirs = np.array([ray.dir for ray in rays], dtype=float)
+        best_dist = np.full(len(rays), np.inf)
+        intersections: List[Optional[Intersection]] = [None] * len(rays)
+
+        start = self.resident_chunk or 0
+        order = list(range(start, len(self.hw_chunks))) + list(range(start))
+        for pass_num, chunk_idx in enumerate(order):
+            if chunk_idx != self.resident_chunk:
+                self.upload_chunk(chunk_idx)
+            self.dispatch_send(rays, self.hw_chunks[chunk_idx])
+            self.chunk_passes += 1
+            if pass_num == 0 and self.sphere_shapes:
+                sphere_dist, sphere_idx = intersect_spheres(origins, dirs, self.sphere_centers, self.sphere_radii)
+                for i in np.nonzero(sphere_idx >= 0)[0]:
+                    pt = origins[i] + dirs[i] * (sphere_dist[i] / np.linalg.norm(dirs[i]))
+                    intersections[i] = Intersection(pt, self.sphere_shapes[sphere_idx[i]], sphere_dist[i])
+                    best_dist[i] = sphere_dist[i]
+            hits = self.dispatch_recv()
+            for i in range(len(rays)):
+                if hits[i] is None:
+                    continue
+                dist = np.linalg.norm(hits[i].pt - origins[i])
+                if dist < best_dist[i]:
+                    best_dist[i] = dist
+                    intersections[i] = hits[i]
+        return intersections
+
+    def primary_cache_key(self, send_recv_fn) -> str:
+        """
+        Get the key of the primary hits of the current camera, geometry and backend. Materials,
+        the bounce depth and the random number seed are left out, as they don't change where
+        camera rays first hit.
+
+        Parameters:
+            send_recv_fn: The function casting the ray groups.
+
+        Returns:
+            str: The hex digest.
+        """
+        digest = hashlib.sha256()
+        settings = [self.rows, self.cols, self.primary_strata, self.fov, getattr(send_recv_fn, '__name__', repr(send_recv_fn)),
+                    [float(x) for x in self.camera.pos], float(self.camera.pitch), float(self.camera.yaw)]
+        digest.update(json.dumps(settings).encode())
+        self.digest_scene(digest, materials=False)
+        return digest.hexdigest()
+
+    def cached_primary_hit(self, slot) -> Optional[Intersection]:
+        """
+        Get a cached first hit, with the current material of the shape it is on.
+
+        Parameters:
+            slot: The hit's position in the cache arrays, from PrimaryHitCache.slot.
+
+        Returns:
+            Optional[Intersection]: The hit, or None for a cached miss.
+        """
+        cache = self.primary_cache
+        idx = cache.shape_idx[slot]
+        if idx < 0:
+            return None
+        k = cache.instance[slot]
+        shape = self.scene[idx] if k < 0 else self.scene[idx].world_shape(k, cache.triangle[slot])
+        return Intersection(cache.points[slot].astype(float), shape, 0, normal=cache.normals[slot].astype(float))
+
+    def primary_cached_send_recv(self, send_recv_fn):
+        """
+        Wrap a ray group casting function so camera rays are answered from the primary hit
+        cache, and the hits of the camera rays it does cast are added to the cache.
+
+        Parameters:
+            send_recv_fn: The function casting a group of rays.
+
+        Returns:
+            Callable: The wrapped function.
+        """
+        cache = self.primary_cache
+
+        def send_recv(rays) -> List[Optional[Intersection]]:
+            intersections: List[Optional[Intersection]] = [None] * len(rays)
+            to_cast = []
+            for i, ray in enumerate(rays):
+                if ray.bounces == 0 and cache.filled[cache.slot(ray)]:
+                    intersections[i] = self.cached_primary_hit(cache.slot(ray))
+                    self.primary_cache_hits += 1
+                else:
+                    to_cast.append(i)
+            if not to_cast:
+                return intersections
+
+            cast = send_recv_fn([rays[i] for i in to_cast])
+            for i, intersection in zip(to_cast, cast):
+                ray = rays[i]
+                if ray.bounces == 0:
+                    slot = cache.slot(ray)
+                    source = (-1, -1, -1) if intersection is None else self.hit_source(intersection)
+                    if intersection is None or source[0] >= 0:
+                        cache.shape_idx[slot], cache.instance[slot], cache.triangle[slot] = source
+                        if intersection is not None:
+                            cache.points[slot] = intersection.pt
+                            cache.normals[slot] = intersection.shape.normal(intersection.pt)
+                        cache.filled[slot] = True
+                        # Shade from the cached (compact) hit, so later passes see exactly the same one.
+                        intersection = self.cached_primary_hit(slot)
+                intersections[i] = intersection
+            return intersections
+
+        return send_recv
+
+    def camera_ray_dirs(self, sample) -> np.ndarray:
+        """
+        Get the camera ray directions of one sample of every pixel, aimed through the primary
+        hit cache's fixed positions when it is enabled.
+
+        Parameters:
+            sample: The index of the sample.
+
+        Returns:
+            np.ndarray: The directions, (rows * cols, 3), indexed by flat pixel index.
+        """
+        uniforms = self.rng.uniforms(np.arange(self.rows * self.cols), sample, 0)
+        if self.primary_cache_enabled:
+            offsets = self.primary_cache.offsets[sample % len(self.primary_cache.offsets)]
+            uniforms[:, DIM_PIXEL_X] = offsets[0]
+            uniforms[:, DIM_PIXEL_Y] = offsets[1]
+        dirs = np.zeros((self.rows * self.cols, 3))
+        for r in range(self.rows):
+            for c in range(self.cols):
+                u = uniforms[r * self.cols + c]
+                dirs[r * self.cols + c] = self.camera.get_ray_dir(c + u[DIM_PIXEL_X], r + u[DIM_PIXEL_Y])
+        return dirs
+
+    def render_scene_grouped(self, send_recv_fn, group_size=NUM_PLL):
+        """
+        Render the scene using the pathtracing algorithm on hardware.
+
+        Parameters:
+            send_recv_fn: The function casting a group of rays.
+            group_size: The number of rays handed to send_recv_fn at a time.
+        """
+        self.iters = 0
+        self.done = 0
+        print(
+            f"Running the pathtracer with a bounce depth of {self.depth} "
+            f"and {self.rays_per_pixel} rays per pixel."
+        )
+
+        self.final_pixels = np.zeros((self.rows, self.cols, 3))
+        if self.aovs_enabled:
+            self.reset_aovs()
+
+        if self.primary_cache_enabled:
+            key = self.primary_cache_key(send_recv_fn)
+            if self.primary_cache is None or self.primary_cache.key != key:
+                self.primary_cache = PrimaryHitCache(self.rows, self.cols, self.primary_strata, key)
+            self.shape_ids = {id(shape): i for i, shape in enumerate(self.scene)}
+            self.primary_cache_hits = 0
+            send_recv_fn = self.primary_cached_send_recv(send_recv_fn)
+
+        for sample in range(self.rays_per_pixel):
+            rays = deque()
+            self.pixels = 255 * np.ones((self.rows, self.cols, 3))
+
+            print("\rGenerating rays to trace from the camera...", end='')
+
+            # Set up the initial rays.
+            dirs = self.camera_ray_dirs(sample) if self.session is None else self.session.camera_ray_dirs(sample)
+            for r in range(self.rows):
+                for c in range(self.cols):
+                    rays.append(Ray(self.camera.pos, dirs[r * self.cols + c], r=r, c=c, sample=sample))
+
+            t0 = time()
+
+            # Fire and requeue rays until we are done.
+            while len(rays) > 0:
+                self.trace_ray_group(rays, group_size, send_recv_fn)
+                print(
+                    f"\rTraced {self.iters} rays so far. {self.done // self.rays_per_pixel} / {self.rows * self.cols} pixels done. "
+                    f"{self.iters / (time() - t0):.0f} rays per second.",
+                    end=''
+                )
+
+            self.final_pixels += self.pixels
+
+        self.final_pixels = self.final_pixels / self.rays_per_pixel
+        if self.aovs_enabled:
+            self.finish_aovs()
+
+        print()
+        print("Done!", " " * 64)
+        if self.primary_cache_enabled:
+            # Every ray of the render is one intersection query, cast or answered from the cache.
+            cached = self.primary_cache
+            print(
+                f"Primary hit cache answered {self.primary_cache_hits} of {self.iters} ray casts "
+                f"({100 * self.primary_cache_hits / max(self.iters, 1):.1f}% of the intersection work), "
+                f"holding {np.count_nonzero(cached.filled)} hits in {cached.nbytes / 1024 ** 2:.1f} MiB."
+            )
+
+    def wavefront_shapes(self) -> dict:
+        """
+        Gather the scene's planes, spheres and triangles into arrays for whole-array intersection.
+
+        Returns:
+            dict: Per shape type, the scene indices of its shapes and their coordinates, and the
+            materials of all shapes indexed by scene index.
+        """
+        def coords(shape_type, count):
+            idx = np.array([i for i, s in enumerate(self.scene) if getattr(s, 'shape_type', None) == shape_type], dtype=np.int64)
+            points = np.array([np.asarray(self.scene[i].coordinates[:count], dtype=float) for i in idx]).reshape(len(idx), count, 3)
+            return idx, points
+
+        shapes = {
+            'plane': coords(ShapeType.PLANE, 2),
+            'sphere': coords(ShapeType.SPHERE, 2),
+            'triangle': coords(ShapeType.TRIANGLE, 3),
+            'quad': coords(ShapeType.QUAD, 3),
+            'instanced': [i for i, s in enumerate(self.scene) if isinstance(s, InstancedGeometry)],
+            'colors': np.zeros((len(self.scene), 3)),
+            'emittance': np.zeros(len(self.scene)),
+            'normals': np.zeros((len(self.scene), 3)),
+        }
+        for i, shape in enumerate(self.scene):
+            if isinstance(shape, Shape):
+                shapes['colors'][i] = shape.color
+                shapes['emittance'][i] = shape.emittance
+                if shape.shape_type != ShapeType.SPHERE:
+                    shapes['normals'][i] = shape.normal(None if shape.shape_type == ShapeType.PLANE else shape.coordinates[0])
+        return shapes
+
+    def wavefront_extend(self, origins, dirs):
+        """
+        Find the closest hit of every ray at once, intersecting whole arrays of rays and shapes.
+        Planes, spheres, triangles and quads are tested as in Shape.intersection_with, mesh instances
+        through their BVHs, a level at a time for all the rays.
 
-    def hardware_send_recv(self, rays) -> List[Optional[Intersection]]:
-        for i, ray in enumerate(rays):
-            # TODO if using custom fixed point, convert first
-            struct.pack_into('ffffff', self.input_buffer, i * RAY_FIELDS * FIELD_WIDTH, *ray.pos, *ray.dir)
+        Parameters:
+            origins: The ray origins, (n, 3).
+            dirs: The ray directions, (n, 3).
 
-        START_CONTROL_REG = 0x0
-        self.raycast_ip.write(START_CONTROL_REG, 0x1)
-        self.dma_send.transfer(self.input_buffer)
-        self.dma_recv.transfer(self.output_buffer)
+        Returns:
+            Tuple: Per ray, whether it hit, the hit point, the shape's normal there (facing
+            either way), the shape's color and emittance, and the shape's scene index (-1 if none).
+        """
+        shapes = self.wave_shapes
+        n = len(origins)
+        best = np.full(n, 99999.0)
+        best_idx = np.full(n, -1, dtype=np.int64)
+        best_t = np.zeros(n)
+        dir_len = np.linalg.norm(dirs, axis=1)
+        count = max(sum(len(shapes[kind][0]) for kind in ('plane', 'sphere', 'triangle', 'quad')), 1)
+        step = max(WAVEFRONT_EXTEND_ELEMENTS // count, 1)
 
-        intersections = []
+        for lo in range(0, n, step):
+            o = origins[lo:lo + step, np.newaxis, :]
+            d = dirs[lo:lo + step, np.newaxis, :]
+            candidates = []
 
-        rayhit_iter = struct.iter_unpack('fffi', self.output_buffer)
+            for kind in ('plane', 'sphere', 'triangle', 'quad'):
+                idx, coords = shapes[kind]
+                if len(idx):
+                    candidates.append((idx, *intersect_shape_arrays(kind, coords, o, d)))
 
-        for rayhit in rayhit_iter:
-            (x, y, z, scene_idx) = rayhit
-            if scene_idx == 0: # Scene hits from hardware returned one indexed so that 0 repr. no hit.
-                intersections.append(None)
+            for idx, t, ok in candidates:
+                dist = np.abs(t) * dir_len[lo:lo + step, np.newaxis]
+                dist = np.where(ok & (dist > MIN_HIT_DIST), dist, np.inf)
+                nearest = np.argmin(dist, axis=1)
+                nearest_dist = dist[np.arange(len(dist)), nearest]
+                # Ties keep the shape earliest in the scene, like cast_ray.
+                better = (nearest_dist < best[lo:lo + step]) | (
+                    (nearest_dist == best[lo:lo + step]) & (idx[nearest] < best_idx[lo:lo + step])
+                )
+                best[lo:lo + step] = np.where(better, nearest_dist, best[lo:lo + step])
+                best_idx[lo:lo + step] = np.where(better, idx[nearest], best_idx[lo:lo + step])
+                best_t[lo:lo + step] = np.where(better, t[np.arange(len(t)), nearest], best_t[lo:lo + step])
+
+        hit = best_idx >= 0
+        points = origins + dirs * best_t[:, np.newaxis]
+        normals = shapes['normals'][best_idx]
+        colors = shapes['colors'][best_idx]
+        emittance = np.where(hit, shapes['emittance'][best_idx], 0)
+        spheres = hit & np.isin(best_idx, shapes['sphere'][0])
+        if np.any(spheres):
+            centers = np.array([self.scene[i].coordinates[0] for i in best_idx[spheres]], dtype=float)
+            to_point = points[spheres] - centers
+            normals[spheres] = to_point / np.linalg.norm(to_point, axis=1)[:, np.newaxis]
+
+        for scene_idx in shapes['instanced']:
+            geometry = self.scene[scene_idx]
+            t, k, tri = geometry.intersect_arrays(origins, dirs, MIN_HIT_DIST / dir_len, best / dir_len)
+            nearer = np.flatnonzero(k >= 0)
+            if not len(nearer):
                 continue
-            intersections.append(Intersection(np.array([x,y,z]), self.scene[scene_idx - 1], 0))
+            best[nearer] = t[nearer] * dir_len[nearer]
+            hit[nearer] = True
+            points[nearer] = origins[nearer] + t[nearer, np.newaxis] * dirs[nearer]
+            coords = geometry.world_triangles(k[nearer], tri[nearer])
+            normals[nearer] = np.cross(coords[:, 1] - coords[:, 0], coords[:, 2] - coords[:, 0])
+            colors[nearer] = geometry.colors[k[nearer]]
+            emittance[nearer] = geometry.emittance[k[nearer]]
+            best_idx[nearer] = scene_idx
 
-        return intersections
+        best_idx[~hit] = -1
+        return hit, points, normals, colors, emittance, best_idx
 
-    def software_send_recv(self, rays) -> List[Optional[Intersection]]:
-        intersections: List[Optional[Intersection]] = []
-        for ray in rays:
-            if ray:
-                intersections.append(self.cast_ray(ray))
+    def send_recv_extend(self, send_recv_fn, group_size=NUM_PLL):
+        """
+        Wrap a ray group casting function, such as hardware_send_recv, for the extend step of
+        render_scene_wavefront.
 
-        return intersections
+        Parameters:
+            send_recv_fn: The function casting a group of rays.
+            group_size: The number of rays handed to send_recv_fn at a time.
 
-    def trace_ray_group(self, ray_queue, num_pll, send_recv_fn):
-        rays_to_run = min(len(ray_queue), num_pll)
-        traced_rays = [ray_queue.popleft() for _ in range(rays_to_run)]
+        Returns:
+            Callable: An extend function, returning the same arrays as wavefront_extend.
+        """
+        def extend(origins, dirs):
+            n = len(origins)
+            rays = [Ray(origins[i], dirs[i]) for i in range(n)]
+            intersections: List[Optional[Intersection]] = []
+            for start in range(0, n, group_size):
+                group = rays[start:start + group_size]
+                intersections.extend(send_recv_fn(group)[:len(group)])
 
-        self.iters += rays_to_run
+            hit = np.zeros(n, dtype=bool)
+            points = np.zeros((n, 3))
+            normals = np.zeros((n, 3))
+            colors = np.zeros((n, 3))
+            emittance = np.zeros(n)
+            shape_idx = np.full(n, -1, dtype=np.int64)
+            for i, isect in enumerate(intersections):
+                if isect is None:
+                    continue
+                hit[i] = True
+                points[i] = isect.pt
+                normals[i] = isect.shape.normal(isect.pt)
+                colors[i] = isect.shape.color
+                emittance[i] = isect.shape.emittance
+                shape_idx[i] = self.hit_source(isect)[0]
+            return hit, points, normals, colors, emittance, shape_idx
 
-        intersections = send_recv_fn(traced_rays)
+        return extend
 
-        for i, ray in enumerate(traced_rays):
-            intersection = intersections[i]
+    def trace_wave(self, pixel, sample, extend_fn, frame, rng=None, frame_pixels=None) -> tuple:
+        """
+        Trace one sample of a wave of pixels with the wavefront integrator, from the camera
+        rays to the last bounce, adding the light each path reaches to the frame.
 
-            if intersection is None:
-                self.pixels[ray.r][ray.c] = np.array([0, 0, 0])
-                self.done += 1
-                continue
+        Parameters:
+            pixel: The flat indices of the wave's pixels.
+            sample: The index of the sample.
+            extend_fn: The intersection backend, as for render_scene_wavefront.
+            frame: The summed colors of all pixels, (rows * cols, 3).
+            rng: The random numbers to use, for threads that need their own CounterRNG. Defaults to rng.
+            frame_pixels: The sorted flat indices of the pixels the frame holds, a row each, for
+                frames covering only some pixels. Defaults to a frame of every pixel.
 
-            shape = intersection.shape 
+        Returns:
+            Tuple[int, int]: The number of rays cast and the number of paths finished.
+        """
+        rng = self.rng if rng is None else rng
+        rays = 0
+        done = 0
+        origins, dirs = self.wave_camera_rays(pixel, sample, rng)
+        throughput = np.full((len(pixel), 3), 255.0)
 
-            if (emittance := shape.emittance) > 0:
-                self.pixels[ray.r][ray.c] = color_mult(self.pixels[ray.r][ray.c], emittance * shape.color)
-                self.done += 1
-                continue
+        for bounce in range(self.depth):
+            if len(pixel) == 0:
+                break
+            # Extend.
+            hit, points, normals, colors, emittance, shape_idx = extend_fn(origins, dirs)
+            rays += len(pixel)
 
-            if ray.bounces == self.depth - 1:
-                # Last bounce needs to hit a light, else the ray will be dark.
-                self.pixels[ray.r][ray.c] = np.array([0, 0, 0])
-                self.done += 1
-                continue
+            # Shade.
+            normals = np.where((np.sum(normals * dirs, axis=1) > 0)[:, np.newaxis], -normals, normals)
+            if bounce == 0 and self.aovs_enabled:
+                self.record_first_hits(pixel[hit], sample, points[hit], origins[hit], normals[hit], colors[hit], shape_idx[hit])
+            if self.track_touched:
+                self.record_touched(pixel[hit], shape_idx[hit])
+            emissive = hit & (emittance > 0)
+            rows = pixel[emissive] if frame_pixels is None else np.searchsorted(frame_pixels, pixel[emissive])
+            np.add.at(frame, rows, throughput[emissive] * emittance[emissive, np.newaxis] * colors[emissive] / 255)
+            # Last bounce needs to hit a light, else the path is dark.
+            alive = hit & ~emissive & (bounce < self.depth - 1)
+            done += len(pixel) - np.count_nonzero(alive)
 
-            normal = shape.normal(intersection.pt)
+            # Compact.
+            pixel = pixel[alive]
+            points = points[alive]
+            normals = normals[alive]
+            throughput = throughput[alive] * colors[alive] / 255
 
-            # If normal vector and ray point in same hemisphere, flip the normal.
-            if np.dot(normal, traced_rays[i].dir) > 0.0:
-                normal = normal * -1
+            uniforms = rng.uniforms(pixel, sample, bounce).reshape(-1, 4)
+            dirs = sphere_vectors_from(uniforms[:, DIM_DIRECTION_U], uniforms[:, DIM_DIRECTION_V])
+            dirs = np.where((np.sum(dirs * normals, axis=1) < 0)[:, np.newaxis], -dirs, dirs)
+            throughput = throughput * np.sum(normals * dirs, axis=1)[:, np.newaxis]
+            origins = points
+        return rays, done
 
-            diffuse_dir = random_hemisphere_vector(normal)
-            self.pixels[ray.r][ray.c] = color_mult(self.pixels[ray.r][ray.c], shape.color) * np.dot(normal, diffuse_dir) # XXX: * 2
+    def wave_camera_rays(self, pixel, sample, rng) -> tuple:
+        """
+        Get the camera rays of one sample of a wave of pixels, jittered within each pixel.
 
-            ray_queue.append(Ray(intersection.pt, diffuse_dir, ray.bounces + 1, ray.r, ray.c))
+        Parameters:
+            pixel: The flat indices of the wave's pixels.
+            sample: The index of the sample.
+            rng: The random numbers to use.
 
-    def render_scene_grouped(self, send_recv_fn):
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The ray origins and unit directions, (n, 3) each.
         """
-        Render the scene using the pathtracing algorithm on hardware.
+        camera_pos = np.asarray(self.camera.pos, dtype=float)
+        uniforms = rng.uniforms(pixel, sample, 0)
+        x = pixel % self.cols + uniforms[:, DIM_PIXEL_X]
+        y = pixel // self.cols + uniforms[:, DIM_PIXEL_Y]
+        dirs = (
+            self.camera.top_left
+            + self.camera.horizontal_delta * x[:, np.newaxis]
+            + self.camera.vert_delta * y[:, np.newaxis]
+        )
+        norms = np.linalg.norm(dirs, axis=1)
+        dirs = dirs / np.where(norms == 0, 1, norms)[:, np.newaxis]
+        return np.broadcast_to(camera_pos, dirs.shape), dirs
+
+    def render_scene_wavefront(self, extend_fn=None, mask=None, threads=None) -> None:
+        """
+        Render the scene with a wavefront integrator. The live paths of a wave are kept as
+        arrays, and each bounce runs as whole-array steps: extend (cast every path's ray),
+        shade (add the paths that hit a light to the framebuffer with np.add.at, and sample
+        the next direction of the others) and compact (keep only the surviving paths).
+
+        Parameters:
+            extend_fn: The intersection backend for the extend step, taking ray origins and
+                directions and returning the arrays wavefront_extend does. Defaults to
+                wavefront_extend; use send_recv_extend to plug in a ray group casting function.
+            mask: The pixels to render, (rows, cols). The other pixels keep their colors (and
+                auxiliary buffers and touched shapes) from earlier renders. Defaults to all pixels.
+            threads: The number of threads tracing waves at once on a thread pool, sharing the
+                scene and the framebuffer. NumPy releases the GIL inside its array kernels, so waves
+                trace in parallel for most of their time. Only wavefront_extend can be used from
+                threads. Defaults to tracing every wave on the calling thread.
         """
+        if threads is not None and extend_fn is not None:
+            raise Exception("Only wavefront_extend can extend waves from threads.")
         self.iters = 0
         self.done = 0
         print(
-            f"Running the pathtracer with a bounce depth of {self.depth} "
+            f"Running the wavefront pathtracer with a bounce depth of {self.depth} "
             f"and {self.rays_per_pixel} rays per pixel."
         )
+        if extend_fn is None:
+            self.wave_shapes = self.wavefront_shapes() if self.session is None else self.session.wavefront_shapes()
+            extend_fn = self.wavefront_extend
+        self.shape_ids = {id(shape): i for i, shape in enumerate(self.scene)}
+        if self.aovs_enabled:
+            self.reset_aovs(mask)
+        if self.track_touched:
+            words = max((len(self.scene) + 63) // 64, 1)
+            if mask is None or self.touched is None or self.touched.shape[2] != words:
+                self.touched = np.zeros((self.rows, self.cols, words), dtype=np.uint64)
+            else:
+                self.touched[mask] = 0
 
-        self.final_pixels = np.zeros((self.rows, self.cols, 3))
+        num_pixels = self.rows * self.cols
+        pixels = np.arange(num_pixels) if mask is None else np.flatnonzero(mask)
+        t0 = time()
+        if threads is not None:
+            frame = self.trace_waves_threaded(pixels, extend_fn, threads, t0)
+        else:
+            frame = np.zeros((num_pixels, 3))
+            for sample in range(self.rays_per_pixel):
+                for start in range(0, len(pixels), WAVEFRONT_SIZE):
+                    rays, done = self.trace_wave(pixels[start:start + WAVEFRONT_SIZE], sample, extend_fn, frame)
+                    self.iters += rays
+                    self.done += done
+                    print(
+                        f"\rTraced {self.iters} rays so far. {self.done // self.rays_per_pixel} / {len(pixels)} pixels done. "
+                        f"{self.iters / (time() - t0):.0f} rays per second.",
+                        end=''
+                    )
 
-        for _ in range(self.rays_per_pixel):
-            rays = deque()
-            self.pixels = 255 * np.ones((self.rows, self.cols, 3))
+        frame = frame.reshape(self.rows, self.cols, 3) / self.rays_per_pixel
+        if mask is None:
+            self.final_pixels = frame
+        else:
+            self.final_pixels = np.where(mask[:, :, np.newaxis], frame, self.final_pixels)
+        if self.aovs_enabled:
+            self.finish_aovs(mask)
+        print()
+        print("Done!", " " * 64)
 
-            print("\rGenerating rays to trace from the camera...", end='')
+    def trace_waves_threaded(self, pixels, extend_fn, threads, t0) -> np.ndarray:
+        """
+        Trace every sample of the given pixels on a pool of threads. Each wave is a set of pixels
+        traced through all of their samples by one thread, so the auxiliary buffers and touched
+        shapes of a pixel are only ever written by one thread, in sample order. A wave's light is
+        summed in a buffer of its own pixels, which is added to the frame under a lock when the
+        wave is done, so the image is the same as a single threaded render's, and each thread
+        only needs memory for the wave it is tracing.
 
-            # Set up the initial rays.
-            for r in range(self.rows):
-                for c in range(self.cols):
-                    rays.append(self.camera.get_random_ray(r, c))
+        Parameters:
+            pixels: The flat indices of the pixels to render.
+            extend_fn: The intersection backend, safe to call from several threads.
+            threads: The number of threads.
+            t0: When the render started, for the progress line.
 
-            t0 = time()
+        Returns:
+            np.ndarray: The summed colors of all pixels, (rows * cols, 3).
+        """
+        size = min(WAVEFRONT_SIZE, max(THREAD_MIN_WAVE_SIZE, -(-len(pixels) // (threads * THREAD_WAVES_PER_THREAD))))
+        size = max(min(size, -(-len(pixels) // threads)), 1)
+        frame = np.zeros((self.rows * self.cols, 3))
+        frame_lock = threading.Lock()
+        local = threading.local()
 
-            # Fire and requeue rays until we are done.
-            while len(rays) > 0:
-                self.trace_ray_group(rays, NUM_PLL, send_recv_fn)
+        def trace(wave):
+            # Small batches of random numbers go through a stateful NumPy bit generator, so each thread needs its own.
+            if not hasattr(local, 'rng'):
+                local.rng = CounterRNG(self.rng.seed)
+            wave_frame = np.zeros((len(wave), 3))
+            rays = done = 0
+            for sample in range(self.rays_per_pixel):
+                wave_rays, wave_done = self.trace_wave(wave, sample, extend_fn, wave_frame, local.rng, frame_pixels=wave)
+                rays += wave_rays
+                done += wave_done
+            with frame_lock:
+                frame[wave] += wave_frame
+            return rays, done
+
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            futures = [pool.submit(trace, pixels[start:start + size]) for start in range(0, len(pixels), size)]
+            for future in as_completed(futures):
+                rays, done = future.result()
+                self.iters += rays
+                self.done += done
                 print(
-                    f"\rTraced {self.iters} rays so far. {self.done // self.rays_per_pixel} / {self.rows * self.cols} pixels done. "
+                    f"\rTraced {self.iters} rays so far on {threads} threads. {self.done // self.rays_per_pixel} / {len(pixels)} pixels done. "
                     f"{self.iters / (time() - t0):.0f} rays per second.",
                     end=''
                 )
+        return frame
 
-            self.final_pixels += self.pixels
+    def bidirectional_lights(self) -> dict:
+        """
+        Gather the lights that the bidirectional integrator's light subpaths can start from: the
+        emissive spheres, triangles and quads, picked in proportion to their power. Planes have no
+        finite area to pick points from, and instanced lights are only found by camera paths.
 
-        self.final_pixels = self.final_pixels / self.rays_per_pixel
+        Returns:
+            dict: The lights' scene indices, kinds and coordinates, the cumulative probabilities of
+            picking each, and per scene index the area density of light subpaths starting there
+            (0 for shapes they can't start from) and the density of the directions they leave in.
+        """
+        lights = {'idx': [], 'kinds': [], 'coords': [], 'power': []}
+        kinds = {ShapeType.SPHERE: 'sphere', ShapeType.TRIANGLE: 'triangle', ShapeType.QUAD: 'quad'}
+        areas = []
+        for i, shape in enumerate(self.scene):
+            if not isinstance(shape, Shape) or shape.emittance <= 0 or shape.shape_type not in kinds:
+                continue
+            kind = kinds[shape.shape_type]
+            coords = np.asarray(shape.coordinates[:2 if kind == 'sphere' else 3], dtype=float)
+            area = sample_shape_points(kind, coords, np.zeros(1), np.zeros(1))[2]
+            if area <= 0:
+                continue
+            lights['idx'].append(i)
+            lights['kinds'].append(kind)
+            lights['coords'].append(coords)
+            lights['power'].append(area * shape.emittance * np.mean(shape.color))
+            areas.append(area)
+        probs = np.array(lights['power']) / max(sum(lights['power']), 1e-12)
+        lights['cdf'] = np.cumsum(probs)
+        lights['area_pdf'] = np.zeros(len(self.scene))
+        lights['area_pdf'][lights['idx']] = probs / np.array(areas)
+        # Flat lights shine from both sides, spheres only outwards.
+        lights['emit_pdf'] = np.full(len(self.scene), 1 / (4 * math.pi))
+        lights['emit_pdf'][[i for i, kind in zip(lights['idx'], lights['kinds']) if kind == 'sphere']] = 1 / (2 * math.pi)
+        return lights
+
+    def trace_camera_subpaths(self, pixel, sample, frame, lights) -> tuple:
+        """
+        Trace one sample of a wave of camera subpaths, as trace_wave does, keeping their vertices.
+        The light of paths that reach a light is added to the frame, weighted against the
+        bidirectional strategies that could have made the same path.
+
+        Parameters:
+            pixel: The flat indices of the wave's pixels.
+            sample: The index of the sample.
+            frame: The summed colors of all pixels, (rows * cols, 3).
+            lights: The lights, from bidirectional_lights.
+
+        Returns:
+            Tuple[List[SubpathVertices], int]: The vertices, the t-th hits of the paths at index
+            t - 1, and the number of rays cast.
+        """
+        n = len(pixel)
+        lane = np.arange(n)
+        origins, dirs = self.wave_camera_rays(pixel, sample, self.rng)
+        throughput = np.full((n, 3), 255.0)
+        vertices: List[SubpathVertices] = []
+        rays = 0
+        cos_out = None
+        for bounce in range(self.depth):
+            if len(lane) == 0:
+                break
+            hit, points, normals, colors, emittance, shape_idx = self.wavefront_extend(origins, dirs)
+            rays += len(lane)
+            normals = np.where((np.sum(normals * dirs, axis=1) > 0)[:, np.newaxis], -normals, normals)
+            if bounce == 0 and self.aovs_enabled:
+                self.record_first_hits(pixel[hit], sample, points[hit], origins[hit], normals[hit], colors[hit], shape_idx[hit])
+            scale = np.linalg.norm(normals, axis=1)
+            unit = normals / np.where(scale == 0, 1, scale)[:, np.newaxis]
+            dist2 = np.sum((points - origins) ** 2, axis=1)
+
+            # Record the hits as the paths' next vertices.
+            vertex = SubpathVertices(n)
+            at = lane[hit]
+            vertex.pos[at] = points[hit]
+            vertex.normal[at] = unit[hit]
+            vertex.brdf[at] = colors[hit] / 255 * scale[hit, np.newaxis] / (2 * math.pi)
+            vertex.alpha[at] = throughput[hit]
+            if bounce == 0:
+                # The camera's density cancels out of every weight, as no strategy connects to the camera.
+                vertex.pdf_fwd[at] = 1
+            else:
+                cos_in = -np.sum(unit * dirs, axis=1)
+                vertex.pdf_fwd[at] = (cos_in / dist2)[hit] / (2 * math.pi)
+                vertices[-1].geom_next[at] = (cos_out / dist2)[hit]
+            vertices.append(vertex)
+
+            emissive = hit & (emittance > 0)
+            if np.any(emissive):
+                at = lane[emissive]
+                light_idx = shape_idx[emissive]
+                # The path's vertices from the light: this hit, then the earlier hits, newest first.
+                light_pdfs, camera_pdfs = [], []
+                if len(vertices) > 1:
+                    light_pdfs.append(lights['area_pdf'][light_idx])
+                    camera_pdfs.append(vertex.pdf_fwd[at])
+                for t in range(len(vertices) - 1, 1, -1):
+                    emit_pdf = lights['emit_pdf'][light_idx] if t == len(vertices) - 1 else 1 / (2 * math.pi)
+                    light_pdfs.append(emit_pdf * vertices[t - 1].geom_next[at])
+                    camera_pdfs.append(vertices[t - 1].pdf_fwd[at])
+                weight = mis_weight(light_pdfs, camera_pdfs, 0)
+                light = emittance[emissive, np.newaxis] * colors[emissive] / 255
+                np.add.at(frame, pixel[at], throughput[emissive] * light * weight[:, np.newaxis])
+            vertex.valid[lane[hit & ~emissive]] = True
+            alive = hit & ~emissive & (bounce < self.depth - 1)
+
+            lane = lane[alive]
+            points = points[alive]
+            normals = normals[alive]
+            unit = unit[alive]
+            throughput = throughput[alive] * colors[alive] / 255
+            uniforms = self.rng.uniforms(pixel[lane], sample, bounce).reshape(-1, 4)
+            dirs = sphere_vectors_from(uniforms[:, DIM_DIRECTION_U], uniforms[:, DIM_DIRECTION_V])
+            dirs = np.where((np.sum(dirs * normals, axis=1) < 0)[:, np.newaxis], -dirs, dirs)
+            throughput = throughput * np.sum(normals * dirs, axis=1)[:, np.newaxis]
+            cos_out = np.sum(unit * dirs, axis=1)
+            origins = points
+        return vertices, rays
+
+    def trace_light_subpaths(self, pixel, sample, lights) -> tuple:
+        """
+        Trace one sample of a wave of light subpaths, one per pixel, each starting from a point
+        picked on a light and scattering like camera paths do. Subpaths end where they miss, hit
+        a light, or have depth - 1 vertices, the most a path of depth hits can take from them.
+
+        Parameters:
+            pixel: The flat indices of the wave's pixels.
+            sample: The index of the sample.
+            lights: The lights, from bidirectional_lights, at least one.
+
+        Returns:
+            Tuple[List[SubpathVertices], np.ndarray, np.ndarray, int]: The vertices, the s-th of
+            the paths at index s - 1; per path, the density of the directions its light emits in,
+            and whether the light only shines outwards; and the number of rays cast.
+        """
+        n = len(pixel)
+        start = SubpathVertices(n)
+        uniforms = self.rng.uniforms(pixel, sample, 0, BLOCK_LIGHT_POINT).reshape(-1, 4)
+        pick = np.searchsorted(lights['cdf'], uniforms[:, DIM_LIGHT_PICK] * lights['cdf'][-1], side='right')
+        pick = np.minimum(pick, len(lights['idx']) - 1)
+        light_idx = np.array(lights['idx'])[pick]
+        one_sided = np.zeros(n, dtype=bool)
+        for k, (kind, coords) in enumerate(zip(lights['kinds'], lights['coords'])):
+            at = pick == k
+            if np.any(at):
+                points, normals, _ = sample_shape_points(
+                    kind, coords, uniforms[at, DIM_LIGHT_POINT_U], uniforms[at, DIM_LIGHT_POINT_V]
+                )
+                start.pos[at] = points
+                start.normal[at] = normals
+                one_sided[at] = kind == 'sphere'
+        start.valid[:] = True
+        start.pdf_fwd[:] = lights['area_pdf'][light_idx]
+        emittance = np.array([self.scene[i].emittance for i in light_idx], dtype=float)
+        colors = np.array([self.scene[i].color for i in light_idx], dtype=float).reshape(n, 3)
+        start.alpha[:] = emittance[:, np.newaxis] * colors / 255 / start.pdf_fwd[:, np.newaxis]
+        emit_pdf = lights['emit_pdf'][light_idx]
+
+        # Emit uniformly over the directions the light shines in.
+        uniforms = self.rng.uniforms(pixel, sample, 0, BLOCK_LIGHT_PATH).reshape(-1, 4)
+        dirs = sphere_vectors_from(uniforms[:, DIM_DIRECTION_U], uniforms[:, DIM_DIRECTION_V])
+        dirs = np.where((one_sided & (np.sum(dirs * start.normal, axis=1) < 0))[:, np.newaxis], -dirs, dirs)
+        cos_out = np.abs(np.sum(start.normal * dirs, axis=1))
+        throughput = start.alpha * (cos_out / emit_pdf)[:, np.newaxis]
+        pdf_dir = emit_pdf
+        origins = start.pos
+        lane = np.arange(n)
+        vertices = [start]
+        rays = 0
+        for bounce in range(1, self.depth - 1):
+            if len(lane) == 0:
+                break
+            hit, points, normals, colors, emittance, _ = self.wavefront_extend(origins, dirs)
+            rays += len(lane)
+            keep = hit & (emittance == 0)
+            normals = np.where((np.sum(normals * dirs, axis=1) > 0)[:, np.newaxis], -normals, normals)
+            scale = np.linalg.norm(normals, axis=1)
+            unit = normals / np.where(scale == 0, 1, scale)[:, np.newaxis]
+            dist2 = np.sum((points - origins) ** 2, axis=1)
+            cos_in = -np.sum(unit * dirs, axis=1)
+
+            vertex = SubpathVertices(n)
+            at = lane[keep]
+            vertex.valid[at] = True
+            vertex.pos[at] = points[keep]
+            vertex.normal[at] = unit[keep]
+            vertex.brdf[at] = colors[keep] / 255 * scale[keep, np.newaxis] / (2 * math.pi)
+            vertex.alpha[at] = throughput[keep]
+            vertex.pdf_fwd[at] = (pdf_dir * cos_in / dist2)[keep]
+            vertices[-1].geom_next[at] = (cos_out / dist2)[keep]
+            vertices.append(vertex)
+
+            lane = lane[keep]
+            points = points[keep]
+            normals = normals[keep]
+            unit = unit[keep]
+            throughput = throughput[keep] * colors[keep] / 255
+            uniforms = self.rng.uniforms(pixel[lane], sample, bounce, BLOCK_LIGHT_PATH).reshape(-1, 4)
+            dirs = sphere_vectors_from(uniforms[:, DIM_DIRECTION_U], uniforms[:, DIM_DIRECTION_V])
+            dirs = np.where((np.sum(dirs * normals, axis=1) < 0)[:, np.newaxis], -dirs, dirs)
+            throughput = throughput * np.sum(normals * dirs, axis=1)[:, np.newaxis]
+            cos_out = np.sum(unit * dirs, axis=1)
+            pdf_dir = 1 / (2 * math.pi)
+            origins = points
+        return vertices, emit_pdf, one_sided, rays
+
+    def connect_subpaths(self, pixel, camera, light, emit_pdf, one_sided, frame) -> int:
+        """
+        Connect every camera subpath vertex to every light subpath vertex of the same path, for
+        the paths of at most depth hits, and add the light of the connections that aren't blocked
+        to the frame, weighted against the other strategies that could have made the same path.
+
+        Parameters:
+            pixel: The flat indices of the wave's pixels.
+            camera: The camera subpath vertices, from trace_camera_subpaths.
+            light: The light subpath vertices, from trace_light_subpaths.
+            emit_pdf: Per path, the density of the directions its light emits in.
+            one_sided: Per path, whether its light only shines outwards.
+            frame: The summed colors of all pixels, (rows * cols, 3).
+
+        Returns:
+            int: The number of connection rays cast.
+        """
+        lanes, light_added, starts, ends = [], [], [], []
+        for t in range(1, len(camera) + 1):
+            y = camera[t - 1]
+            for s in range(1, min(len(light), self.depth - t) + 1):
+                z = light[s - 1]
+                at = np.flatnonzero(y.valid & z.valid)
+                to_light = z.pos[at] - y.pos[at]
+                dist2 = np.sum(to_light ** 2, axis=1)
+                to_light = to_light / np.sqrt(np.where(dist2 == 0, 1, dist2))[:, np.newaxis]
+                cos_y = np.sum(y.normal[at] * to_light, axis=1)
+                cos_z = -np.sum(z.normal[at] * to_light, axis=1)
+                if s == 1:
+                    cos_z = np.where(one_sided[at], cos_z, np.abs(cos_z))
+                # Surfaces only scatter back to the side light arrives from.
+                ok = (cos_y > 0) & (cos_z > 0) & (dist2 > 0)
+                at, dist2, cos_y, cos_z = at[ok], dist2[ok], cos_y[ok], cos_z[ok]
+                if len(at) == 0:
+                    continue
+                f_light = 1 if s == 1 else z.brdf[at]
+                contribution = y.alpha[at] * y.brdf[at] * f_light * z.alpha[at] * (cos_y * cos_z / dist2)[:, np.newaxis]
+
+                # The path's vertices from the light: the light subpath's, then the camera subpath's backwards.
+                light_pdfs = [light[i].pdf_fwd[at] for i in range(s)]
+                camera_pdfs = [light[i].geom_next[at] / (2 * math.pi) for i in range(s - 1)]
+                camera_pdfs.append(cos_z / dist2 / (2 * math.pi))
+                if t >= 2:
+                    light_pdfs.append((emit_pdf[at] if s == 1 else 1 / (2 * math.pi)) * cos_y / dist2)
+                    camera_pdfs.append(y.pdf_fwd[at])
+                    for j in range(t - 1, 1, -1):
+                        light_pdfs.append(camera[j - 1].geom_next[at] / (2 * math.pi))
+                        camera_pdfs.append(camera[j - 1].pdf_fwd[at])
+                weight = mis_weight(light_pdfs, camera_pdfs, s)
+
+                lanes.append(at)
+                light_added.append(contribution * weight[:, np.newaxis])
+                starts.append(y.pos[at])
+                ends.append(z.pos[at])
+        if not lanes:
+            return 0
+        lanes = np.concatenate(lanes)
+        visible = self.visible(np.concatenate(starts), np.concatenate(ends))
+        np.add.at(frame, pixel[lanes[visible]], np.concatenate(light_added)[visible])
+        return len(lanes)
+
+    def render_scene_bidirectional(self) -> None:
+        """
+        Render the scene with a bidirectional path tracer. For each sample of a pixel, a camera
+        subpath is traced as by render_scene_wavefront and a light subpath from a point picked on
+        a light, then every pair of their vertices is connected with a shadow ray. Each path
+        found one way is weighted by the balance heuristic against all the others that could
+        have made it, so the image converges to the same result as render_scene's, with much
+        less noise from lights that camera paths rarely hit. Waves of pixels are traced as
+        whole arrays, as in the wavefront integrator.
 
+        Only emissive spheres, triangles and quads can start light subpaths; light from planes
+        and instances is found by the camera paths alone, as in render_scene_wavefront. Scenes
+        with no other lights are rendered by render_scene_wavefront's waves.
+        """
+        self.iters = 0
+        self.done = 0
+        print(
+            f"Running the bidirectional pathtracer with a bounce depth of {self.depth} "
+            f"and {self.rays_per_pixel} rays per pixel."
+        )
+        self.wave_shapes = self.wavefront_shapes() if self.session is None else self.session.wavefront_shapes()
+        self.shape_ids = {id(shape): i for i, shape in enumerate(self.scene)}
+        lights = self.bidirectional_lights()
+        # Without light subpaths, every path is weighted 1 and found as by the wavefront integrator.
+        bidirectional = bool(lights['idx']) and self.depth > 1
+        if not bidirectional:
+            print("No light subpaths can connect to the camera paths, so only camera paths are traced.")
+        if self.aovs_enabled:
+            self.reset_aovs()
+
+        num_pixels = self.rows * self.cols
+        frame = np.zeros((num_pixels, 3))
+        wave_size = BIDIRECTIONAL_WAVE_SIZE if bidirectional else WAVEFRONT_SIZE
+        t0 = time()
+        for sample in range(self.rays_per_pixel):
+            for start in range(0, num_pixels, wave_size):
+                pixel = np.arange(start, min(start + wave_size, num_pixels))
+                if bidirectional:
+                    camera, rays = self.trace_camera_subpaths(pixel, sample, frame, lights)
+                    light, emit_pdf, one_sided, light_rays = self.trace_light_subpaths(pixel, sample, lights)
+                    rays += light_rays + self.connect_subpaths(pixel, camera, light, emit_pdf, one_sided, frame)
+                else:
+                    rays, _ = self.trace_wave(pixel, sample, self.wavefront_extend, frame)
+                self.iters += rays
+                self.done += len(pixel)
+                print(
+                    f"\rTraced {self.iters} rays so far. {self.done // self.rays_per_pixel} / {num_pixels} pixels done. "
+                    f"{self.iters / (time() - t0):.0f} rays per second.",
+                    end=''
+                )
+
+        self.final_pixels = frame.reshape(self.rows, self.cols, 3) / self.rays_per_pixel
+        if self.aovs_enabled:
+            self.finish_aovs()
         print()
         print("Done!", " " * 64)
 
-    def render_scene_in_hardware(self):
-        self.input_buffer = allocate(shape=(NUM_PLL * RAY_FIELDS * FIELD_WIDTH,), dtype=np.byte)
-        self.output_buffer = allocate(shape=(NUM_PLL * RAYHIT_FIELDS * FIELD_WIDTH,), dtype=np.byte)
+    def render_roi(self, row_start, row_end, col_start=0, col_end=None, extend_fn=None) -> np.ndarray:
+        """
+        Render only a rectangular region of interest with the wavefront integrator, leaving
+        the rest of the image as it was.
+
+        Parameters:
+            row_start: The first row of the region.
+            row_end: One past the last row of the region.
+            col_start: The first column of the region.
+            col_end: One past the last column of the region. Defaults to the image width.
+            extend_fn: The intersection backend, as for render_scene_wavefront.
+
+        Returns:
+            np.ndarray: The region's pixels, cropped out of final_pixels.
+        """
+        if col_end is None:
+            col_end = self.cols
+        mask = np.zeros((self.rows, self.cols), dtype=bool)
+        mask[row_start:row_end, col_start:col_end] = True
+        self.render_scene_wavefront(extend_fn, mask)
+        return self.final_pixels[row_start:row_end, col_start:col_end]
+
+    def rerender_shapes(self, shape_indices, extend_fn=None) -> int:
+        """
+        Re-render, with the wavefront integrator, only the pixels whose paths hit any of the
+        given shapes in the last render, after editing their colors or emittance. Needs a
+        full render with track_touched set first. Paths that never hit an edited shape are
+        unaffected by a material edit, so the result is the same as a full re-render. Moving
+        shapes can change which pixels see them, so geometry edits need a full re-render.
+
+        Parameters:
+            shape_indices: The scene indices of the edited shapes.
+            extend_fn: The intersection backend, as for render_scene_wavefront.
+
+        Returns:
+            int: The number of pixels re-rendered.
+        """
+        mask = self.pixels_touching(shape_indices)
+        if np.any(mask):
+            self.render_scene_wavefront(extend_fn, mask)
+        print(f"Re-rendered {np.count_nonzero(mask)} of {mask.size} pixels.")
+        return int(np.count_nonzero(mask))
+
+    def render_scene_in_hardware(self, wavefront=False):
+        """
+        Render the scene with ray casting on the hardware.
+
+        Parameters:
+            wavefront: Render with render_scene_wavefront rather than render_scene_grouped.
+        """
+        self.prepare_scene_on_hardware()
+
+        if len(self.hw_chunks) > 1:
+            group_size = NUM_PLL * CHUNK_GROUP_BATCHES
+        else:
+            group_size = NUM_PLL
+        if len(self.hw_units) > 1:
+            # Give every raycast IP a transfer of the single IP group size, UNIT_QUEUE_DEPTH times over.
+            group_size *= len(self.hw_units) * UNIT_QUEUE_DEPTH
+        self.prepare_buffers(group_size)
+
+        if wavefront:
+            render = lambda fn, group_size: self.render_scene_wavefront(self.send_recv_extend(fn, group_size))
+        else:
+            render = self.render_scene_grouped
+
+        if len(self.hw_chunks) > 1:
+            render(self.chunked_send_recv, group_size)
+            print(
+                f"Ran {self.chunk_passes} chunk passes over {len(self.hw_chunks)} chunks, "
+                f"with {self.chunk_uploads} BRAM uploads ({self.chunk_upload_bytes / 1024:.1f} KiB) "
+                f"taking {self.chunk_upload_time:.2f} seconds."
+            )
+        elif self.sphere_shapes:
+            render(self.hybrid_send_recv, group_size)
+        else:
+            render(self.hardware_send_recv, group_size)
+        self.report_wire()
+        self.report_units()
+
+    def allocate_buffers(self, group_size) -> None:
+        """
+        Allocate the DMA buffers of every raycast IP for groups of rays, sized for the wire format in use.
+        With several IPs, each group is split into UNIT_QUEUE_DEPTH transfers per IP.
+
+        Parameters:
+            group_size: The most rays sent at once.
+        """
+        self.require_hardware()
+        self.free_buffers()
+        self.unit_transfers = 1 if len(self.hw_units) == 1 else len(self.hw_units) * UNIT_QUEUE_DEPTH
+        self.unit_capacity = -(-group_size // (self.unit_transfers * NUM_PLL)) * NUM_PLL
+        for unit in self.hw_units:
+            unit.input_buffer = allocate(shape=(self.unit_capacity * self.ray_bytes,), dtype=np.byte)
+            unit.output_buffer = allocate(shape=(self.unit_capacity * self.rayhit_bytes,), dtype=np.byte)
+        self.input_buffer = self.hw_units[0].input_buffer
+        self.output_buffer = self.hw_units[0].output_buffer
+
+    def free_buffers(self) -> None:
+        """
+        Free the DMA buffers of every raycast IP, returning their contiguous memory.
+        """
+        for unit in self.hw_units:
+            for buffer in (unit.input_buffer, unit.output_buffer):
+                if buffer is not None:
+                    buffer.freebuffer()
+            unit.input_buffer = None
+            unit.output_buffer = None
+        self.input_buffer = None
+        self.output_buffer = None
+
+    def prepare_scene_on_hardware(self) -> None:
+        """
+        Send the scene to the hardware for a render, through the open RenderSession if any,
+        which skips scenes already resident.
+        """
+        if self.session is None:
+            self.send_scene_to_hardware()
+        else:
+            self.session.send_scene_to_hardware()
+
+    def prepare_buffers(self, group_size) -> None:
+        """
+        Allocate the DMA buffers for a render, through the open RenderSession if any, which
+        keeps buffers already allocated for the group size.
+
+        Parameters:
+            group_size: The most rays sent at once.
+        """
+        if self.session is None:
+            self.allocate_buffers(group_size)
+        else:
+            self.session.allocate_buffers(group_size)
+
+    def report_units(self) -> None:
+        """
+        Print how the rays were shared between the raycast IPs, when there are several.
+        """
+        if len(self.hw_units) < 2:
+            return
+        total = max(sum(unit.rays_cast for unit in self.hw_units), 1)
+        shares = ", ".join(
+            f"raycast_{unit.index}: {unit.rays_cast} rays in {unit.transfers} transfers ({100 * unit.rays_cast / total:.1f}%)"
+            for unit in self.hw_units
+        )
+        print(f"Dispatched by {self.dispatch_policy} to {len(self.hw_units)} raycast IPs: {shares}.")
+
+    def report_wire(self) -> None:
+        """
+        Print how much the compact wire format saved over floats, and what its quantization lost.
+        """
+        if not self.compact_wire or not self.wire_rays:
+            return
+        float_bytes = RAY_FIELDS * FIELD_WIDTH + RAYHIT_FIELDS * FIELD_WIDTH
+        compact_bytes = self.ray_bytes + self.rayhit_bytes
+        print(
+            f"Sent {self.wire_rays} rays in the compact wire format: "
+            f"{self.wire_rays * compact_bytes / 1024:.1f} KiB instead of {self.wire_rays * float_bytes / 1024:.1f} KiB "
+            f"({float_bytes / compact_bytes:.1f}x fewer bytes per ray). Largest quantization errors: "
+            f"{self.wire_error['origin_error']:.4f} in origins, {self.wire_error['direction_error']:.3f} degrees in "
+            f"directions, with {self.wire_error['saturated']} saturated values."
+        )
+
+    def render_scene_coscheduled(self, wavefront=False):
+        """
+        Render the scene with ray casting split between the hardware and the CPU, balanced
+        by their measured throughputs. Scenes too large for the scene BRAM are rendered with
+        render_scene_in_hardware instead.
+
+        Parameters:
+            wavefront: Render with render_scene_wavefront rather than render_scene_grouped.
+        """
+        self.prepare_scene_on_hardware()
+        if len(self.hw_chunks) > 1:
+            print("Scene does not fit in the scene BRAM, rendering in chunks on the hardware only.")
+            return self.render_scene_in_hardware(wavefront)
 
-        self.send_scene_to_hardware()
+        group_size = NUM_PLL * COSCHEDULE_GROUP_BATCHES * len(self.hw_units)
+        self.prepare_buffers(group_size)
 
-        return self.render_scene_grouped(self.hardware_send_recv)
+        self.hw_rate: Optional[float] = None
+        self.cpu_rate: Optional[float] = None
+        self.cosched_hw_rays = 0
+        self.cosched_cpu_rays = 0
+        if wavefront:
+            self.render_scene_wavefront(self.send_recv_extend(self.coscheduled_send_recv, group_size))
+        else:
+            self.render_scene_grouped(self.coscheduled_send_recv, group_size)
+        # A side's rate stays None until a group is split, which small renders may never do.
+        hw_rate, cpu_rate = ("n/a" if rate is None else f"{rate:.0f}" for rate in (self.hw_rate, self.cpu_rate))
+        print(
+            f"Cast {self.cosched_hw_rays} rays on the hardware ({hw_rate} rays per second) "
+            f"and {self.cosched_cpu_rays} on the CPU ({cpu_rate} rays per second)."
+        )
+        self.report_wire()
+        self.report_units()
 
     def render_scene_in_software(self):
         return self.render_scene_grouped(self.software_send_recv)
@@ -633,23 +4412,262 @@ class Pathtracer():
         """
         self.iters = 0
         self.done = 0
+        self.primary_tests = 0
+        self.primary_tests_saved = 0
+        if self.aovs_enabled:
+            self.reset_aovs()
         print(
             f"Running the pathtracer with a bounce depth of {self.depth} "
             f"and {self.rays_per_pixel} rays per pixel."
         )
+        samples = np.arange(self.rays_per_pixel)
+        bounds = (0, self.rows, 0, self.cols)
+        packets = {}
         for r in range(self.rows):
+            row_uniforms = self.path_uniforms(r * self.cols + np.arange(self.cols), samples)
             for c in range(self.cols):
                 pixel_color = np.zeros((3))
-                for _ in range(self.rays_per_pixel):
-                    ray = self.camera.get_random_ray(r, c)
-                    color = self.ray_color(ray)
+                first_shapes = self.primary_shapes(r, c, bounds, packets)
+                for sample in samples:
+                    path = row_uniforms[c][sample]
+                    ray = self.camera.get_sample_ray(r, c, sample, path[0])
+                    color = self.ray_color(ray, path, first_shapes)
                     pixel_color += color
                 pixel_color = pixel_color / self.rays_per_pixel
                 self.pixels[r][c] = pixel_color
             print(f"{(100 * (r + 1) / self.rows):.2f}% done", end='\r')
         self.final_pixels = self.pixels.copy()
+        if self.aovs_enabled:
+            self.finish_aovs()
+        print("Done!", " " * 20)
+        if self.packets_enabled:
+            total = self.primary_tests + self.primary_tests_saved
+            print(
+                f"Packet culling skipped {self.primary_tests_saved} of {total} primary ray-shape tests "
+                f"({100 * self.primary_tests_saved / max(total, 1):.1f}%)."
+            )
+
+    def render_region(self, row_start, row_end, col_start=0, col_end=None, samples=None, first_sample=0) -> np.ndarray:
+        """
+        Render a rectangular region of the image without touching the framebuffers.
+
+        Parameters:
+            row_start: The first row of the region.
+            row_end: One past the last row of the region.
+            col_start: The first column of the region.
+            col_end: One past the last column of the region. Defaults to the image width.
+            samples: The number of rays to fire per pixel. Defaults to rays_per_pixel.
+            first_sample: The index of the first sample to fire, for adding to earlier samples of the same pixels.
+
+        Returns:
+            np.ndarray: The summed (not averaged) colors of the region's pixels.
+        """
+        if col_end is None:
+            col_end = self.cols
+        if samples is None:
+            samples = self.rays_per_pixel
+        sample_ids = np.arange(first_sample, first_sample + samples)
+        region = np.zeros((row_end - row_start, col_end - col_start, 3))
+        bounds = (row_start, row_end, col_start, col_end)
+        packets = {}
+        for r in range(row_start, row_end):
+            row_uniforms = self.path_uniforms(r * self.cols + np.arange(col_start, col_end), sample_ids)
+            for c in range(col_start, col_end):
+                first_shapes = self.primary_shapes(r, c, bounds, packets)
+                for i, sample in enumerate(sample_ids):
+                    path = row_uniforms[c - col_start][i]
+                    ray = self.camera.get_sample_ray(r, c, sample, path[0])
+                    region[r - row_start][c - col_start] += self.ray_color(ray, path, first_shapes)
+        return region
+
+    def render_progressive(self, checkpoint_file=None, checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL) -> None:
+        """
+        Render pass by pass until every pixel has rays_per_pixel samples, adding to the
+        samples already accumulated. Passes are rendered a row at a time, and the running
+        state is checkpointed to a file periodically and when the render finishes.
+        Results in the final_pixels attribute being filled with the rendered image.
+
+        Parameters:
+            checkpoint_file: The file to checkpoint to, if any.
+            checkpoint_interval: The minimum number of seconds between checkpoints.
+        """
+        self.iters = 0
+        print(
+            f"Running the pathtracer with a bounce depth of {self.depth} "
+            f"and {self.rays_per_pixel} rays per pixel."
+        )
+        row_counts = self.sample_counts.min(axis=1)
+        first_pass = int(row_counts.min())
+        last_checkpoint = time()
+        t0 = time()
+
+        # Pass-major order keeps every pixel within one sample of the others, so a
+        # checkpointed image is evenly converged, and sums samples in sample order,
+        # so the result matches an uninterrupted render_scene bit for bit.
+        for sample in range(first_pass, self.rays_per_pixel):
+            for r in range(self.rows):
+                if row_counts[r] > sample:
+                    continue
+                self.accum[r] += self.render_region(r, r + 1, samples=1, first_sample=sample)[0]
+                self.sample_counts[r] += 1
+                row_counts[r] += 1
+                if checkpoint_file is not None and time() - last_checkpoint >= checkpoint_interval:
+                    self.save_checkpoint(checkpoint_file)
+                    last_checkpoint = time()
+            print(
+                f"\rPass {sample + 1} / {self.rays_per_pixel} done. "
+                f"{self.iters / (time() - t0):.0f} rays per second.",
+                end=''
+            )
+
+        self.final_pixels = self.accum / np.maximum(self.sample_counts, 1)[:, :, np.newaxis]
+        if checkpoint_file is not None:
+            self.save_checkpoint(checkpoint_file)
+        print()
         print("Done!", " " * 20)
 
+    def add_samples(self, samples, checkpoint_file=None, checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL) -> None:
+        """
+        Add more samples to every pixel of an existing progressive render, without re-rendering what's done.
+
+        Parameters:
+            samples: The number of rays per pixel to add.
+            checkpoint_file: The file to checkpoint to, if any.
+            checkpoint_interval: The minimum number of seconds between checkpoints.
+        """
+        self.rays_per_pixel = int(self.sample_counts.max()) + samples
+        self.render_progressive(checkpoint_file, checkpoint_interval)
+
+    def render_key(self) -> str:
+        """
+        Get the key identifying this pathtracer's render in a RenderCache: a hash of the
+        loaded (and possibly optimized) scene, the camera, the resolution, the bounce depth
+        and the random number seed. The rays per pixel are left out, so renders of any
+        sample count share a key and can be topped up.
+
+        Returns:
+            str: The hex digest.
+        """
+        digest = hashlib.sha256()
+        settings = [RENDER_CACHE_VERSION, self.rows, self.cols, self.depth, self.rng.seed, self.fov,
+                    [float(x) for x in self.camera.pos], float(self.camera.pitch), float(self.camera.yaw)]
+        digest.update(json.dumps(settings).encode())
+        self.digest_scene(digest)
+        return digest.hexdigest()
+
+    def digest_scene(self, digest, materials=True) -> None:
+        """
+        Add the scene to a hash.
+
+        Parameters:
+            digest: The hashlib hash to update.
+            materials: Whether to include the shapes' colors, specularity and emittance, or only the geometry.
+        """
+        for shape in self.scene:
+            if isinstance(shape, InstancedGeometry):
+                for mesh in shape.meshes:
+                    digest.update(mesh.vertices.tobytes())
+                    digest.update(mesh.faces.tobytes())
+                arrays = [shape.mesh_index, shape.linear, shape.translation]
+                if materials:
+                    arrays += [shape.colors, shape.specularity, shape.emittance]
+                for array in arrays:
+                    digest.update(array.tobytes())
+                continue
+            digest.update(bytes([shape.shape_type]))
+            digest.update(np.concatenate([np.ravel(c) for c in shape.coordinates]).astype(float).tobytes())
+            if materials:
+                digest.update(np.array([*shape.color, shape.specularity, shape.emittance], dtype=float).tobytes())
+
+    def render_cached(self, cache: RenderCache, checkpoint_file=None, checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL) -> None:
+        """
+        Render progressively, starting from the cached samples of the same render if there are
+        any, so only the missing samples are rendered, then store the result in the cache.
+        A cached render with more than rays_per_pixel samples is used as it is.
+        Results in the final_pixels attribute being filled with the rendered image.
+
+        Parameters:
+            cache: The render cache.
+            checkpoint_file: The file to checkpoint to, if any.
+            checkpoint_interval: The minimum number of seconds between checkpoints.
+        """
+        key = self.render_key()
+        cached = cache.get(key)
+        if cached is not None:
+            self.accum, self.sample_counts = cached
+            print(f"Found {int(self.sample_counts.min())} rays per pixel of this render in the cache.")
+        else:
+            self.accum = np.zeros((self.rows, self.cols, 3))
+            self.sample_counts = np.zeros((self.rows, self.cols), dtype=np.int32)
+        if int(self.sample_counts.min()) >= self.rays_per_pixel:
+            self.final_pixels = self.accum / np.maximum(self.sample_counts, 1)[:, :, np.newaxis]
+            return
+        self.render_progressive(checkpoint_file, checkpoint_interval)
+        cache.put(key, self.accum, self.sample_counts)
+
+    def save_checkpoint(self, fname) -> None:
+        """
+        Save the progressive render state to a compressed file.
+        The file is replaced atomically, so a crash mid-save leaves the previous checkpoint intact.
+
+        Parameters:
+            fname: The file to save the checkpoint to.
+        """
+        settings = {
+            "version": CHECKPOINT_VERSION,
+            "rows": self.rows,
+            "cols": self.cols,
+            "depth": self.depth,
+            "rays_per_pixel": self.rays_per_pixel,
+            "seed": self.rng.seed,
+            "fov": self.fov,
+            "camera": {
+                "pos": [float(x) for x in self.camera.pos],
+                "pitch": self.camera.pitch,
+                "yaw": self.camera.yaw,
+            },
+            "scene": self.scene_json,
+            "optimized": self.scene_optimized,
+            "scene_dir": self.scene_dir,
+        }
+        tmp_fname = f"{fname}.tmp"
+        with open(tmp_fname, 'wb') as checkpoint:
+            np.savez_compressed(
+                checkpoint,
+                accum=self.accum,
+                sample_counts=self.sample_counts,
+                settings=np.array(json.dumps(settings)),
+            )
+        os.replace(tmp_fname, fname)
+
+    @classmethod
+    def from_checkpoint(cls, fname) -> "Pathtracer":
+        """
+        Create a pathtracer from a checkpoint, ready to continue with render_progressive or add_samples.
+
+        Parameters:
+            fname: The checkpoint file.
+
+        Returns:
+            Pathtracer: The restored pathtracer.
+        """
+        with np.load(fname) as checkpoint:
+            settings = json.loads(str(checkpoint["settings"]))
+            if settings["version"] != CHECKPOINT_VERSION:
+                raise Exception(f"Unsupported checkpoint version {settings['version']}.")
+            p = cls(settings["rows"], settings["cols"])
+            p.accum = checkpoint["accum"]
+            p.sample_counts = checkpoint["sample_counts"]
+        p.depth = settings["depth"]
+        p.rays_per_pixel = settings["rays_per_pixel"]
+        p.rng = CounterRNG(settings["seed"])
+        camera = settings["camera"]
+        p.set_camera(camera["pos"], camera["pitch"], camera["yaw"], settings["fov"])
+        if settings["scene"] is not None:
+            p.load_from_json(settings["scene"], settings.get("optimized", False), settings.get("scene_dir"))
+        p.final_pixels = p.accum / np.maximum(p.sample_counts, 1)[:, :, np.newaxis]
+        return p
+
     def usable_pixel_array(self):
         """
         Get the pixel array in a format that can be saved to a file or displayed.
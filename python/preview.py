@@ -0,0 +1,401 @@
+"""
+Interactive previews of a scene, for scouting shots.
+
+A PreviewSession renders in a background thread, first at a coarse resolution
+and one ray per pixel, then refines level by level (1/8, 1/4, 1/2 and full
+resolution by default, the last at the pathtracer's rays per pixel). Moving the
+camera or changing the scene cancels the work in flight and restarts from the
+coarsest level, so a new view shows up within a fraction of a second. Every
+finished pass is published to a PreviewBuffer, a block of shared memory that
+viewers in this or other processes poll for the latest frame.
+
+Scout a scene, moving the camera with the keyboard (WASD, arrow keys to turn):
+    python3 preview.py scene scenes/cornell_box.json --name pathtracer_preview
+
+Watch the same preview from another process:
+    python3 preview.py view --name pathtracer_preview
+"""
+
+import argparse
+import copy
+import threading
+from multiprocessing import resource_tracker, shared_memory
+from time import time
+from typing import Dict, Tuple
+
+import numpy as np
+
+from pathtracer import CounterRNG, Pathtracer
+
+# Downscale factors of the preview levels, refined in order.
+PREVIEW_LEVELS = (8, 4, 2, 1)
+# Pixels traced between checks for a cancelled preview.
+PREVIEW_BAND_PIXELS = 4096
+# How often viewers poll the shared buffer, in seconds.
+VIEW_INTERVAL = 0.05
+PREVIEW_HEADER_DTYPE = np.dtype([
+    ('seq', '<u8'),
+    ('rows', '<u8'),
+    ('cols', '<u8'),
+    ('level', '<u8'),
+    ('samples', '<u8'),
+    ('generation', '<u8'),
+    ('frames', '<u8'),
+    ('done', '<u8'),
+])
+
+
+class PreviewBuffer():
+    """Represents the latest preview frame, in shared memory that viewers can poll."""
+
+    def __init__(self, name=None, rows=None, cols=None) -> None:
+        """
+        Create a new preview buffer, or attach to an existing one.
+
+        Parameters:
+            name: The name of the shared memory block. Defaults to a generated name when creating.
+            rows: The frame height. Creates the buffer when given, otherwise attaches to the named one.
+            cols: The frame width.
+        """
+        self.owner = rows is not None
+        if self.owner:
+            size = PREVIEW_HEADER_DTYPE.itemsize + rows * cols * 3 * np.dtype(np.float32).itemsize
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        else:
+            try:
+                self.shm = shared_memory.SharedMemory(name=name, track=False)
+            except TypeError:
+                # Before Python 3.13, attaching registers the block with this process's resource
+                # tracker, which would remove it from under its owner when this process exits.
+                self.shm = shared_memory.SharedMemory(name=name)
+                resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self.header = np.ndarray((1,), dtype=PREVIEW_HEADER_DTYPE, buffer=self.shm.buf)
+        if self.owner:
+            self.header[0] = 0
+            self.header['rows'] = rows
+            self.header['cols'] = cols
+        rows, cols = int(self.header['rows'][0]), int(self.header['cols'][0])
+        self.image = np.ndarray((rows, cols, 3), dtype=np.float32, buffer=self.shm.buf, offset=PREVIEW_HEADER_DTYPE.itemsize)
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def write(self, image, level, samples, generation, done) -> None:
+        """
+        Publish a frame. The sequence number is odd while the frame is being written, so
+        readers can tell a torn read and retry.
+
+        Parameters:
+            image: The frame, (rows, cols, 3) in 0-255 range.
+            level: The downscale factor it was rendered at.
+            samples: Its rays per pixel.
+            generation: The camera and scene generation it shows.
+            done: Whether it is the last frame of its generation.
+        """
+        self.header['seq'] += 1
+        self.image[:] = image
+        self.header['level'] = level
+        self.header['samples'] = samples
+        self.header['generation'] = generation
+        self.header['done'] = done
+        self.header['frames'] += 1
+        self.header['seq'] += 1
+
+    def read(self) -> Tuple[np.ndarray, dict]:
+        """
+        Get a consistent copy of the latest frame.
+
+        Returns:
+            Tuple[np.ndarray, dict]: The frame, and its level, samples, generation, frame
+            count and whether it is done. The frame count is 0 until the first frame.
+        """
+        while True:
+            seq = int(self.header['seq'][0])
+            if seq % 2:
+                continue
+            image = self.image.copy()
+            info = {key: int(self.header[key][0]) for key in ('level', 'samples', 'generation', 'frames', 'done')}
+            if int(self.header['seq'][0]) == seq:
+                info['done'] = bool(info['done'])
+                return image, info
+
+    def close(self) -> None:
+        """
+        Detach from the buffer, removing it if this process created it.
+        """
+        del self.header, self.image
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class PreviewSession():
+    """Represents an interactive preview of a pathtracer's scene, refined in the background."""
+
+    def __init__(self, pathtracer: Pathtracer, levels=PREVIEW_LEVELS, coarse_samples=1, name=None) -> None:
+        """
+        Initialize a new PreviewSession object and start rendering.
+
+        Parameters:
+            pathtracer: The pathtracer holding the scene, camera and render settings. Change its
+                camera and scene through the session, so in-flight work is cancelled.
+            levels: The downscale factors of the levels, refined in order. The full resolution
+                level (1) renders at the pathtracer's rays_per_pixel.
+            coarse_samples: The rays per pixel of the other levels.
+            name: The name of the shared memory block frames are published to.
+        """
+        self.pathtracer = pathtracer
+        self.levels = levels
+        self.coarse_samples = coarse_samples
+        self.buffer = PreviewBuffer(name, pathtracer.rows, pathtracer.cols)
+        self.condition = threading.Condition()
+        self.generation = 0
+        self.finished_generation = -1
+        self.stopped = False
+        self.cancelled = 0
+        self.changed_at = time()
+        # Seconds from the last change to each level of it finishing.
+        self.level_seconds: Dict[int, float] = {}
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self) -> "PreviewSession":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def invalidate(self) -> None:
+        """
+        Cancel the preview in flight and restart it from the coarsest level.
+        """
+        with self.condition:
+            self.generation += 1
+            self.changed_at = time()
+            self.level_seconds = {}
+            self.condition.notify_all()
+
+    def set_camera(self, pos, pitch, yaw, fov=None) -> None:
+        """
+        Move the camera, as with Pathtracer.set_camera, and restart the preview.
+        """
+        with self.condition:
+            self.pathtracer.set_camera(pos, pitch, yaw, fov)
+            self.invalidate()
+
+    def load_from_json(self, json_blob, optimize=False, base_dir=None) -> None:
+        """
+        Load a new scene, as with Pathtracer.load_from_json, and restart the preview.
+        """
+        with self.condition:
+            self.pathtracer.load_from_json(json_blob, optimize, base_dir)
+            self.invalidate()
+
+    def set_scene(self, scene) -> None:
+        """
+        Replace the scene's shapes, and restart the preview.
+
+        Parameters:
+            scene: The new list of shapes. The list is not copied, so don't modify it afterwards.
+        """
+        with self.condition:
+            self.pathtracer.scene = scene
+            self.invalidate()
+
+    def wait(self, timeout=None) -> bool:
+        """
+        Wait for the preview of the current camera and scene to reach full resolution.
+
+        Parameters:
+            timeout: The most seconds to wait, or None to wait for as long as it takes.
+
+        Returns:
+            bool: Whether it finished.
+        """
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: self.stopped or self.finished_generation == self.generation, timeout
+            ) and not self.stopped
+
+    def latest(self) -> Tuple[np.ndarray, dict]:
+        """
+        Get the latest published frame, as with PreviewBuffer.read.
+        """
+        return self.buffer.read()
+
+    def close(self) -> None:
+        """
+        Stop rendering and remove the shared buffer.
+        """
+        with self.condition:
+            self.stopped = True
+            self.generation += 1
+            self.condition.notify_all()
+        self.thread.join()
+        self.buffer.close()
+
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.stopped or self.finished_generation != self.generation)
+                if self.stopped:
+                    return
+                generation = self.generation
+                # Snapshot what the levels need, so later changes can't alter a level half way.
+                p = self.pathtracer
+                settings = (list(p.scene), p.camera, p.depth, p.rng.seed, p.rays_per_pixel)
+            if self.refine(generation, *settings):
+                with self.condition:
+                    if self.generation == generation:
+                        self.finished_generation = generation
+                        self.condition.notify_all()
+
+    def level_pathtracer(self, level, scene, camera, depth, seed) -> Pathtracer:
+        """
+        Get a pathtracer rendering the scene at a downscale factor. Each of its pixels covers a
+        level by level block of the full resolution pixels.
+
+        Parameters:
+            level: The downscale factor.
+            scene: The shapes.
+            camera: The full resolution camera.
+            depth: The bounce depth.
+            seed: The seed of the random numbers.
+
+        Returns:
+            Pathtracer: The pathtracer, with its camera's pixel steps scaled up by the factor.
+        """
+        rows = -(-self.pathtracer.rows // level)
+        cols = -(-self.pathtracer.cols // level)
+        p = Pathtracer(rows, cols)
+        p.scene = scene
+        p.depth = depth
+        # A CounterRNG of its own, as generators aren't shared between threads.
+        p.rng = CounterRNG(seed)
+        p.camera = copy.copy(camera)
+        p.camera.rows = rows
+        p.camera.cols = cols
+        p.camera.horizontal_delta = camera.horizontal_delta * level
+        p.camera.vert_delta = camera.vert_delta * level
+        return p
+
+    def refine(self, generation, scene, camera, depth, seed, rays_per_pixel) -> bool:
+        """
+        Render the levels in turn, publishing each finished pass, until the generation changes.
+
+        Returns:
+            bool: Whether every level was rendered.
+        """
+        wave_shapes = None
+        for level in self.levels:
+            p = self.level_pathtracer(level, scene, camera, depth, seed)
+            if wave_shapes is None:
+                wave_shapes = p.wavefront_shapes()
+            p.wave_shapes = wave_shapes
+            samples = rays_per_pixel if level == 1 else min(self.coarse_samples, rays_per_pixel)
+            pixels = np.arange(p.rows * p.cols)
+            frame = np.zeros((len(pixels), 3))
+            for sample in range(samples):
+                for start in range(0, len(pixels), PREVIEW_BAND_PIXELS):
+                    if self.generation != generation:
+                        self.cancelled += 1
+                        return False
+                    p.trace_wave(pixels[start:start + PREVIEW_BAND_PIXELS], sample, p.wavefront_extend, frame)
+                image = frame.reshape(p.rows, p.cols, 3) / (sample + 1)
+                image = np.repeat(np.repeat(image, level, axis=0), level, axis=1)
+                done = level == self.levels[-1] and sample == samples - 1
+                self.buffer.write(image[:self.pathtracer.rows, :self.pathtracer.cols], level, sample + 1, generation, done)
+            if self.generation == generation:
+                self.level_seconds[level] = time() - self.changed_at
+        return True
+
+
+def view(buffer: PreviewBuffer, on_key=None) -> None:
+    """
+    Show the frames of a preview buffer in a window as they are published.
+
+    Parameters:
+        buffer: The buffer to poll.
+        on_key: Called with the name of each key pressed in the window, if given.
+    """
+    import matplotlib.pyplot as plt
+
+    image, info = buffer.read()
+    fig, ax = plt.subplots()
+    shown = ax.imshow(image.clip(0, 255).astype('uint8'))
+    ax.set_axis_off()
+    last = {'frames': info['frames']}
+
+    def poll():
+        image, info = buffer.read()
+        if info['frames'] == last['frames']:
+            return
+        last['frames'] = info['frames']
+        shown.set_data(image.clip(0, 255).astype('uint8'))
+        status = "done" if info['done'] else "refining"
+        ax.set_title(f"1/{info['level']} resolution, {info['samples']} rays per pixel ({status})")
+        fig.canvas.draw_idle()
+
+    timer = fig.canvas.new_timer(interval=int(VIEW_INTERVAL * 1000))
+    timer.add_callback(poll)
+    timer.start()
+    if on_key is not None:
+        fig.canvas.mpl_connect('key_press_event', lambda event: on_key(event.key))
+    plt.show()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    scene = commands.add_parser("scene", help="Preview a scene, moving the camera with the keyboard.")
+    scene.add_argument("scene")
+    scene.add_argument("--rows", type=int, default=360)
+    scene.add_argument("--cols", type=int, default=480)
+    scene.add_argument("--spp", type=int, default=4)
+    scene.add_argument("--depth", type=int, default=4)
+    scene.add_argument("--name", default=None, help="Name of the shared memory block to publish frames to.")
+    scene.add_argument("--step", type=float, default=0.25, help="Distance moved per key press.")
+    scene.add_argument("--turn", type=float, default=0.1, help="Radians turned per key press.")
+
+    viewer = commands.add_parser("view", help="Watch the frames another process publishes.")
+    viewer.add_argument("--name", required=True)
+
+    args = parser.parse_args()
+    if args.command == "view":
+        buffer = PreviewBuffer(args.name)
+        try:
+            view(buffer)
+        finally:
+            buffer.close()
+        return
+
+    p = Pathtracer(args.rows, args.cols)
+    p.rays_per_pixel = args.spp
+    p.depth = args.depth
+    p.load_from_file(args.scene)
+    state = {'pos': np.array(p.camera.pos, dtype=float), 'pitch': p.camera.pitch, 'yaw': p.camera.yaw}
+
+    with PreviewSession(p, name=args.name) as session:
+        print(f"Publishing preview frames to shared memory {session.buffer.name}.")
+
+        def on_key(key):
+            forward = np.array([np.cos(state['yaw']), np.sin(state['yaw']), 0.0])
+            left = np.array([-np.sin(state['yaw']), np.cos(state['yaw']), 0.0])
+            moves = {'w': forward, 's': -forward, 'a': left, 'd': -left, 'r': np.array([0, 0, -1.0]), 'f': np.array([0, 0, 1.0])}
+            turns = {'left': ('yaw', 1), 'right': ('yaw', -1), 'up': ('pitch', -1), 'down': ('pitch', 1)}
+            if key in moves:
+                state['pos'] = state['pos'] + moves[key] * args.step
+            elif key in turns:
+                angle, sign = turns[key]
+                state[angle] += sign * args.turn
+            else:
+                return
+            session.set_camera(state['pos'], state['pitch'], state['yaw'])
+
+        view(session.buffer, on_key)
+
+
+if __name__ == "__main__":
+    main()
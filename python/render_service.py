@@ -0,0 +1,633 @@
+"""
+Local render service for the pathtracer.
+
+Render jobs are submitted over a Unix socket (or localhost TCP) as newline
+delimited JSON. Jobs are queued by priority and deadline, split into
+(sample pass, row band) chunks and fanned out to a warm pool of worker
+processes that keep loaded scenes resident between jobs. Progress and the
+final image are streamed back to the submitting client on the same connection.
+
+Run a server:
+    python3 render_service.py serve --socket /tmp/pathtracer.sock --workers 4
+
+Submit a job:
+    python3 render_service.py submit scenes/cornell_box.json --spp 4 --out result.png
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import heapq
+import itertools
+import json
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from time import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from pathtracer import CounterRNG, Pathtracer, load_scene_from_json
+
+DEFAULT_SOCKET = "/tmp/pathtracer.sock"
+DEFAULT_BAND_ROWS = 16
+# The most scenes a worker process keeps loaded; the least recently rendered is dropped first.
+WORKER_SCENE_LIMIT = 4
+
+# Scenes loaded by this worker process, keyed by the hash of their JSON, least recently rendered first.
+_worker_scenes: "OrderedDict[str, list]" = OrderedDict()
+
+
+def scene_key(scene_json: str) -> str:
+    """
+    Get the key identifying a scene in the worker scene caches.
+
+    Parameters:
+        scene_json: The JSON blob describing the scene.
+
+    Returns:
+        str: The hex digest of the scene JSON.
+    """
+    return hashlib.sha1(scene_json.encode()).hexdigest()
+
+
+def _render_chunk(key, scene_json, settings, sample, row_start, row_end) -> Tuple[np.ndarray, bool, List[str]]:
+    """
+    Render one row band of one sample pass in a pool worker.
+
+    Parameters:
+        key: The scene key.
+        scene_json: The scene JSON, or None if the worker is expected to have it cached.
+        settings: The job's render settings (rows, cols, depth, seed, camera).
+        sample: The index of the sample pass.
+        row_start: The first row of the band.
+        row_end: One past the last row of the band.
+
+    Returns:
+        Tuple[np.ndarray, bool, List[str]]: The summed band colors, whether the scene had to be
+        loaded, and the keys of the scenes dropped to make room for it.
+    """
+    loaded = False
+    evicted = []
+    if key not in _worker_scenes:
+        if scene_json is None:
+            raise KeyError(key)
+        _worker_scenes[key] = load_scene_from_json(scene_json)
+        loaded = True
+        while len(_worker_scenes) > WORKER_SCENE_LIMIT:
+            evicted.append(_worker_scenes.popitem(last=False)[0])
+    _worker_scenes.move_to_end(key)
+
+    p = Pathtracer(settings["rows"], settings["cols"])
+    p.depth = settings["depth"]
+    p.rng = CounterRNG(settings["seed"])
+    camera = settings["camera"]
+    p.set_camera(camera["pos"], camera["pitch"], camera["yaw"], camera.get("fov"))
+    p.scene = _worker_scenes[key]
+    return p.render_region(row_start, row_end, samples=1, first_sample=sample), loaded, evicted
+
+
+def _spec_int(spec, name, default, minimum) -> int:
+    """
+    Get an integer field of a job description, checking its type and range.
+
+    Parameters:
+        spec: The job description sent by the client.
+        name: The field.
+        default: The value if the field is missing.
+        minimum: The smallest value allowed, or None to allow any.
+
+    Returns:
+        int: The value.
+    """
+    value = spec.get(name, default)
+    # bool is an int subclass, but true is not a row count.
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError(f"Job field {name} must be an integer, got {value!r}.")
+    if minimum is not None and value < minimum:
+        raise ValueError(f"Job field {name} must be at least {minimum}, got {value}.")
+    return value
+
+
+def _spec_number(value, name) -> float:
+    """
+    Check that a field of a job description is a number.
+
+    Parameters:
+        value: The field's value.
+        name: The field, for the error message.
+
+    Returns:
+        float: The value.
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"Job field {name} must be a number, got {value!r}.")
+    return value
+
+
+class RenderJob():
+    """Represents a render job queued in the service."""
+
+    def __init__(self, job_id, spec, send: Callable) -> None:
+        """
+        Initialize a new RenderJob object.
+
+        Parameters:
+            job_id: The id assigned to the job by the service.
+            spec: The job description sent by the client.
+            send: Coroutine function used to stream events back to the client.
+
+        Raises:
+            ValueError: If a field of the job description has the wrong type or range, so the
+                job would render nothing or fail in the workers.
+        """
+        self.job_id = job_id
+        self.send = send
+
+        if "scene" in spec:
+            self.scene_json: str = json.dumps(spec["scene"])
+        elif isinstance(spec.get("scene_file"), str):
+            with open(spec["scene_file"], "r") as scene_file:
+                self.scene_json = scene_file.read()
+        else:
+            raise ValueError("Job needs a scene or a scene_file path.")
+        self.scene_key = scene_key(self.scene_json)
+
+        self.rows: int = _spec_int(spec, "rows", 360, 1)
+        self.cols: int = _spec_int(spec, "cols", 480, 1)
+        self.spp: int = _spec_int(spec, "spp", 4, 1)
+        self.priority: int = _spec_int(spec, "priority", 0, None)
+        deadline = spec.get("deadline")
+        self.deadline: Optional[float] = None if deadline is None else _spec_number(deadline, "deadline")
+        band_rows = _spec_int(spec, "band_rows", DEFAULT_BAND_ROWS, 1)
+        camera = {"pos": [0, 0, 0], "pitch": 0, "yaw": 0}
+        if not isinstance(spec.get("camera", {}), dict):
+            raise ValueError(f"Job field camera must be an object, got {spec['camera']!r}.")
+        camera.update(spec.get("camera", {}))
+        if not isinstance(camera["pos"], list) or len(camera["pos"]) != 3:
+            raise ValueError(f"Camera pos must be a list of 3 numbers, got {camera['pos']!r}.")
+        for i, x in enumerate(camera["pos"]):
+            _spec_number(x, f"camera.pos[{i}]")
+        for name in ("pitch", "yaw") + (("fov",) if camera.get("fov") is not None else ()):
+            _spec_number(camera[name], f"camera.{name}")
+        self.settings = {
+            "rows": self.rows,
+            "cols": self.cols,
+            "depth": _spec_int(spec, "depth", 4, 0),
+            "seed": _spec_int(spec, "seed", 0, 0),
+            "camera": camera,
+        }
+
+        # Chunks are issued pass by pass, so a job cut short by its deadline
+        # still has every pixel sampled the same number of times.
+        bands = [(r, min(r + band_rows, self.rows)) for r in range(0, self.rows, band_rows)]
+        self.pending: List[Tuple[int, int, int]] = [(s, r0, r1) for s in range(self.spp) for (r0, r1) in bands]
+        self.pending.reverse()
+        self.total = len(self.pending)
+        self.in_flight = 0
+        self.completed = 0
+        self.bands_per_pass = len(bands)
+        # Passes of a band are merged in sample order, whatever order they finish in,
+        # so the floating point sums match a serial render bit for bit.
+        self.next_sample: Dict[int, int] = {r0: 0 for (r0, _) in bands}
+        self.held: Dict[Tuple[int, int], np.ndarray] = {}
+
+        self.accum = np.zeros((self.rows, self.cols, 3))
+        self.sample_counts = np.zeros((self.rows, self.cols), dtype=np.int32)
+        self.submitted = time()
+        self.cancelled = False
+        self.done = asyncio.Event()
+
+    def sort_key(self):
+        """
+        Get the key jobs are scheduled by: priority first, then earliest deadline, then age.
+        """
+        return (-self.priority, self.deadline if self.deadline is not None else float("inf"), self.job_id)
+
+    def expired(self) -> bool:
+        """
+        Check whether the job's deadline has passed.
+        """
+        return self.deadline is not None and time() > self.deadline
+
+    def merge(self, sample, row_start, row_end, band) -> None:
+        """
+        Merge a finished chunk, holding it back until the band's earlier passes are merged.
+
+        Parameters:
+            sample: The index of the chunk's sample pass.
+            row_start: The first row of the band.
+            row_end: One past the last row of the band.
+            band: The summed band colors.
+        """
+        self.held[(row_start, sample)] = band
+        while (row_start, self.next_sample[row_start]) in self.held:
+            self.accum[row_start:row_end] += self.held.pop((row_start, self.next_sample[row_start]))
+            self.sample_counts[row_start:row_end] += 1
+            self.next_sample[row_start] += 1
+
+    def final_pixels(self) -> np.ndarray:
+        """
+        Get the averaged pixel colors from everything accumulated so far.
+        """
+        counts = np.maximum(self.sample_counts, 1)[:, :, np.newaxis]
+        return self.accum / counts
+
+
+class RenderService():
+    """Represents a local render service with a job queue and a warm worker pool."""
+
+    def __init__(self, workers=None) -> None:
+        """
+        Initialize a new RenderService object.
+
+        Parameters:
+            workers: The number of worker processes. Defaults to the number of CPUs.
+        """
+        self.workers: int = workers or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        self.jobs: List[Tuple[tuple, RenderJob]] = []
+        self.job_ids = itertools.count(1)
+        self.slots = asyncio.Semaphore(self.workers)
+        self.work_available = asyncio.Event()
+        self.dispatcher: Optional[asyncio.Task] = None
+        # Which scenes each worker process is known to have loaded. The pool gives no
+        # control over which process runs a chunk, so the scene JSON is only dropped
+        # from a chunk once every worker has reported loading it, and workers report
+        # the scenes they drop again.
+        self.scene_loads: Dict[str, int] = {}
+
+    def start(self) -> None:
+        """
+        Start the dispatcher that feeds queued chunks to the worker pool.
+        """
+        if self.dispatcher is None:
+            self.dispatcher = asyncio.get_running_loop().create_task(self.dispatch())
+
+    async def close(self) -> None:
+        """
+        Stop the dispatcher and shut the worker pool down.
+        """
+        if self.dispatcher is not None:
+            self.dispatcher.cancel()
+            try:
+                await self.dispatcher
+            except asyncio.CancelledError:
+                pass
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    async def submit(self, spec, send: Callable) -> RenderJob:
+        """
+        Queue a new render job.
+
+        Parameters:
+            spec: The job description sent by the client.
+            send: Coroutine function used to stream events back to the client.
+
+        Returns:
+            RenderJob: The queued job.
+        """
+        job = RenderJob(next(self.job_ids), spec, send)
+        await send({"event": "queued", "job_id": job.job_id, "chunks": job.total})
+        if job.expired():
+            await self.finish(job, "expired")
+            return job
+        heapq.heappush(self.jobs, (job.sort_key(), job))
+        self.work_available.set()
+        return job
+
+    def next_chunk(self) -> Optional[Tuple[RenderJob, Tuple[int, int, int]]]:
+        """
+        Take the next chunk to run from the most urgent job with work left.
+        """
+        while self.jobs:
+            job = self.jobs[0][1]
+            if job.cancelled or not job.pending:
+                heapq.heappop(self.jobs)
+                continue
+            return job, job.pending.pop()
+        return None
+
+    async def dispatch(self) -> None:
+        """
+        Feed chunks to the worker pool, one per free worker.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.slots.acquire()
+            picked = self.next_chunk()
+            while picked is None:
+                self.work_available.clear()
+                await self.work_available.wait()
+                picked = self.next_chunk()
+            job, chunk = picked
+            if job.expired():
+                # Stop issuing passes; the job finishes with what is already in flight.
+                job.pending.clear()
+                self.slots.release()
+                if job.in_flight == 0:
+                    await self.finish(job, "deadline")
+                continue
+            job.in_flight += 1
+            scene_json = None if self.scene_loads.get(job.scene_key, 0) >= self.workers else job.scene_json
+            future = loop.run_in_executor(
+                self.executor, _render_chunk, job.scene_key, scene_json, job.settings, *chunk
+            )
+            loop.create_task(self.collect(job, chunk, future))
+
+    async def collect(self, job: RenderJob, chunk, future) -> None:
+        """
+        Merge a finished chunk into its job and report progress.
+
+        Parameters:
+            job: The job the chunk belongs to.
+            chunk: The (sample, row_start, row_end) chunk description.
+            future: The executor future rendering the chunk.
+        """
+        sample, row_start, row_end = chunk
+        try:
+            band, loaded, evicted = await future
+        except Exception as e:
+            job.in_flight -= 1
+            self.slots.release()
+            if isinstance(e, KeyError) and e.args == (job.scene_key,):
+                # The chunk went without the scene JSON to a worker that has since dropped
+                # the scene. Count one worker fewer as having it, and send the chunk again.
+                self.scene_loads[job.scene_key] = max(min(self.scene_loads.get(job.scene_key, 0), self.workers) - 1, 0)
+                if not job.cancelled and not job.done.is_set():
+                    if not any(queued is job for _, queued in self.jobs):
+                        heapq.heappush(self.jobs, (job.sort_key(), job))
+                    job.pending.append(chunk)
+                    self.work_available.set()
+                return
+            job.pending.clear()
+            if not job.done.is_set():
+                await self.finish(job, "error", str(e))
+            return
+        self.slots.release()
+        job.in_flight -= 1
+        if loaded:
+            self.scene_loads[job.scene_key] = self.scene_loads.get(job.scene_key, 0) + 1
+        for key in evicted:
+            self.scene_loads[key] = self.scene_loads.get(key, 0) - 1
+            if self.scene_loads[key] <= 0:
+                del self.scene_loads[key]
+        if job.cancelled:
+            return
+
+        job.merge(sample, row_start, row_end, band)
+        job.completed += 1
+        await job.send({
+            "event": "progress",
+            "job_id": job.job_id,
+            "done": job.completed,
+            "total": job.total,
+            "samples": job.completed // job.bands_per_pass,
+        })
+
+        if not job.pending and job.in_flight == 0 and not job.done.is_set():
+            await self.finish(job, "deadline" if job.completed < job.total else "done")
+
+    async def finish(self, job: RenderJob, status, error=None) -> None:
+        """
+        Send the job's result to its client.
+
+        Parameters:
+            job: The finished job.
+            status: One of "done", "deadline", "expired" or "error".
+            error: The error message, if the job failed.
+        """
+        job.done.set()
+        message = {
+            "event": "result",
+            "job_id": job.job_id,
+            "status": status,
+            "rows": job.rows,
+            "cols": job.cols,
+            "samples": int(job.sample_counts.min()) if job.completed else 0,
+            "seconds": time() - job.submitted,
+        }
+        if error is not None:
+            message["error"] = error
+        if status in ("done", "deadline"):
+            pixels = job.final_pixels().clip(0, 255).astype('uint8')
+            message["encoding"] = "rgb8"
+            message["pixels"] = base64.b64encode(pixels.tobytes()).decode()
+        await job.send(message)
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Serve one client connection. Each line is a JSON request.
+
+        Parameters:
+            reader: The connection's stream reader.
+            writer: The connection's stream writer.
+        """
+        lock = asyncio.Lock()
+        jobs: List[RenderJob] = []
+
+        async def send(message):
+            async with lock:
+                writer.write(json.dumps(message).encode() + b"\n")
+                await writer.drain()
+
+        try:
+            while line := await reader.readline():
+                try:
+                    request = json.loads(line)
+                except json.JSONDecodeError as e:
+                    await send({"event": "error", "error": f"Invalid request: {e}"})
+                    continue
+                if not isinstance(request, dict):
+                    await send({"event": "error", "error": "Invalid request: expected a JSON object."})
+                    continue
+                op = request.get("op")
+                if op == "render":
+                    if not isinstance(request.get("job"), dict):
+                        await send({"event": "error", "error": "Invalid request: job must be a JSON object."})
+                        continue
+                    try:
+                        jobs.append(await self.submit(request["job"], send))
+                    except (KeyError, OSError, TypeError, ValueError) as e:
+                        await send({"event": "error", "error": str(e)})
+                elif op == "status":
+                    await send({
+                        "event": "status",
+                        "workers": self.workers,
+                        "queued_jobs": len(self.jobs),
+                        "resident_scenes": len(self.scene_loads),
+                    })
+                else:
+                    await send({"event": "error", "error": f"Unknown op {op!r}."})
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+        finally:
+            # Nobody is left to receive the results of this client's jobs.
+            for job in jobs:
+                if not job.done.is_set():
+                    job.cancelled = True
+                    job.pending.clear()
+            writer.close()
+
+    async def serve(self, socket_path=None, host=None, port=None) -> asyncio.AbstractServer:
+        """
+        Start accepting clients on a Unix socket, or on TCP if a port is given.
+
+        Parameters:
+            socket_path: The Unix socket path to listen on.
+            host: The TCP host to listen on.
+            port: The TCP port to listen on.
+
+        Returns:
+            asyncio.AbstractServer: The listening server.
+        """
+        self.start()
+        if port is not None:
+            return await asyncio.start_server(self.handle_client, host or "127.0.0.1", port)
+        socket_path = socket_path or DEFAULT_SOCKET
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        return await asyncio.start_unix_server(self.handle_client, socket_path)
+
+
+class RenderClient():
+    """Represents a client connection to a render service."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Initialize a new RenderClient object. Use connect() to create one.
+
+        Parameters:
+            reader: The connection's stream reader.
+            writer: The connection's stream writer.
+        """
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, socket_path=None, host=None, port=None) -> "RenderClient":
+        """
+        Connect to a render service.
+
+        Parameters:
+            socket_path: The Unix socket path of the service.
+            host: The TCP host of the service.
+            port: The TCP port of the service.
+
+        Returns:
+            RenderClient: The connected client.
+        """
+        if port is not None:
+            reader, writer = await asyncio.open_connection(host or "127.0.0.1", port)
+        else:
+            reader, writer = await asyncio.open_unix_connection(socket_path or DEFAULT_SOCKET)
+        return cls(reader, writer)
+
+    async def request(self, message) -> None:
+        self.writer.write(json.dumps(message).encode() + b"\n")
+        await self.writer.drain()
+
+    async def status(self):
+        await self.request({"op": "status"})
+        return json.loads(await self.reader.readline())
+
+    async def render(self, job, on_progress: Optional[Callable] = None):
+        """
+        Submit a render job and wait for its result.
+        Only one render should be in progress per client at a time.
+
+        Parameters:
+            job: The job description (scene or scene_file, rows, cols, spp, depth, seed, camera, priority, deadline).
+            on_progress: Optional callback invoked with each progress event.
+
+        Returns:
+            Tuple[dict, Optional[np.ndarray]]: The result event and the decoded uint8 image, if any.
+        """
+        await self.request({"op": "render", "job": job})
+        while line := await self.reader.readline():
+            event = json.loads(line)
+            if event["event"] == "error":
+                raise RuntimeError(event["error"])
+            if event["event"] == "progress" and on_progress is not None:
+                on_progress(event)
+            if event["event"] == "result":
+                pixels = None
+                if "pixels" in event:
+                    pixels = np.frombuffer(base64.b64decode(event.pop("pixels")), dtype=np.uint8)
+                    pixels = pixels.reshape((event["rows"], event["cols"], 3))
+                return event, pixels
+        raise ConnectionError("Render service closed the connection.")
+
+    async def close(self) -> None:
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+async def _serve_forever(args) -> None:
+    service = RenderService(args.workers)
+    server = await service.serve(args.socket, args.host, args.port)
+    print(f"Render service listening with {service.workers} workers.")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.close()
+
+
+async def _submit(args) -> None:
+    client = await RenderClient.connect(args.socket, args.host, args.port)
+    job = {
+        "scene_file": os.path.abspath(args.scene),
+        "rows": args.rows,
+        "cols": args.cols,
+        "spp": args.spp,
+        "depth": args.depth,
+        "priority": args.priority,
+    }
+    if args.timeout is not None:
+        job["deadline"] = time() + args.timeout
+
+    def show(event):
+        print(f"\r{event['done']} / {event['total']} chunks done, {event['samples']} full passes.", end='')
+
+    result, pixels = await client.render(job, show)
+    await client.close()
+    print()
+    print(f"Job {result['job_id']} {result['status']} with {result['samples']} rays per pixel in {result['seconds']:.2f} seconds.")
+    if pixels is not None:
+        import matplotlib.pyplot as plt
+        plt.imsave(args.out, pixels)
+        print(f"Saved rendered scene to {args.out}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--socket", default=None, help="Unix socket path of the service.")
+    parser.add_argument("--host", default=None, help="TCP host, used together with --port.")
+    parser.add_argument("--port", type=int, default=None, help="Serve or connect over TCP instead of a Unix socket.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve = commands.add_parser("serve", help="Run the render service.")
+    serve.add_argument("--workers", type=int, default=None)
+
+    submit = commands.add_parser("submit", help="Submit a render job and save the result.")
+    submit.add_argument("scene")
+    submit.add_argument("--rows", type=int, default=360)
+    submit.add_argument("--cols", type=int, default=480)
+    submit.add_argument("--spp", type=int, default=4)
+    submit.add_argument("--depth", type=int, default=4)
+    submit.add_argument("--priority", type=int, default=0)
+    submit.add_argument("--timeout", type=float, default=None, help="Seconds until the job's deadline.")
+    submit.add_argument("--out", default="test_render_result.png")
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        asyncio.run(_serve_forever(args))
+    else:
+        asyncio.run(_submit(args))
+
+
+if __name__ == "__main__":
+    main()
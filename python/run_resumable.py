@@ -0,0 +1,27 @@
+from pathtracer import *
+import os
+import sys
+import time
+
+# Renders with periodic checkpoints. Rerun after an interruption to pick up where it left off,
+# or pass a number of extra rays per pixel to add to a finished render.
+checkpoint_file = 'test_render_checkpoint.npz'
+
+if os.path.exists(checkpoint_file):
+    p = Pathtracer.from_checkpoint(checkpoint_file)
+    print(f'Resuming from {checkpoint_file} with {p.sample_counts.min()} rays per pixel done')
+else:
+    p = Pathtracer()
+    p.rays_per_pixel = 40
+    p.depth = 5
+    p.load_from_file("scenes/cornell_box_tri.json")
+
+t1 = time.time()
+if len(sys.argv) > 1:
+    p.add_samples(int(sys.argv[1]), checkpoint_file)
+else:
+    p.render_progressive(checkpoint_file)
+t2 = time.time()
+print(f'Took {t2-t1} seconds to render scene, running {p.iters} iterations')
+
+p.save_rendered_scene('test_render_result.png')